@@ -1,5 +1,10 @@
 from flask import Flask, g, session, json, render_template, request, redirect, url_for, abort, flash, get_flashed_messages
-import chatter_classes as cc, sqlite3, os
+from markupsafe import Markup
+import chatter_classes as cc, chatter_cache, chatter_shards, chatter_replicas, chatter_sqltrace, chatter_metrics
+import chatter_profiler, chatter_slowlog, chatter_analytics, datetime
+import chatter_archive, chatter_notify, chatter_broker, chatter_websocket, sqlite3, os, gzip, zlib, collections, time
+import chatter_ratelimit, chatter_sendlog, chatter_migrations, chatter_retention, threading
+import chatter_maintenance, itertools, math
 
 app = Flask(__name__)
 
@@ -8,15 +13,211 @@ app.config.from_object(__name__)
 app.config.update(
     {
         'DATABASE': os.path.join(app.root_path, 'test.db'),
-        'SECRET_KEY': '123456' # TODO: Change secret key
+        # When shard databases are listed, DATABASE is the catalog and messages are spread across the shards
+        'SHARD_DATABASES': [],
+        'SECRET_KEY': '123456', # TODO: Change secret key
+        'COMPRESS_MIN_SIZE': 500,   # Responses smaller than this (in bytes) are sent uncompressed
+        'COMPRESS_LEVEL': 6,
+        'HISTORY_PAGE_SIZE': 50,
+        'PAGE_CACHE_DIR': os.path.join(app.root_path, 'page_cache'),
+        'PAGE_CACHE_ENTRIES': 256,
+        'PAGE_CACHE_DISK_BYTES': 64 << 20,
+        # Rendered HTML for blocks of about this many of a chatroom's messages is kept in memory, so chatroom pages are
+        # mostly put together from fragments rendered before
+        'FRAGMENT_CACHE_ENTRIES': 1024,
+        'FRAGMENT_BLOCK_SIZE': 32,
+        # Read-only copies of DATABASE for heavy reads. Set the refresh interval to None if the replicas are refreshed
+        # by a separate process (python chatter_replicas.py ...), e.g. when running several workers.
+        'READ_REPLICAS': [],
+        'READ_REPLICA_MAX_STALENESS': 5.0,
+        'READ_REPLICA_REFRESH_INTERVAL': 5.0,
+        # Count and time the SQL statements run by each request, reported at /debug/sql and, for admins only, in
+        # X-SQL-* response headers
+        'SQL_TRACE': True,
+        'SQL_REPEAT_THRESHOLD': chatter_sqltrace.REPEAT_THRESHOLD,
+        'SQL_TRACE_HISTORY': 50,
+        # Every worker process writes its metrics here so /metrics can report totals for all of them
+        'METRICS_DIR': os.path.join(app.root_path, 'metrics'),
+        'METRICS_FLUSH_INTERVAL': 1.0,
+        # Sampled request profiles are written here; admins switch profiling on and off at /debug/profile
+        'PROFILE_DIR': os.path.join(app.root_path, 'profiles'),
+        'PROFILE_MAX_DUMPS': chatter_profiler.MAX_DUMPS,
+        # Statements slower than this are logged with their query plan (None to turn off), see /debug/slow-queries
+        'SLOW_QUERY_MS': chatter_slowlog.THRESHOLD_MS,
+        'SLOW_QUERY_LOG': os.path.join(app.root_path, 'slow_queries.log'),
+        # Each worker process has a socket here, so messages added through one worker are pushed by all of them
+        # (None to turn off, e.g. when only running one process)
+        'NOTIFY_DIR': os.path.join(app.root_path, 'notify'),
+        # Events waiting to be pushed to a WebSocket; a client that falls further behind is disconnected and reloads
+        'WEBSOCKET_QUEUE': 200,
+        # Token buckets limiting how fast messages can be sent, shared by every worker through this file (None to turn
+        # off). Per-user limits depend on the sender's role in the chatroom, and None means no limit.
+        'RATE_LIMIT_FILE': os.path.join(app.root_path, 'rate_limits.bin'),
+        'RATE_LIMITS': {'member': chatter_ratelimit.Limit(rate=1.0, burst=10),
+                        'owner': chatter_ratelimit.Limit(rate=2.0, burst=20),
+                        'admin': None},
+        'CHATROOM_RATE_LIMIT': chatter_ratelimit.DEFAULT_CHATROOM_LIMIT,
+        # Messages sent over WebSockets are acknowledged once written to a log here, and added to the database in the
+        # background (None to add them before acknowledging)
+        'SEND_LOG_DIR': None,
+        # Seconds between deleting messages older than their chatroom's retention period (None to turn off, e.g. when
+        # python chatter_retention.py is run from cron or several workers are running), and the retention for
+        # chatrooms without a policy of their own (None to keep their messages forever)
+        'RETENTION_INTERVAL': chatter_retention.INTERVAL,
+        'RETENTION_DEFAULT_DAYS': None,
+        # Database maintenance (ANALYZE, PRAGMA optimize, WAL checkpoints and incremental vacuum) runs every interval
+        # seconds (None to only run it from /debug/maintenance), starting within the local hours given, with a time
+        # budget in seconds per database. Workers share the state file so only one of them runs it.
+        'MAINTENANCE_INTERVAL': chatter_maintenance.INTERVAL,
+        'MAINTENANCE_HOURS': chatter_maintenance.HOURS,
+        'MAINTENANCE_BUDGET': chatter_maintenance.BUDGET,
+        'MAINTENANCE_STATE_FILE': os.path.join(app.root_path, 'maintenance.state')
     }
 )
 
+# Only reads each database's header; raises chatter_migrations.SchemaError if a database is newer than this code
+for path, count in chatter_migrations.check_schema([app.config['DATABASE']] + app.config['SHARD_DATABASES']).items():
+    app.logger.warning(f"{path} is {count} schema migrations behind. Run python chatter_migrations.py to update it.")
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+
+page_cache = chatter_cache.CompressedPageCache(app.config['PAGE_CACHE_ENTRIES'], app.config['PAGE_CACHE_DIR'],
+                                               app.config['PAGE_CACHE_DISK_BYTES'])
+cc.message_change_listeners.append(page_cache.invalidate_chatroom)
+
+fragment_cache = chatter_cache.FragmentCache(app.config['FRAGMENT_CACHE_ENTRIES'], app.config['FRAGMENT_BLOCK_SIZE'])
+cc.message_change_listeners.append(fragment_cache.invalidate_message)
+
+# Summaries of the SQL run by recent requests, newest last, for /debug/sql
+sql_trace_history = collections.deque(maxlen=app.config['SQL_TRACE_HISTORY'])
+
+metrics = chatter_metrics.Metrics(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+metrics.describe('chatter_http_request_duration_seconds', 'histogram', "Time taken to handle each request.")
+metrics.describe('chatter_http_requests_total', 'counter', "Requests handled, by route, method and status.")
+metrics.describe('chatter_db_statements_total', 'counter', "SQL statements run, by route (needs SQL_TRACE).")
+metrics.describe('chatter_db_statement_seconds_total', 'counter', "Time spent in SQL statements, by route.")
+metrics.describe('chatter_db_request_statements', 'histogram', "SQL statements run per request, by route.")
+metrics.describe('chatter_db_connections_open', 'gauge', "Database connections currently open for requests.")
+metrics.describe('chatter_db_connections_opened_total', 'counter', "Database connections opened for requests.")
+metrics.describe('chatter_cache_requests_total', 'counter', "Cache lookups, by cache and result (hit or miss).")
+metrics.describe('chatter_messages_inserted_total', 'counter', "Messages added. Use rate() for the insert rate.")
+metrics.derive('chatter_cache_hit_ratio', "Fraction of cache lookups that were hits, by cache.",
+               lambda totals: chatter_metrics.hit_ratios(totals, 'chatter_cache_requests_total'))
+
+cc.message_add_listeners.append(lambda chatroomid, messageid: metrics.inc('chatter_messages_inserted_total'))
+
+metrics.describe('chatter_broker_events_total', 'counter', "Broker events published, delivered to subscribers, dropped "
+                 "from full queues, and subscriptions disconnected for falling behind.")
+metrics.describe('chatter_broker_subscriptions', 'gauge', "Open broker subscriptions.")
+
+
+def record_broker_metrics(name, topic, count):
+    if name == 'subscribers':
+        metrics.inc('chatter_broker_subscriptions', amount=count)
+    else:
+        metrics.inc('chatter_broker_events_total', {'event': name}, count)
+
+
+cc.broker.metrics_hook = record_broker_metrics
+
+metrics.describe('chatter_rate_limited_total', 'counter', "Messages refused by rate limiting, by the bucket that "
+                 "was empty (user or chatroom).")
+metrics.describe('chatter_websocket_connections_open', 'gauge', "WebSocket sessions currently open.")
+metrics.describe('chatter_websocket_messages_total', 'counter', "WebSocket messages received from clients and pushed "
+                 "to them.")
+
+profiler = chatter_profiler.RequestProfiler(app.config['PROFILE_DIR'], app.config['PROFILE_MAX_DUMPS'])
+
+if app.config['SLOW_QUERY_MS'] is not None:
+    chatter_slowlog.active_log = chatter_slowlog.SlowQueryLog(app.config['SLOW_QUERY_MS'], app.config['SLOW_QUERY_LOG'],
+                                                              logger=app.logger)
+    connection_factory = chatter_slowlog.TimedConnection
+else:
+    connection_factory = sqlite3.Connection
+
+if app.config['READ_REPLICAS']:
+    cc.read_replicas = chatter_replicas.ReplicaManager(app.config['DATABASE'], app.config['READ_REPLICAS'],
+                                                       app.config['READ_REPLICA_REFRESH_INTERVAL'], connection_factory)
+    cc.READ_REPLICA_MAX_STALENESS = app.config['READ_REPLICA_MAX_STALENESS']
+
+    if app.config['READ_REPLICA_REFRESH_INTERVAL'] is not None:
+        cc.read_replicas.start()
+
+if app.config['RATE_LIMIT_FILE'] is not None:
+    cc.rate_limiter = chatter_ratelimit.RateLimiter(app.config['RATE_LIMIT_FILE'], app.config['RATE_LIMITS'],
+                                                    app.config['CHATROOM_RATE_LIMIT'])
+
+if app.config['NOTIFY_DIR'] is not None:
+    try:
+        cc.notify_channel = chatter_notify.NotifyChannel(app.config['NOTIFY_DIR'], cc.broker,
+                                                         on_receive=cc.receive_event)
+        cc.notify_channel.start()
+    except (chatter_notify.NotifyError, OSError) as e:
+        app.logger.warning(f"Cross-process notification is off, so only this worker's messages will be pushed: {e}")
+
+def connect_db():
+    # A new connection, for threads other than the request's own (which uses get_db())
+
+    if app.config['SHARD_DATABASES']:
+        return chatter_shards.ShardRouter(app.config['DATABASE'], app.config['SHARD_DATABASES'], connection_factory)
+
+    db = sqlite3.connect(app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES, factory=connection_factory)
+    db.row_factory = sqlite3.Row
+
+    return db
+
+metrics.describe('chatter_retention_purged_messages_total', 'counter', "Messages deleted for being older than their "
+                 "chatroom's retention period.")
+metrics.describe('chatter_retention_run_seconds', 'histogram', "Time taken by each retention run.")
+
+
+def record_retention_run(result, seconds):
+    metrics.inc('chatter_retention_purged_messages_total', amount=result['purged'])
+    metrics.observe('chatter_retention_run_seconds', value=seconds)
+
+
+if app.config['RETENTION_INTERVAL'] is not None:
+    retention_scheduler = chatter_retention.RetentionScheduler(connect_db, app.config['RETENTION_INTERVAL'],
+                                                               app.config['RETENTION_DEFAULT_DAYS'],
+                                                               on_run=record_retention_run)
+    retention_scheduler.start()
+
+metrics.describe('chatter_maintenance_task_seconds', 'histogram', "Time taken by each database maintenance task.")
+metrics.describe('chatter_maintenance_tasks_total', 'counter', "Database maintenance tasks run, by task and result "
+                 "(completed, skipped, interrupted by the time budget, or failed).")
+metrics.describe('chatter_maintenance_bytes_reclaimed_total', 'counter', "Bytes given back to the filesystem by "
+                 "database maintenance, by task.")
+
+
+def record_maintenance_run(results):
+    for r in results:
+        metrics.inc('chatter_maintenance_tasks_total', {'task': r['task'], 'result': r['result']})
+        if r['result'] != 'skipped':
+            metrics.observe('chatter_maintenance_task_seconds', {'task': r['task']}, r['seconds'])
+            metrics.inc('chatter_maintenance_bytes_reclaimed_total', {'task': r['task']}, r['bytes_reclaimed'])
+
+
+maintenance_scheduler = chatter_maintenance.MaintenanceScheduler(connect_db, app.config['MAINTENANCE_STATE_FILE'],
+                                                                 app.config['MAINTENANCE_INTERVAL'],
+                                                                 app.config['MAINTENANCE_HOURS'],
+                                                                 app.config['MAINTENANCE_BUDGET'],
+                                                                 on_run=record_maintenance_run)
+maintenance_scheduler.start()
+
+if app.config['SEND_LOG_DIR'] is not None:
+    cc.send_log = chatter_sendlog.SendLog(app.config['SEND_LOG_DIR'], connect_db)
+    cc.send_log.start()
+
 def get_db():
 
     if not hasattr(g, 'db'):
-        g.db = sqlite3.connect(app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES)
-        g.db.row_factory = sqlite3.Row
+        g.db = connect_db()
+
+        metrics.inc('chatter_db_connections_opened_total')
+        metrics.inc('chatter_db_connections_open')
+
+        if 'sql_trace' in g:
+            g.sql_trace.install(g.db)
 
     return g.db
 
@@ -24,14 +225,149 @@ def get_db():
 def close_db(error):
     if hasattr(g, 'db'):
         g.db.close()
+        metrics.inc('chatter_db_connections_open', amount=-1)
+
+
+@app.before_request
+def start_sql_trace():
+    g.request_started = time.perf_counter()
+
+    if app.config['SQL_TRACE']:
+        g.sql_trace = chatter_sqltrace.RequestTrace(app.config['SQL_REPEAT_THRESHOLD'])
+
+
+@app.before_request
+def start_profile():
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    if profiler.should_profile(route, session.get('active_userid')):
+        profile = profiler.start()
+        if profile:
+            g.profile = (profile, route)
+
+
+@app.teardown_request
+def finish_profile(error):
+    # A teardown rather than after_request so the profile is always stopped, even if the request failed
+    if 'profile' in g:
+        profile, route = g.pop('profile')
+        profiler.finish(profile, route, time.perf_counter() - g.request_started)
+
+
+@app.after_request
+def finish_sql_trace(response):
+
+    # Requests that never touched the database (e.g. static files) have nothing to report
+    if 'sql_trace' not in g:
+        return response
+
+    summary = g.sql_trace.finish()
+    if not summary['statement_count']:
+        return response
+
+    # The headers show how requests query the database, so like /debug/sql they are only for admins. Only a user the
+    # request already loaded is checked, so that the trace adds no queries of its own.
+    active_user = g.get('active_user')
+    if active_user and active_user.userid == session.get('active_userid') and active_user.is_admin:
+        response.headers['X-SQL-Count'] = str(summary['statement_count'])
+        response.headers['X-SQL-Time-Ms'] = f"{summary['statement_ms']:.2f}"
+        if summary['repeated']:
+            response.headers['X-SQL-Repeated'] = str(len(summary['repeated']))
+
+    if summary['repeated']:
+        for s in summary['repeated']:
+            app.logger.warning(f"Possible N+1 query in {request.method} {request.path}: "
+                               f"ran {s['count']} times: {s['shape']}")
+
+    sql_trace_history.append(dict(method=request.method, path=request.full_path.rstrip('?'),
+                                  status=response.status_code, **summary))
+
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = {'route': route, 'method': request.method}
+
+    metrics.observe('chatter_http_request_duration_seconds', labels, time.perf_counter() - g.request_started)
+    metrics.inc('chatter_http_requests_total', dict(labels, status=response.status_code))
+
+    if 'sql_trace' in g:
+        summary = g.sql_trace.finish()
+        metrics.inc('chatter_db_statements_total', {'route': route}, summary['statement_count'])
+        metrics.inc('chatter_db_statement_seconds_total', {'route': route}, summary['statement_ms'] / 1000)
+        metrics.observe('chatter_db_request_statements', {'route': route}, summary['statement_count'])
+
+    # The caches keep their own counts, so copy them across rather than counting twice
+    page_stats = page_cache.stats
+    metrics.set('chatter_cache_requests_total', {'cache': 'page', 'result': 'hit'},
+                page_stats['hits'] + page_stats['disk_hits'])
+    metrics.set('chatter_cache_requests_total', {'cache': 'page', 'result': 'miss'}, page_stats['misses'])
+
+    fragment_stats = fragment_cache.stats
+    metrics.set('chatter_cache_requests_total', {'cache': 'fragment', 'result': 'hit'}, fragment_stats['hits'])
+    metrics.set('chatter_cache_requests_total', {'cache': 'fragment', 'result': 'miss'}, fragment_stats['misses'])
+
+    segment_stats = chatter_archive.get_segment_cache_info()
+    metrics.set('chatter_cache_requests_total', {'cache': 'archive_segment', 'result': 'hit'}, segment_stats.hits)
+    metrics.set('chatter_cache_requests_total', {'cache': 'archive_segment', 'result': 'miss'}, segment_stats.misses)
+
+    metrics.maybe_flush()
+
+    return response
+
+
+def choose_encoding():
+    # Pick gzip or deflate according to the client's Accept-Encoding header, or None if it accepts neither
+    return request.accept_encodings.best_match(['gzip', 'deflate'])
+
+
+def compress(data:bytes, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+    else:
+        return zlib.compress(data, app.config['COMPRESS_LEVEL'])
+
+
+@app.after_request
+def compress_response(response):
+
+    response.vary.add('Accept-Encoding')
+
+    # Leave alone anything already encoded (e.g. pages served from page_cache), streamed or not worth compressing
+    if response.direct_passthrough or 'Content-Encoding' in response.headers or \
+            response.status_code < 200 or response.status_code >= 300 or \
+            response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    encoding = choose_encoding()
+    if not encoding:
+        return response
+
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+
+    return response
 
 
 def get_active_user() -> cc.User:
+    # Loaded once per request and kept in g, where after_request hooks can find it
     try:
-        return cc.User(session['active_userid'], get_db())
+        userid = session['active_userid']
     except KeyError:
         return None
 
+    if g.get('active_user') is None or g.active_user.userid != userid:
+        g.active_user = cc.User(userid, get_db())
+
+    return g.active_user
+
 @app.route('/')
 def hello_world():
     return 'Hello World!'
@@ -101,6 +437,62 @@ def view_chatroom_list():
     else:
         return redirect(url_for('login'))
 
+@app.route('/join', methods=['POST'])
+def join_chatroom():
+    active_user = get_active_user()
+    if active_user:
+        try:
+            chatroom = active_user.join_chatroom(request.form['joincode'].strip())
+            return redirect(url_for('view_chatroom', chatroomid=chatroom.chatroomid))
+
+        except cc.ChatroomNotFoundError:
+            flash("No chatroom has that join code")
+            return redirect(url_for('view_chatroom_list'))
+
+        except cc.UserPermissionError:
+            abort(403)
+    else:
+        abort(401)
+
+
+def render_timeline(chatroomid, entries):
+    """
+    Renders timeline entries (oldest first) as HTML, one block of messages at a time (see chatter_cache.FragmentCache),
+    reusing the blocks held in fragment_cache. Each block's version is the hash of its entries, so any change to what it
+    shows renders it again. Pending messages are always rendered, as their ids are provisional.
+    """
+
+    fragments = []
+    # Counts block starts, so each block's entries share a number; pending entries are grouped under None
+    block = 0
+
+    def get_block(e):
+        nonlocal block
+        if e.pending:
+            return None
+        if fragment_cache.starts_block(e.messageid):
+            block += 1
+        return block
+
+    for block_number, group in itertools.groupby(entries, get_block):
+        group = list(group)
+
+        if block_number is None:
+            fragments.append(render_template('message_block.html', messages=group))
+            continue
+
+        version = hash(tuple(group))
+        html = fragment_cache.get(chatroomid, group[0].messageid, group[-1].messageid, version)
+
+        if html is None:
+            html = render_template('message_block.html', messages=group)
+            fragment_cache.put(chatroomid, group[0].messageid, group[-1].messageid, version, html)
+
+        fragments.append(html)
+
+    return Markup(''.join(fragments))
+
+
 @app.route('/view/chatroom/<int:chatroomid>')
 def view_chatroom(chatroomid):
     active_user = get_active_user()
@@ -109,7 +501,13 @@ def view_chatroom(chatroomid):
             chatroom = cc.Chatroom(chatroomid, get_db())
             if chatroom.user_is_member(active_user) or chatroom.user_is_owner(active_user):
 
-                return render_template('chatroom.html', au=active_user, cr=chatroom)
+                # One page of the timeline, shown oldest first, with a link to the page before it
+                timeline = chatroom.get_timeline(request.args.get('before', type=int), app.config['HISTORY_PAGE_SIZE'])
+                stored = [e for e in timeline if not e.pending]
+                next_cursor = stored[-1].messageid if len(stored) == app.config['HISTORY_PAGE_SIZE'] else None
+
+                return render_template('chatroom.html', au=active_user, cr=chatroom, next_cursor=next_cursor,
+                                       timeline_html=render_timeline(chatroomid, list(reversed(timeline))))
 
             else:
                 return "You do not have permission to see this chatroom"
@@ -119,5 +517,324 @@ def view_chatroom(chatroomid):
     else:
         return redirect(url_for('login'))
 
+
+class WebSocketResponse(app.response_class):
+    # Returned when a WebSocket session ends. The connection no longer speaks HTTP, so rather than writing a response
+    # this tells Werkzeug that the client has gone.
+
+    def __call__(self, environ, start_response):
+        raise ConnectionError("WebSocket session finished")
+
+
+def get_socket_topics(user:cc.User):
+    return user.get_chatroomids() | {cc.get_user_topic(user.userid)}
+
+
+def push_events(ws, subscription, userid):
+    """
+    Pushes broker events for a WebSocket session until its subscription is closed, loading each new or changed
+    message so the client doesn't have to ask for it. Runs on its own thread, with its own database connection.
+    """
+
+    db = connect_db()
+    user_topic = cc.get_user_topic(userid)
+
+    try:
+        while True:
+            topic, event = subscription.get()
+
+            if event['type'] in ('message_added', 'message_changed'):
+                try:
+                    message = json.loads(cc.Message(event['messageid'], db).json)
+                except cc.MessageNotFoundError:
+                    # Deleted since
+                    message = None
+
+                if message is None and event['type'] == 'message_added':
+                    continue
+                ws.send(json.dumps(dict(event, message=message)))
+                metrics.inc('chatter_websocket_messages_total', {'direction': 'pushed'})
+
+            elif event['type'] in ('message_applied', 'messages_purged', 'user_renamed'):
+                # Lets the client swap the provisional id it was given for the real one, drop expired messages or show
+                # a sender's new username
+                ws.send(json.dumps(event))
+
+            elif event['type'] == 'membership_changed':
+                joined_or_left = topic == user_topic and event['chatroomid'] not in subscription.topics
+
+                if topic == user_topic:
+                    # Follow the user into chatrooms they have joined, and out of any they have left
+                    topics = get_socket_topics(cc.User(userid, db, lazy=True))
+                    subscription.add_topics(topics - subscription.topics)
+                    subscription.remove_topics(subscription.topics - topics)
+
+                # Changes to the user's own membership of a chatroom they were already in arrive on both topics
+                if topic != user_topic or joined_or_left:
+                    ws.send(json.dumps(event))
+                    metrics.inc('chatter_websocket_messages_total', {'direction': 'pushed'})
+
+    except chatter_broker.SubscriptionClosed:
+        if subscription.closed_reason == 'overflow':
+            ws.close(chatter_websocket.CLOSE_TRY_AGAIN_LATER, "Too far behind, reconnect and reload")
+
+    except (chatter_websocket.ConnectionClosed, OSError):
+        pass
+
+    finally:
+        db.close()
+
+
+def receive_socket_message(ws, active_user:cc.User, data):
+    # Handles one message from a WebSocket client: {"type": "send", "chatroomid": 1, "content": "...", "ref": ...}
+
+    try:
+        request_data = json.loads(data)
+        ref = request_data.get('ref')
+        if request_data['type'] != 'send':
+            raise ValueError(f"Unknown message type {request_data['type']}")
+        chatroomid, content = int(request_data['chatroomid']), str(request_data['content'])
+
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        ws.send(json.dumps({'type': 'error', 'ref': None, 'error': f"Invalid message: {e}"}))
+        return
+
+    try:
+        m = active_user.send_message(content, chatroomid, fast_ack=True)
+        ws.send(json.dumps({'type': 'sent', 'ref': ref, 'chatroomid': chatroomid, 'messageid': m.messageid,
+                            'pending': isinstance(m, cc.PendingMessage)}))
+        metrics.inc('chatter_websocket_messages_total', {'direction': 'received'})
+
+    except cc.UserPermissionError:
+        ws.send(json.dumps({'type': 'error', 'ref': ref, 'error': "You cannot send messages to this chatroom"}))
+
+    except chatter_ratelimit.RateLimitError as e:
+        metrics.inc('chatter_rate_limited_total', {'scope': e.scope})
+        ws.send(json.dumps({'type': 'error', 'ref': ref, 'error': "Too many messages, slow down",
+                            'retry_after': round(e.retry_after, 3)}))
+
+    except sqlite3.Error:
+        # Already logged by Message.add()
+        ws.send(json.dumps({'type': 'error', 'ref': ref, 'error': "The message could not be saved, try again"}))
+
+
+# Werkzeug only routes upgrade requests to rules marked as WebSockets, and only those
+@app.route('/ws', websocket=True)
+def chat_socket():
+    """
+    One WebSocket per session, carrying every chatroom the user belongs to. Clients send
+    {"type": "send", "chatroomid": 1, "content": "...", "ref": ...} and get back {"type": "sent", "ref": ...,
+    "messageid": ...} or {"type": "error", "ref": ..., "error": ...}. New and changed messages and membership changes
+    in the user's chatrooms are pushed as they are committed, by any worker.
+    """
+
+    active_user = get_active_user()
+    if not active_user:
+        abort(401)
+
+    # Subscribe before the handshake so nothing committed after the client connects is missed
+    subscription = cc.broker.subscribe(get_socket_topics(active_user), app.config['WEBSOCKET_QUEUE'],
+                                       chatter_broker.DISCONNECT)
+
+    try:
+        ws = chatter_websocket.WebSocket.accept(request.environ)
+
+    except chatter_websocket.WebSocketUnsupported:
+        subscription.close()
+        abort(501)
+
+    except chatter_websocket.WebSocketError:
+        subscription.close()
+        abort(400)
+
+    pusher = threading.Thread(target=push_events, args=(ws, subscription, active_user.userid), daemon=True,
+                              name=f"WebSocketPusher-{active_user.userid}")
+    pusher.start()
+    metrics.inc('chatter_websocket_connections_open')
+
+    try:
+        while True:
+            receive_socket_message(ws, active_user, ws.receive())
+
+    except chatter_websocket.ConnectionClosed:
+        pass
+
+    finally:
+        subscription.close()
+        pusher.join()
+        ws.shutdown()
+        metrics.inc('chatter_websocket_connections_open', amount=-1)
+
+    return WebSocketResponse(status=101)
+
+
+@app.route('/json/chatroom/<int:chatroomid>')
+def json_chatroom(chatroomid):
+    active_user = get_active_user()
+    if active_user:
+        try:
+            chatroom = cc.Chatroom(chatroomid, get_db())
+            if chatroom.user_is_member(active_user) or chatroom.user_is_owner(active_user):
+
+                return app.response_class(chatroom.json_with_messages, mimetype='application/json')
+
+            else:
+                abort(403)
+
+        except cc.ChatroomNotFoundError:
+            abort(404)
+    else:
+        abort(401)
+
+
+@app.route('/json/chatroom/<int:chatroomid>/messages')
+def json_chatroom_messages(chatroomid):
+    active_user = get_active_user()
+    if active_user:
+        before = request.args.get('before', type=int)
+        try:
+            chatroom = cc.Chatroom(chatroomid, get_db())
+            if chatroom.user_is_member(active_user) or chatroom.user_is_owner(active_user):
+
+                encoding = choose_encoding()
+
+                # The newest page changes as messages arrive, but older pages (those with a cursor) only change when
+                # a message is updated or deleted, which clears them from page_cache. A cursor above the newest message
+                # gives a page that new messages will still be added to, so those pages aren't cached.
+                if before is not None and encoding and before <= (chatroom.get_newest_messageid() or 0):
+                    data = page_cache.get(chatroomid, before, encoding)
+
+                    if data is None:
+                        page = chatroom.json_history_page(before, app.config['HISTORY_PAGE_SIZE'], primary=True)
+                        data = compress(page.encode('utf-8'), encoding)
+                        page_cache.put(chatroomid, before, encoding, data)
+
+                    response = app.response_class(data, mimetype='application/json')
+                    response.headers['Content-Encoding'] = encoding
+                    return response
+
+                return app.response_class(chatroom.json_history_page(before, app.config['HISTORY_PAGE_SIZE']),
+                                          mimetype='application/json')
+
+            else:
+                abort(403)
+
+        except cc.ChatroomNotFoundError:
+            abort(404)
+    else:
+        abort(401)
+
+
+@app.route('/json/chatroom/<int:chatroomid>/stats')
+def json_chatroom_stats(chatroomid):
+    active_user = get_active_user()
+    if active_user:
+        try:
+            chatroom = cc.Chatroom(chatroomid, get_db())
+            if active_user.is_admin or chatroom.user_is_owner(active_user):
+
+                days = request.args.get('days', 0, type=int)
+                top = request.args.get('top', 10, type=int)
+                utc_offset = request.args.get('utc_offset', 0, type=float)
+                period_days = request.args.get('period_days', 1, type=int)
+
+                if days < 0 or top < 0 or period_days < 1 or not (math.isfinite(utc_offset) and abs(utc_offset) <= 24):
+                    return app.response_class(json.dumps({'error': "days and top must be at least 0, period_days at "
+                                                                   "least 1 and utc_offset within 24 hours."}),
+                                              status=400, mimetype='application/json')
+
+                # Further back than any message could have been sent is the same as all of them
+                since = None
+                if days and days < (datetime.datetime.now() - datetime.datetime(1970, 1, 2)).days:
+                    since = datetime.datetime.now() - datetime.timedelta(days=days)
+
+                stats = chatroom.get_activity_stats(since, top, utc_offset, period_days)
+
+                return app.response_class(json.dumps(stats, indent=4), mimetype='application/json')
+
+            else:
+                abort(403)
+
+        except cc.ChatroomNotFoundError:
+            abort(404)
+
+        except chatter_analytics.AnalyticsError as e:
+            return app.response_class(json.dumps({'error': str(e)}), status=501, mimetype='application/json')
+    else:
+        abort(401)
+
+
+@app.route('/debug/sql')
+def debug_sql():
+    active_user = get_active_user()
+    if active_user and active_user.is_admin:
+        # Newest first, without this request (which is still running)
+        return app.response_class(json.dumps(list(reversed(sql_trace_history)), indent=4),
+                                  mimetype='application/json')
+    else:
+        abort(403)
+
+
+@app.route('/debug/slow-queries')
+def debug_slow_queries():
+    active_user = get_active_user()
+    if active_user and active_user.is_admin:
+        log = chatter_slowlog.active_log
+        return app.response_class(json.dumps({'threshold_ms': log.threshold * 1000 if log else None,
+                                              'entries': log.entries if log else []}, indent=4),
+                                  mimetype='application/json')
+    else:
+        abort(403)
+
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    active_user = get_active_user()
+    if not (active_user and active_user.is_admin):
+        abort(403)
+
+    if request.method == 'POST':
+        try:
+            profiler.configure(request.form.get('enabled') in ('1', 'true', 'on'),
+                               float(request.form.get('sample_rate', 0.01)),
+                               request.form.get('route') or None,
+                               int(request.form['userid']) if request.form.get('userid') else None)
+        except (ValueError, chatter_profiler.ProfileError) as e:
+            return app.response_class(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+
+    summary = chatter_profiler.summarise(profiler.directory, request.args.get('route'),
+                                         request.args.get('limit', 25, type=int))
+
+    return app.response_class(json.dumps({'settings': profiler.settings, **summary}, indent=4),
+                              mimetype='application/json')
+
+
+@app.route('/debug/maintenance', methods=['GET', 'POST'])
+def debug_maintenance():
+    active_user = get_active_user()
+    if not (active_user and active_user.is_admin):
+        abort(403)
+
+    if request.method == 'POST':
+        # Runs in the background; GET this page again to see the results
+        tasks = request.form.get('tasks')
+        try:
+            maintenance_scheduler.trigger(tasks.split(',') if tasks else None)
+        except chatter_maintenance.MaintenanceError as e:
+            return app.response_class(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+
+    return app.response_class(json.dumps({'settings': maintenance_scheduler.settings,
+                                          'running': maintenance_scheduler.running,
+                                          'last_run': maintenance_scheduler.last_run,
+                                          'results': maintenance_scheduler.last_results}, indent=4),
+                              mimetype='application/json')
+
+
+@app.route('/metrics')
+def show_metrics():
+    metrics.flush()
+    return app.response_class(metrics.render(), mimetype='text/plain', content_type='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,177 @@
+import sqlite3, time, statistics, json, os, shutil, tempfile, subprocess, platform, argparse, datetime
+import chatter_classes, synthetic_data
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results')
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def time_operation(operation, min_repeats=5, min_time=1.0, max_repeats=1000):
+    """
+    Runs operation repeatedly, at least min_repeats times and for at least min_time seconds (unless max_repeats is
+    reached first), and summarises how long each run took.
+    :return: Dictionary of timing statistics in seconds
+    """
+
+    timings = []
+    started = time.perf_counter()
+
+    while len(timings) < max_repeats and (len(timings) < min_repeats or time.perf_counter() - started < min_time):
+        t = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - t)
+
+    timings.sort()
+
+    return {
+        'repeats': len(timings),
+        'min_s': timings[0],
+        'median_s': statistics.median(timings),
+        'mean_s': statistics.fmean(timings),
+        'p95_s': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'max_s': timings[-1]
+    }
+
+
+def pick_subjects(db:sqlite3.Connection):
+    # The busiest chatroom shows worst-case behaviour and a median one shows the typical case
+    rooms = db.execute("SELECT chatroomid, count(*) AS message_count FROM Message GROUP BY chatroomid "
+                       "ORDER BY message_count DESC").fetchall()
+    busiest_room = rooms[0]['chatroomid']
+    median_room = rooms[len(rooms) // 2]['chatroomid']
+
+    user = db.execute("SELECT userid, count(*) AS room_count FROM ChatroomMember GROUP BY userid "
+                      "ORDER BY room_count DESC LIMIT 1").fetchone()['userid']
+    messageid = db.execute("SELECT messageid FROM Message WHERE chatroomid=? ORDER BY messageid DESC LIMIT 1",
+                           [median_room]).fetchone()['messageid']
+
+    return busiest_room, median_room, user, messageid
+
+
+def get_operations(db:sqlite3.Connection):
+    # Each public chatter_classes operation to time, as (name, function) pairs
+
+    busiest_room, median_room, userid, messageid = pick_subjects(db)
+    busiest = chatter_classes.Chatroom(busiest_room, db)
+    median = chatter_classes.Chatroom(median_room, db)
+    user = chatter_classes.User(userid, db)
+    username = user.username
+    password = synthetic_data.get_password(userid)
+
+    return [
+        ('User.authenticate', lambda: chatter_classes.User.authenticate(username, password, db)),
+        ('User.__init__', lambda: chatter_classes.User(userid, db)),
+        ('User.json', lambda: user.json),
+        ('Chatroom.get_chatrooms_for_user', lambda: chatter_classes.Chatroom.get_chatrooms_for_user(userid, db)),
+        ('Chatroom.__init__', lambda: chatter_classes.Chatroom(median_room, db)),
+        ('Chatroom.get_all_members', lambda: median.get_all_members()),
+        ('Chatroom.user_is_member', lambda: median.user_is_member(user)),
+        ('Chatroom.get_message_count[median]', lambda: median.get_message_count()),
+        ('Chatroom.get_message_count[busiest]', lambda: busiest.get_message_count()),
+        ('Chatroom.get_messages[median]', lambda: median.get_messages()),
+        ('Chatroom.get_messages[busiest]', lambda: busiest.get_messages()),
+        ('Chatroom.get_messages[busiest, last day]',
+         lambda: busiest.get_messages(datetime.datetime.now() - datetime.timedelta(days=1))),
+        ('Chatroom.get_message_page[busiest]', lambda: busiest.get_message_page()),
+        ('Chatroom.get_message_counts_by_chatroom[30 days]',
+         lambda: chatter_classes.Chatroom.get_message_counts_by_chatroom(db, datetime.datetime.now() -
+                                                                         datetime.timedelta(days=30))),
+        ('Chatroom.json[median]', lambda: median.json),
+        ('Chatroom.json_with_messages[median]', lambda: median.json_with_messages),
+        ('Chatroom.json_with_messages[busiest]', lambda: busiest.json_with_messages),
+        ('Message.__init__', lambda: chatter_classes.Message(messageid, db)),
+        ('Message.json', lambda: chatter_classes.Message(messageid, db).json),
+        ('Message.iter_records[busiest]', lambda: list(chatter_classes.Message.iter_records(db, busiest_room))),
+        ('Message.add', lambda: chatter_classes.Message.add("Added by benchmark.py", median_room, userid, db)),
+    ]
+
+
+def run(scales, operations=None, min_time=1.0, seed=12345):
+    """
+    Times each operation against a synthetic dataset of each scale. The datasets are generated once and reused, and
+    each run works on a fresh copy so operations that write (e.g. Message.add) don't change later results.
+    :param scales: Names of synthetic_data.SCALES to run against
+    :param operations: Names of operations to run, or None for all of them
+    :return: Dictionary of results, ready to be written out as JSON
+    """
+
+    results = []
+
+    for scale in scales:
+        dataset = synthetic_data.get_dataset(DATA_DIR, scale, seed)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'benchmark.db')
+            shutil.copyfile(dataset, db_path)
+
+            db = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+            db.row_factory = sqlite3.Row
+
+            for name, operation in get_operations(db):
+                if operations and name not in operations:
+                    continue
+
+                timing = time_operation(operation, min_time=min_time)
+                results.append(dict(scale=scale, operation=name, **timing))
+                print(f"{scale:>8} {name:<45} median {timing['median_s'] * 1000:10.3f} ms "
+                      f"({timing['repeats']} runs)")
+
+            db.close()
+
+    return {
+        'commit': get_commit(),
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'seed': seed,
+        'scales': {scale: synthetic_data.SCALES[scale] for scale in scales},
+        'results': results
+    }
+
+
+def compare(old_path, new_path):
+    # Prints how each operation's median time changed between two result files
+
+    with open(old_path) as f:
+        old = {(r['scale'], r['operation']): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+
+    for r in new:
+        before = old.get((r['scale'], r['operation']))
+        if before:
+            ratio = r['median_s'] / before['median_s']
+            print(f"{r['scale']:>8} {r['operation']:<45} {before['median_s'] * 1000:10.3f} ms -> "
+                  f"{r['median_s'] * 1000:10.3f} ms  ({ratio:.2f}x)")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Time chatter_classes operations against synthetic datasets.")
+    parser.add_argument('--scales', nargs='+', choices=synthetic_data.SCALES.keys(), default=['small', 'medium'])
+    parser.add_argument('--operations', nargs='+', help="Only run these operations (default all)")
+    parser.add_argument('--min-time', type=float, default=1.0, help="Seconds to spend on each operation (default 1)")
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--output', help="Results file (default bench_results/<commit>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two results files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+
+    else:
+        report = run(args.scales, args.operations, args.min_time, args.seed)
+
+        output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+        print(f"Success: Results written to {output}")
@@ -0,0 +1,118 @@
+import datetime
+
+# NumPy is only needed for analytics, so the rest of Chatter works without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SECONDS_PER_DAY = 86400
+
+# Upper bounds (in seconds) of the response time histogram buckets: 10s, 30s, 1m, 5m, 15m, 1h, 3h, 12h, 1d, longer
+RESPONSE_TIME_BUCKETS = (10, 30, 60, 300, 900, 3600, 10800, 43200, 86400)
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+_COLUMNS = [('timestamp', 'f8'), ('senderid', 'i8'), ('chatroomid', 'i8')]
+
+
+class AnalyticsError(Exception):
+    pass
+
+
+def load_columns(records):
+    """
+    Packs the timestamp, senderid and chatroomid of each message into a NumPy structured array, sorted by time.
+    :param records: Iterable of chatter_classes.MessageRecord, e.g. from Message.iter_records()
+    """
+
+    if np is None:
+        raise AnalyticsError("ERROR: Chatroom analytics need NumPy, which is not installed (pip install numpy).")
+
+    columns = np.fromiter(((r.timestamp, r.senderid, r.chatroomid) for r in records), dtype=_COLUMNS)
+    columns.sort(order='timestamp', kind='stable')
+
+    return columns
+
+
+def get_activity_stats(columns, top_senders=10, utc_offset_hours=0, period_days=1):
+    """
+    Works out activity statistics for the messages in columns (from load_columns()).
+    :param top_senders: How many of the busiest senders to list
+    :param utc_offset_hours: Offset of the timezone to use for hours, weekdays and periods
+    :param period_days: Length in days of each period for active_members (e.g. 7 for weekly)
+    :return: Dictionary of plain Python values, ready to be encoded as JSON
+    """
+
+    local_ts = columns['timestamp'] + utc_offset_hours * 3600
+    days = np.floor_divide(local_ts, SECONDS_PER_DAY).astype(np.int64)
+
+    # Periods longer than the days since 1970 all group the messages the same way, so are cut down to one that does too
+    # without its dates overflowing
+    if len(days):
+        period_days = min(period_days, max(1, int(np.abs(days).max()) + 1))
+
+    hours = (np.floor_divide(local_ts, 3600).astype(np.int64)) % 24
+    # 1 January 1970 was a Thursday, which is weekday 3 counting from Monday
+    weekdays = (days + 3) % 7
+
+    return {
+        'message_count': int(len(columns)),
+        'first_ts': float(columns['timestamp'][0]) if len(columns) else None,
+        'last_ts': float(columns['timestamp'][-1]) if len(columns) else None,
+        'messages_per_hour': np.bincount(hours, minlength=24).tolist(),
+        'messages_per_weekday': dict(zip(WEEKDAYS, np.bincount(weekdays, minlength=7).tolist())),
+        'top_senders': get_top_senders(columns['senderid'], top_senders),
+        'response_times': get_response_times(columns['timestamp'], columns['senderid']),
+        'active_members': get_active_members(days // period_days * period_days, columns['senderid'])
+    }
+
+
+def get_top_senders(senderids, limit):
+
+    senders, counts = np.unique(senderids, return_counts=True)
+    busiest = np.argsort(-counts, kind='stable')[:limit]
+
+    return [{'senderid': int(senders[i]), 'message_count': int(counts[i])} for i in busiest]
+
+
+def get_response_times(timestamps, senderids):
+    """
+    Treats every message sent by someone other than the sender of the message before it as a response, and summarises
+    how long those responses took.
+    """
+
+    gaps = np.diff(timestamps)[senderids[1:] != senderids[:-1]]
+
+    if not len(gaps):
+        return {'count': 0, 'histogram': [], 'percentiles': {}}
+
+    counts = np.bincount(np.searchsorted(RESPONSE_TIME_BUCKETS, gaps, side='left'),
+                         minlength=len(RESPONSE_TIME_BUCKETS) + 1)
+    percentiles = np.percentile(gaps, [50, 90, 99])
+
+    return {
+        'count': int(len(gaps)),
+        'mean_s': float(gaps.mean()),
+        'percentiles': {'p50_s': float(percentiles[0]), 'p90_s': float(percentiles[1]),
+                        'p99_s': float(percentiles[2])},
+        'histogram': [{'up_to_s': bound, 'count': int(count)}
+                      for bound, count in zip(list(RESPONSE_TIME_BUCKETS) + [None], counts)]
+    }
+
+
+def get_active_members(periods, senderids):
+    # Number of distinct senders and messages in each period that had any messages, oldest first
+
+    if not len(periods):
+        return []
+
+    period_list, message_counts = np.unique(periods, return_counts=True)
+
+    # Each distinct (period, sender) pair counts once towards its period
+    pairs = np.unique(np.stack([periods, senderids], axis=1), axis=0)
+    member_counts = np.bincount(np.searchsorted(period_list, pairs[:, 0]), minlength=len(period_list))
+
+    return [{'date': (datetime.date(1970, 1, 1) + datetime.timedelta(days=int(p))).isoformat(),
+             'active_members': int(m), 'message_count': int(c)}
+            for p, m, c in zip(period_list, member_counts, message_counts)]
@@ -0,0 +1,355 @@
+import sqlite3, datetime, functools, gzip, json, os, argparse
+
+# Messages older than this many days are moved out of the live Message table by archive_messages()
+ARCHIVE_AFTER_DAYS = 90
+
+MESSAGE_FIELDS = ('messageid', 'content', 'chatroomid', 'senderid', 'timestamp')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def create_archive_table(dbcnx:sqlite3.Connection):
+    # One row per segment file (i.e. per chatroom per month), so the index stays tiny however much history is archived
+    c = dbcnx.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS MessageArchive (
+                    segmentid INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chatroomid INTEGER NOT NULL,
+                    month TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    first_messageid INTEGER NOT NULL,
+                    last_messageid INTEGER NOT NULL,
+                    first_ts NUMERIC NOT NULL,
+                    last_ts NUMERIC NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    UNIQUE (chatroomid, month)
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messagearchive_messageids "
+              "ON MessageArchive (first_messageid, last_messageid)")
+
+
+def get_archive_dir(db:sqlite3.Connection):
+    # Segments live alongside the database file they were archived from, e.g. test.db.archive/
+    row = db.execute("PRAGMA database_list").fetchone()
+    if not row or not row[2]:
+        raise ArchiveError("ERROR: Messages can only be archived from a database stored in a file.")
+
+    return row[2] + '.archive'
+
+
+def archive_messages(db:sqlite3.Connection, older_than:datetime.datetime=None):
+    """
+    Moves messages older than a cutoff out of the Message table and into compressed per-chatroom, per-month segment
+    files. Each segment is committed separately, so the writer lock is only held for one segment at a time.
+    :param db: Database connection
+    :param older_than: Cutoff time, by default ARCHIVE_AFTER_DAYS days ago
+    :return: The number of messages archived
+    """
+
+    if not older_than:
+        older_than = datetime.datetime.now() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+
+    cutoff_ts = int(round(older_than.timestamp(), 0))
+    archive_dir = get_archive_dir(db)
+    os.makedirs(archive_dir, exist_ok=True)
+
+    try:
+        create_archive_table(db)
+        db.commit()
+
+        c = db.cursor()
+        groups = c.execute("SELECT DISTINCT chatroomid, strftime('%Y-%m', timestamp, 'unixepoch') AS month "
+                           "FROM Message WHERE timestamp<?", [cutoff_ts]).fetchall()
+
+        archived_count = 0
+
+        for group in groups:
+            rows = c.execute("SELECT messageid, content, chatroomid, senderid, timestamp FROM Message "
+                             "WHERE chatroomid=? AND strftime('%Y-%m', timestamp, 'unixepoch')=? AND timestamp<? "
+                             "ORDER BY messageid", [group['chatroomid'], group['month'], cutoff_ts]).fetchall()
+
+            new_messages = [{f: row[f] for f in MESSAGE_FIELDS} for row in rows]
+
+            segment = c.execute("SELECT filename FROM MessageArchive WHERE chatroomid=? AND month=?",
+                                [group['chatroomid'], group['month']]).fetchone()
+
+            if segment:
+                # Merge with what was archived for this month on an earlier run
+                new_messageids = {m['messageid'] for m in new_messages}
+                existing = [m for m in read_segment(archive_dir, segment['filename'])
+                            if m['messageid'] not in new_messageids]
+                messages = sorted(existing + new_messages, key=lambda m: m['messageid'])
+                filename = segment['filename']
+            else:
+                messages = new_messages
+                filename = f"{group['chatroomid']}-{group['month']}.jsonl.gz"
+
+            # The segment file is written before the rows are deleted, so a crash part way through leaves a message
+            # in both places rather than in neither. Readers always prefer the live copy.
+            _write_segment(archive_dir, filename, messages)
+            _save_segment_index(c, group['chatroomid'], group['month'], filename, messages)
+
+            c.executemany("DELETE FROM Message WHERE messageid=?", [[m['messageid']] for m in new_messages])
+            db.commit()
+
+            archived_count += len(new_messages)
+
+        return archived_count
+
+    except sqlite3.Error as e:
+        db.rollback()
+        print(f"ERROR: Exception raised when archiving messages. Database rolled back to last commit. Details:\n{e}")
+        raise e
+
+
+def find_archived_message(db:sqlite3.Connection, messageid):
+
+    for segment in _get_segments(db, "first_messageid<=? AND last_messageid>=?", [messageid, messageid]):
+        for m in read_segment(get_archive_dir(db), segment['filename']):
+            if m['messageid'] == messageid:
+                return m
+
+    return None
+
+
+def get_archived_messages_for_chatroom(db:sqlite3.Connection, chatroomid, since_ts):
+
+    messages = []
+
+    for segment in _get_segments(db, "chatroomid=? AND last_ts>? ORDER BY first_messageid", [chatroomid, since_ts]):
+        messages += [m for m in read_segment(get_archive_dir(db), segment['filename']) if m['timestamp'] > since_ts]
+
+    return messages
+
+
+def iter_archived_messages(db:sqlite3.Connection, since_ts):
+    # Every chatroom's archived messages newer than since_ts, read a segment at a time, for bulk reads
+
+    for segment in _get_segments(db, "last_ts>? ORDER BY chatroomid, first_messageid", [since_ts]):
+        for m in read_segment(get_archive_dir(db), segment['filename']):
+            if m['timestamp'] > since_ts:
+                yield m
+
+
+def get_archived_message_page(db:sqlite3.Connection, chatroomid, before, limit):
+    # Newest first, matching Message.get_message_page_for_chatroom
+
+    messages = []
+
+    for segment in _get_segments(db, "chatroomid=? AND first_messageid<? ORDER BY first_messageid DESC",
+                                  [chatroomid, before]):
+        messages += [m for m in reversed(read_segment(get_archive_dir(db), segment['filename']))
+                     if m['messageid'] < before]
+
+        if len(messages) >= limit:
+            break
+
+    return messages[:limit]
+
+
+def count_archived_messages_for_chatroom(db:sqlite3.Connection, chatroomid, since_ts):
+
+    count = 0
+
+    for segment in _get_segments(db, "chatroomid=? AND last_ts>?", [chatroomid, since_ts]):
+        if segment['first_ts'] > since_ts:
+            count += segment['message_count']
+        else:
+            # The cutoff falls inside this segment, so only part of it counts
+            count += len([m for m in read_segment(get_archive_dir(db), segment['filename'])
+                          if m['timestamp'] > since_ts])
+
+    return count
+
+
+def update_archived_message(db:sqlite3.Connection, messageid, **changes):
+    _rewrite_archived_message(db, messageid, changes)
+
+
+def delete_archived_message(db:sqlite3.Connection, messageid):
+    _rewrite_archived_message(db, messageid, None)
+
+
+def restore_archived_message(db:sqlite3.Connection, messageid):
+    # Moves an archived message back into the Message table, e.g. before a change that would belong in another segment.
+    # As in archive_messages(), a crash part way through leaves the message in both places, where the live copy wins.
+
+    m = find_archived_message(db, messageid)
+    if m is None:
+        raise ArchiveError(f"ERROR: No archived message found with messageid {messageid}.")
+
+    try:
+        db.execute("INSERT INTO Message (messageid, content, chatroomid, senderid, timestamp) VALUES (?, ?, ?, ?, ?)",
+                   [m[f] for f in MESSAGE_FIELDS])
+        db.commit()
+
+    except sqlite3.Error as e:
+        db.rollback()
+        print(f"ERROR: Exception raised when restoring archived messageid {messageid}. Details:\n{e}")
+        raise e
+
+    _rewrite_archived_message(db, messageid, None)
+
+
+def get_month(ts):
+    # The month of the segment a message sent at Unix time ts belongs in, as from strftime('%Y-%m') in archive_messages()
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m')
+
+
+def get_segments_before(db:sqlite3.Connection, chatroomid, before_ts):
+    # The chatroom's segments holding any messages older than before_ts, oldest first
+    return _get_segments(db, "chatroomid=? AND first_ts<? ORDER BY first_messageid", [chatroomid, before_ts])
+
+
+def remove_archived_messages(db:sqlite3.Connection, segment, before_ts):
+    """
+    Removes a segment's messages older than before_ts, e.g. when they pass a chatroom's retention period. Its index row
+    is updated in the caller's transaction, and the messages kept are written to a new file beside the segment; the
+    segment itself is left alone until the caller has committed and calls replace_segment(path, new_path), or
+    discard_segment(new_path) after rolling back.
+    :param segment: A row from get_segments_before()
+    :return: (the messages removed, path of the segment file, path of its replacement or None if no messages remain)
+    """
+
+    archive_dir = get_archive_dir(db)
+    path = os.path.join(archive_dir, segment['filename'])
+    messages = read_segment(archive_dir, segment['filename'])
+
+    removed = [m for m in messages if m['timestamp'] < before_ts]
+    kept = [m for m in messages if m['timestamp'] >= before_ts]
+
+    _save_segment_index(db.cursor(), segment['chatroomid'], segment['month'], segment['filename'], kept)
+
+    if not kept:
+        return removed, path, None
+
+    new_path = f"{path}.{os.getpid()}.new"
+    _write_segment_file(new_path, kept)
+    return removed, path, new_path
+
+
+def replace_segment(path, new_path):
+    # Swaps in a segment rewritten by remove_archived_messages(), or removes it if new_path is None
+
+    if new_path is None:
+        os.remove(path)
+    else:
+        os.replace(new_path, path)
+
+
+def discard_segment(new_path):
+
+    if new_path is not None:
+        try:
+            os.remove(new_path)
+        except FileNotFoundError:
+            pass
+
+
+def get_segment_cache_info():
+    # Hits and misses of the decoded segment cache, for metrics
+    return _read_segment_file.cache_info()
+
+
+def read_segment(archive_dir, filename):
+    path = os.path.join(archive_dir, filename)
+    return _read_segment_file(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=32)
+def _read_segment_file(path, mtime_ns):
+    # mtime_ns is part of the cache key so that a rewritten segment is never served from the cache
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return tuple(json.loads(line) for line in f)
+
+
+def _write_segment(archive_dir, filename, messages):
+
+    path = os.path.join(archive_dir, filename)
+    tmp_path = path + '.tmp'
+
+    _write_segment_file(tmp_path, messages)
+    os.replace(tmp_path, path)
+
+
+def _write_segment_file(path, messages):
+
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for m in messages:
+            f.write(json.dumps(m) + '\n')
+
+
+def _save_segment_index(c:sqlite3.Cursor, chatroomid, month, filename, messages):
+
+    if not messages:
+        c.execute("DELETE FROM MessageArchive WHERE chatroomid=? AND month=?", [chatroomid, month])
+        return
+
+    c.execute('''INSERT INTO MessageArchive (chatroomid, month, filename, first_messageid, last_messageid,
+                    first_ts, last_ts, message_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT (chatroomid, month) DO UPDATE SET
+                    first_messageid=excluded.first_messageid, last_messageid=excluded.last_messageid,
+                    first_ts=excluded.first_ts, last_ts=excluded.last_ts, message_count=excluded.message_count''',
+              [chatroomid, month, filename, messages[0]['messageid'], messages[-1]['messageid'],
+               min(m['timestamp'] for m in messages), max(m['timestamp'] for m in messages), len(messages)])
+
+
+def _get_segments(db:sqlite3.Connection, where, params):
+
+    c = db.cursor()
+
+    # Databases that have never been archived have no index table, and so no archived messages
+    if not c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='MessageArchive'").fetchone():
+        return []
+
+    return c.execute("SELECT chatroomid, month, filename, first_ts, last_ts, message_count FROM MessageArchive "
+                     "WHERE " + where, params).fetchall()
+
+
+def _rewrite_archived_message(db:sqlite3.Connection, messageid, changes):
+
+    archive_dir = get_archive_dir(db)
+
+    try:
+        c = db.cursor()
+
+        for segment in _get_segments(db, "first_messageid<=? AND last_messageid>=?", [messageid, messageid]):
+            messages = [dict(m) for m in read_segment(archive_dir, segment['filename'])]
+
+            if messageid not in [m['messageid'] for m in messages]:
+                continue
+
+            if changes is None:
+                messages = [m for m in messages if m['messageid'] != messageid]
+            else:
+                for m in messages:
+                    if m['messageid'] == messageid:
+                        m.update(changes)
+
+            _write_segment(archive_dir, segment['filename'], messages)
+            _save_segment_index(c, segment['chatroomid'], segment['month'], segment['filename'], messages)
+            db.commit()
+            return
+
+        raise ArchiveError(f"ERROR: No archived message found with messageid {messageid}.")
+
+    except sqlite3.Error as e:
+        db.rollback()
+        print(f"ERROR: Exception raised when rewriting archived messageid {messageid}. Details:\n{e}")
+        raise e
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Move old messages into compressed archive segments.")
+    parser.add_argument('database', help="Path to the database file, e.g. chatter_db.db")
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help=f"Archive messages older than this many days (default {ARCHIVE_AFTER_DAYS})")
+    args = parser.parse_args()
+
+    dbcnx = sqlite3.connect(args.database, detect_types=sqlite3.PARSE_DECLTYPES)
+    dbcnx.row_factory = sqlite3.Row
+
+    count = archive_messages(dbcnx, datetime.datetime.now() - datetime.timedelta(days=args.days))
+    print(f"Success: Archived {count} messages.")
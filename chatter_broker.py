@@ -0,0 +1,224 @@
+import collections, threading
+
+# What to do when a subscriber's queue is full: throw away its oldest event, or close the subscription so the
+# transport can tell the client to resynchronise
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+
+MAX_QUEUE = 100
+
+
+class BrokerError(Exception):
+    pass
+
+
+class SubscriptionClosed(BrokerError):
+    pass
+
+
+class Subscription:
+    """
+    A subscriber's bounded queue of events from one or more topics. Created by Broker.subscribe(), and read with get()
+    from the subscriber's own thread.
+    """
+
+    def __init__(self, broker, topics, max_queue, policy):
+
+        if policy not in (DROP_OLDEST, DISCONNECT):
+            raise BrokerError(f"ERROR: Unknown backpressure policy {policy}.")
+
+        self.__broker = broker
+        self.__topics = set(topics)
+        self.__max_queue = max_queue
+        self.__policy = policy
+        self.__queue = collections.deque()
+        self.__condition = threading.Condition()
+        self.__closed_reason = None
+        self.__dropped = 0
+
+    @property
+    def topics(self):
+        return set(self.__topics)
+
+    @property
+    def closed(self):
+        return self.__closed_reason is not None
+
+    @property
+    def closed_reason(self):
+        return self.__closed_reason
+
+    @property
+    def dropped(self):
+        # Events thrown away because the queue was full (DROP_OLDEST only)
+        return self.__dropped
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def add_topics(self, topics):
+        self.__broker._set_topics(self, self.__topics | set(topics))
+
+    def remove_topics(self, topics):
+        self.__broker._set_topics(self, self.__topics - set(topics))
+
+    def _replace_topics(self, topics):
+        self.__topics = set(topics)
+
+    def get(self, timeout=None):
+        """
+        Waits for the next event.
+        :param timeout: Seconds to wait, or None to wait until there is one
+        :return: (topic, event), or None if the timeout passed first
+        :raises SubscriptionClosed: Once the subscription is closed and every queued event has been read
+        """
+
+        with self.__condition:
+            if not self.__queue and not self.closed:
+                self.__condition.wait(timeout)
+
+            if self.__queue:
+                return self.__queue.popleft()
+
+            if self.closed:
+                raise SubscriptionClosed(f"ERROR: Subscription closed ({self.__closed_reason}).")
+
+            return None
+
+    def close(self, reason='unsubscribed'):
+        self.__broker.unsubscribe(self)
+        self._mark_closed(reason)
+
+    def _mark_closed(self, reason):
+        with self.__condition:
+            if self.__closed_reason is None:
+                self.__closed_reason = reason
+            self.__condition.notify_all()
+
+    def _deliver(self, topic, event):
+        # Returns 'delivered', 'dropped' (the oldest event made way for this one) or 'disconnected'
+
+        with self.__condition:
+            if self.closed:
+                return None
+
+            result = 'delivered'
+
+            if len(self.__queue) >= self.__max_queue:
+                if self.__policy == DISCONNECT:
+                    self.__closed_reason = 'overflow'
+                    self.__condition.notify_all()
+                    return 'disconnected'
+
+                self.__queue.popleft()
+                self.__dropped += 1
+                result = 'dropped'
+
+            self.__queue.append((topic, event))
+            self.__condition.notify()
+
+            return result
+
+
+class Broker:
+    """
+    In-process publish/subscribe with a topic per chatroom. chatter_classes publishes every committed change to
+    chatter_classes.broker, so it is the single fan-out path for push transports: each open connection subscribes to
+    its user's chatrooms and reads events from its Subscription.
+
+    Publishing never blocks on slow subscribers. Each subscription has a bounded queue, and when it is full either its
+    oldest event is dropped or the subscription is closed, according to its policy.
+    """
+
+    def __init__(self, max_queue=MAX_QUEUE, policy=DROP_OLDEST, metrics_hook=None):
+        """
+        :param max_queue: Default queue length for new subscriptions
+        :param policy: Default backpressure policy, DROP_OLDEST or DISCONNECT
+        :param metrics_hook: Called as metrics_hook(name, topic, count) with name 'published', 'delivered', 'dropped',
+            'disconnected' or 'subscribers' (the change in the number of subscriptions)
+        """
+
+        self.__max_queue = max_queue
+        self.__policy = policy
+        self.__lock = threading.Lock()
+        # topic -> set of Subscriptions, and every open Subscription whatever its topics
+        self.__subscribers = {}
+        self.__subscriptions = set()
+        self.metrics_hook = metrics_hook
+
+    def subscribe(self, topics=(), max_queue=None, policy=None) -> Subscription:
+
+        subscription = Subscription(self, topics, max_queue or self.__max_queue, policy or self.__policy)
+
+        with self.__lock:
+            self.__subscriptions.add(subscription)
+            for topic in subscription.topics:
+                self.__subscribers.setdefault(topic, set()).add(subscription)
+
+        self.__report('subscribers', None, 1)
+
+        return subscription
+
+    def unsubscribe(self, subscription:Subscription):
+
+        with self.__lock:
+            if subscription not in self.__subscriptions:
+                return
+
+            self.__subscriptions.discard(subscription)
+            self.__remove_from_topics(subscription, subscription.topics)
+
+        self.__report('subscribers', None, -1)
+
+    def _set_topics(self, subscription:Subscription, topics):
+
+        with self.__lock:
+            if subscription in self.__subscriptions:
+                self.__remove_from_topics(subscription, subscription.topics - topics)
+                for topic in topics - subscription.topics:
+                    self.__subscribers.setdefault(topic, set()).add(subscription)
+
+            subscription._replace_topics(topics)
+
+    def __remove_from_topics(self, subscription, topics):
+        # Called with the lock held
+        for topic in topics:
+            subscribers = self.__subscribers.get(topic, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.__subscribers.pop(topic, None)
+
+    def subscriber_count(self, topic=None):
+
+        with self.__lock:
+            if topic is not None:
+                return len(self.__subscribers.get(topic, ()))
+            return len(self.__subscriptions)
+
+    def publish(self, topic, event):
+        """
+        Queues event for every subscription to topic.
+        :return: The number of subscriptions it was queued for
+        """
+
+        with self.__lock:
+            subscribers = list(self.__subscribers.get(topic, ()))
+
+        results = collections.Counter()
+
+        for subscription in subscribers:
+            result = subscription._deliver(topic, event)
+            if result == 'disconnected':
+                self.unsubscribe(subscription)
+            results[result] += 1
+
+        self.__report('published', topic, 1)
+        for name in ('delivered', 'dropped', 'disconnected'):
+            if results[name]:
+                self.__report(name, topic, results[name])
+
+        return results['delivered'] + results['dropped']
+
+    def __report(self, name, topic, count):
+        if self.metrics_hook:
+            self.metrics_hook(name, topic, count)
@@ -0,0 +1,215 @@
+import collections, os, shutil, threading
+
+
+class CompressedPageCache:
+    """
+    LRU cache for pre-compressed chatroom history pages, keyed by (chatroomid, cursor, encoding).
+
+    Entries are kept in memory up to max_entries. If a directory is given every entry is also written to disk, so pages
+    evicted from memory (or lost when the server restarts) can be served again without re-encoding them. The directory
+    is kept to about max_disk_bytes by removing the least recently used files, checked each time another eighth of it
+    has been written.
+    """
+
+    def __init__(self, max_entries=256, directory=None, max_disk_bytes=None):
+
+        self.__max_entries = max_entries
+        self.__directory = directory
+        self.__max_disk_bytes = max_disk_bytes
+        self.__written = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__disk_hits = 0
+        self.__misses = 0
+
+        if self.__directory:
+            os.makedirs(self.__directory, exist_ok=True)
+            self.__trim_disk()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def stats(self):
+        # Lookups served from memory, served from disk, and not found
+        return {'hits': self.__hits, 'disk_hits': self.__disk_hits, 'misses': self.__misses}
+
+    def __get_path(self, chatroomid, cursor, encoding):
+        return os.path.join(self.__directory, str(int(chatroomid)), f"{int(cursor)}.{encoding}")
+
+    def get(self, chatroomid, cursor, encoding):
+
+        key = (chatroomid, cursor, encoding)
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return self.__entries[key]
+
+        if not self.__directory:
+            self.__misses += 1
+            return None
+
+        path = self.__get_path(chatroomid, cursor, encoding)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The modification time orders files for __trim_disk()
+            os.utime(path)
+
+        except FileNotFoundError:
+            self.__misses += 1
+            return None
+
+        self.__disk_hits += 1
+        self.__remember(key, data)
+        return data
+
+    def put(self, chatroomid, cursor, encoding, data:bytes):
+
+        self.__remember((chatroomid, cursor, encoding), data)
+
+        if self.__directory:
+            path = self.__get_path(chatroomid, cursor, encoding)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write to a temporary file first so a concurrent reader never sees a partially written page
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            with self.__lock:
+                self.__written += len(data)
+                trim = self.__max_disk_bytes is not None and self.__written >= self.__max_disk_bytes // 8
+                if trim:
+                    self.__written = 0
+
+            if trim:
+                self.__trim_disk()
+
+    def invalidate_chatroom(self, chatroomid, messageid=None):
+        # A changed message could appear in any cached page for its chatroom, so drop all of them. The messageid
+        # argument is accepted so this can be registered directly as a chatter_classes message change listener.
+
+        with self.__lock:
+            for key in [k for k in self.__entries if k[0] == chatroomid]:
+                del self.__entries[key]
+
+        if self.__directory:
+            shutil.rmtree(os.path.join(self.__directory, str(int(chatroomid))), ignore_errors=True)
+
+    def __trim_disk(self):
+        # Other worker processes share the directory, so it is measured rather than counted
+
+        if self.__max_disk_bytes is None:
+            return
+
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.__directory):
+            for filename in filenames:
+                # Pages still being written
+                if filename.endswith('.tmp'):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(f[1] for f in files)
+
+        for mtime, size, path in sorted(files):
+            if total <= self.__max_disk_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def __remember(self, key, data):
+
+        with self.__lock:
+            self.__entries[key] = data
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+
+class FragmentCache:
+    """
+    LRU cache for rendered HTML fragments, each covering the messages of one block of a chatroom's timeline, so a
+    block's fragment can be reused by every page that shows the block in full (pages cut a block at their edges; those
+    partial blocks are cached under their own range).
+
+    Blocks are split by the chatroom's own messages rather than fixed ranges of messageids, which every chatroom shares:
+    with many busy chatrooms a range of ids would hold only a message or two from any one of them. A block starts at each
+    message for which starts_block() is true, about one in block_size of them. That depends only on the messageid, so
+    every page agrees on where blocks start, and adding or deleting a message only changes the block it is in.
+
+    Entries are keyed by (chatroomid, first and last messageid shown, version), where version is a fingerprint of what
+    the fragment shows, such as the hash of its timeline entries. A message changed through another worker process
+    then gets a new key rather than a stale fragment. invalidate_message() drops the fragments covering a changed
+    message straight away, rather than leaving them to be evicted.
+    """
+
+    def __init__(self, max_entries=1024, block_size=32):
+
+        self.__max_entries = max_entries
+        self.__block_size = block_size
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def stats(self):
+        return {'hits': self.__hits, 'misses': self.__misses}
+
+    def starts_block(self, messageid):
+        # Hashed so that chatrooms whose ids follow a pattern (e.g. every other id) still get blocks of about block_size
+        return (messageid * 11400714819323198485) % (1 << 64) >> 32 < (1 << 32) // self.__block_size
+
+    def get(self, chatroomid, first_messageid, last_messageid, version):
+
+        key = (chatroomid, first_messageid, last_messageid, version)
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return self.__entries[key]
+
+            self.__misses += 1
+            return None
+
+    def put(self, chatroomid, first_messageid, last_messageid, version, html):
+
+        key = (chatroomid, first_messageid, last_messageid, version)
+
+        with self.__lock:
+            self.__entries[key] = html
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+    def invalidate_message(self, chatroomid, messageid=None):
+        # Drops the fragments covering messageid, or all of the chatroom's if messageid is None (e.g. after a retention
+        # purge). Can be registered directly as a chatter_classes message change listener.
+
+        with self.__lock:
+            for key in [k for k in self.__entries
+                        if k[0] == chatroomid and (messageid is None or k[1] <= messageid <= k[2])]:
+                del self.__entries[key]
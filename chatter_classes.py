@@ -1,4 +1,4 @@
-import sqlite3, abc, datetime, random, os, json
+import sqlite3, abc, datetime, random, os, json, typing, chatter_archive, chatter_analytics, chatter_rollups, chatter_broker
 
 DB_PATH = 'test.db'
 
@@ -8,7 +8,229 @@ def get_db():
     return db
 
 
+# Every committed change is published here, with the chatroomid as the topic, as events like
+# {'type': 'message_added', 'chatroomid': 1, 'messageid': 2}. Push transports subscribe to the chatrooms their user
+# belongs to, plus get_user_topic(userid) to hear about the user joining or leaving chatrooms. With a notify_channel,
+# changes committed by other worker processes are published here too.
+broker = chatter_broker.Broker()
+
+
+# A chatter_notify.NotifyChannel, set by the app when several worker processes share the database, so events published
+# here also reach subscribers connected to the other workers
+notify_channel = None
+
+
+def get_user_topic(userid):
+    return ('user', userid)
+
+
+def publish(topic, event):
+    broker.publish(topic, event)
+
+    if notify_channel:
+        notify_channel.send(topic, event)
+
+
+# Functions called as listener(chatroomid, messageid) after a message has been updated or deleted, so that anything
+# holding a cached copy of it (e.g. compressed history pages) can drop that copy
+message_change_listeners = []
+
+
+def notify_message_changed(chatroomid, messageid):
+    for listener in message_change_listeners:
+        listener(chatroomid, messageid)
+
+    publish(chatroomid, {'type': 'message_changed', 'chatroomid': chatroomid, 'messageid': messageid})
+
+
+# Functions called as listener(chatroomid, messageid) after a new message has been committed
+message_add_listeners = []
+
+
+def notify_message_added(chatroomid, messageid):
+    for listener in message_add_listeners:
+        listener(chatroomid, messageid)
+
+    publish(chatroomid, {'type': 'message_added', 'chatroomid': chatroomid, 'messageid': messageid})
+
+
+def notify_messages_purged(chatroomid, before_ts):
+    # After messages sent before before_ts have been deleted in bulk (see chatter_retention.py), which is announced once
+    # per batch rather than once per message. Listeners are called with no messageid.
+    for listener in message_change_listeners:
+        listener(chatroomid, None)
+
+    publish(chatroomid, {'type': 'messages_purged', 'chatroomid': chatroomid, 'before': before_ts})
+
+
+def notify_user_renamed(userid, chatroomids):
+    # Usernames are shown alongside messages, so pages and fragments cached for the chatrooms the user has sent
+    # messages to are dropped. Listeners are called with no messageid, as after a purge.
+    for chatroomid in chatroomids:
+        for listener in message_change_listeners:
+            listener(chatroomid, None)
+
+        publish(chatroomid, {'type': 'user_renamed', 'chatroomid': chatroomid, 'userid': userid})
+
+
+def receive_event(topic, event):
+    # Called with events from other worker processes (see chatter_notify.NotifyChannel), so this process's change
+    # listeners hear about messages changed or purged there. The events themselves are published by the channel.
+
+    if event.get('type') == 'message_changed':
+        for listener in message_change_listeners:
+            listener(event['chatroomid'], event['messageid'])
+
+    elif event.get('type') in ('messages_purged', 'user_renamed'):
+        for listener in message_change_listeners:
+            listener(event['chatroomid'], None)
+
+
+# Functions called as listener(chatroomid, userids) after users have joined or left a chatroom, so that anything
+# relying on who can see the chatroom (e.g. open subscriptions to it) can check again
+membership_change_listeners = []
+
+
+def notify_membership_changed(chatroomid, userids):
+    for listener in membership_change_listeners:
+        listener(chatroomid, userids)
+
+    event = {'type': 'membership_changed', 'chatroomid': chatroomid, 'userids': list(userids)}
+    publish(chatroomid, event)
+    for userid in userids:
+        publish(get_user_topic(userid), event)
+
+
+# The db passed to the classes below is usually a single sqlite3.Connection holding every table. It can also be a
+# chatter_shards.ShardRouter, which behaves like a connection to the catalog (User, Chatroom and ChatroomMember) but
+# keeps each chatroom's Message and Attachment rows in a separate shard database. These helpers find the connection
+# that chatroom-scoped queries should go to; for a single connection that is always db itself.
+
+def is_sharded(db):
+    return hasattr(db, 'shard_for_chatroom')
+
+
+def get_shard(db, chatroomid) -> sqlite3.Connection:
+    return db.shard_for_chatroom(chatroomid) if is_sharded(db) else db
+
+
+def get_all_shards(db) -> list:
+    return db.shards if is_sharded(db) else [db]
+
+
+def get_shards_for_id(db, rowid) -> list:
+    # Shards to search for a message or attachment id, most likely first
+    return db.shards_for_id(rowid) if is_sharded(db) else [db]
+
+
+def allocate_id(db, shard:sqlite3.Connection, table):
+    # Sharded databases hand out ids themselves so they are unique across shards; otherwise AUTOINCREMENT does it
+    return db.allocate_id(shard, table) if is_sharded(db) else None
+
+
+# Optional chatter_replicas.ReplicaManager. When set, reads that do not need to see the caller's own uncommitted changes
+# (e.g. Chatroom.get_messages() and Chatroom.get_chatrooms_for_user()) are served from a replica whose snapshot is no
+# more than READ_REPLICA_MAX_STALENESS seconds old, keeping them off the primary database.
+read_replicas = None
+READ_REPLICA_MAX_STALENESS = 5.0
+
+
+# Optional chatter_ratelimit.RateLimiter. When set, User.send_message() and Chatroom.add_message() take a token from the
+# sender's bucket and the chatroom's before adding a message, and raise chatter_ratelimit.RateLimitError if either is
+# empty.
+rate_limiter = None
+
+
+def check_rate_limit(db, userid, chatroomid, role=None):
+    """
+    :param role: The sender's role in the chatroom ('member', 'owner' or 'admin') if the caller already knows it,
+        otherwise it is looked up
+    """
+
+    if rate_limiter is None:
+        return
+
+    if role is None:
+        row = db.execute("SELECT admin, (SELECT owner FROM ChatroomMember WHERE chatroomid=? AND userid=?) AS owner "
+                         "FROM User WHERE userid=?", [chatroomid, userid, userid]).fetchone()
+        role = 'admin' if row and row['admin'] else 'owner' if row and row['owner'] else 'member'
+
+    rate_limiter.check_send(userid, chatroomid, role)
+
+
+# Optional chatter_sendlog.SendLog. When set, messages added with fast_ack=True are written to the log and acknowledged
+# as soon as the log is on disk, then added to the Message table in the background. Until then they are returned as
+# PendingMessages with a provisional id, and included in the newest page of their chatroom's history.
+send_log = None
+
+
+def get_read_db(db, chatroomid=None, primary=False):
+    """
+    Chooses the connection for a read that may be served from a replica. Falls back to db itself (or, for a sharded
+    database, the chatroom's shard) if no replicas are configured, none is fresh enough, or db is part way through a
+    transaction. Replicas are copies of a single database file, so they are not used for sharded databases.
+    :param primary: Always read db itself, for reads that a change will be based on (e.g. the messages to delete along
+        with a chatroom), which must not miss anything the replica hasn't caught up on
+    """
+
+    if is_sharded(db):
+        return db if chatroomid is None else get_shard(db, chatroomid)
+
+    if primary or read_replicas is None or db.in_transaction:
+        return db
+
+    replica = read_replicas.get_connection(READ_REPLICA_MAX_STALENESS)
+
+    return replica if replica is not None else db
+
+
 class ChatterDB(abc.ABC):
+    """
+    Objects created with lazy=True hold only their id and database until one of their row's other fields is first
+    used, when _load_row() reads the row. That saves a query per object for callers that only need ids, e.g. to list a
+    chatroom's members, but means a missing row only raises its *NotFoundError on that first use. Callers that need to
+    know straight away call check_exists().
+    """
+
+    # Set to False on lazy objects until their row has been read
+    _loaded = True
+
+    def __getattr__(self, name):
+        # Only called for attributes that haven't been set, which for a lazy object includes its row's fields
+
+        # Special methods looked up by copy, pickle and the like aren't row fields, so don't read the row for them
+        if self._loaded or (name.startswith('__') and name.endswith('__')):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        self._loaded = True
+        try:
+            self._load_row()
+        except Exception:
+            self._loaded = False
+            raise
+
+        return getattr(self, name)
+
+    @abc.abstractmethod
+    def _load_row(self):
+        pass
+
+    def check_exists(self):
+        """
+        Reads a lazy object's row now, rather than on first use
+        :return: The object itself
+        :raises: The class's *NotFoundError if the row doesn't exist
+        """
+
+        if not self._loaded:
+            self._loaded = True
+            try:
+                self._load_row()
+            except Exception:
+                self._loaded = False
+                raise
+
+        return self
 
     @abc.abstractmethod
     def update(self):
@@ -40,13 +262,41 @@ class UserAuthenticationError(Exception):
     pass
 
 
+class UserRecord(typing.NamedTuple):
+    """
+    Read-only copy of a user's row, for bulk reads (see User.iter_records()). A tuple, so much smaller than a User,
+    and holds no database connection; use to_user() to get a User that can be changed.
+    """
+
+    userid: int
+    username: str
+    last_login_ts: float
+    admin: bool
+    active: bool
+
+    def to_user(self, db:sqlite3.Connection):
+        return User(self.userid, db)
+
+
+def _make_user_record(cursor, row):
+    # Row factory building UserRecords straight from cursor rows
+    return UserRecord(row[0], row[1], row[2], row[3] == 1, row[4] == 1)
+
+
 class User(ChatterDB):
 
-    def __init__(self, userid, db:sqlite3.Connection):
+    def __init__(self, userid, db:sqlite3.Connection, lazy=False):
 
         self.__db = db
         self.__userid = userid
 
+        if lazy:
+            self._loaded = False
+        else:
+            self._load_row()
+
+    def _load_row(self):
+
         c = self.__db.cursor()
 
         user_data = c.execute("SELECT username, last_login_ts, admin, active FROM User WHERE userid=?",
@@ -59,7 +309,7 @@ class User(ChatterDB):
             self.__active = True if user_data['active'] == 1 else False
 
         else:
-            raise UserNotFoundError(f"ERROR: No user found with userid {userid}.")
+            raise UserNotFoundError(f"ERROR: No user found with userid {self.__userid}.")
 
     @property
     def userid(self):
@@ -117,6 +367,9 @@ class User(ChatterDB):
                                       f"to delete userid {self.__userid}.")
 
     def update(self, username=None, password=None, last_login_ts=None, admin=None, active=None):
+
+        renamed = False
+
         try:
             c = self.__db.cursor()
 
@@ -129,6 +382,7 @@ class User(ChatterDB):
                     raise UserActionError(f"User already exists with username '{username}'.")
 
                 c.execute("UPDATE User SET username=? WHERE userid=? ", [ username, self.__userid])
+                renamed = self.__username != username
                 self.__username = username
 
             if password is not None:
@@ -154,6 +408,9 @@ class User(ChatterDB):
             print(f"ERROR: Exception raised when updating user {self.__userid}. Details\n{e}")
             raise e
 
+        if renamed:
+            notify_user_renamed(self.__userid, Message.get_chatroomids_for_sender(self.__userid, self.__db))
+
     @staticmethod
     def add(username, password, db:sqlite3.Connection):
 
@@ -178,12 +435,62 @@ class User(ChatterDB):
             print(f"ERROR: Exception raised when adding user {username}.\n"
                   f"Database rolled back to last commit. Details:\n{e}")
 
-    def send_message(self, content, chatroomid):
-        return Message.add(content, chatroomid, self.__userid, self.__db)
+    def send_message(self, content, chatroomid, fast_ack=False):
+        """
+        Adds a message from this user to a chatroom they own or are a member of.
+        :raises UserPermissionError: If the user is inactive or doesn't belong to the chatroom
+        :param fast_ack: Return a PendingMessage as soon as the message is in the send log, if there is one
+        :raises chatter_ratelimit.RateLimitError: If the user or the chatroom has sent too many messages recently
+        """
+
+        if not self.__active:
+            raise UserPermissionError(f"ERROR: Inactive user {self.__username} cannot send messages.")
+
+        c = self.__db.cursor()
+        member_row = c.execute("SELECT owner FROM ChatroomMember WHERE chatroomid=? AND userid=?",
+                               [chatroomid, self.__userid]).fetchone()
+
+        if not member_row:
+            raise UserPermissionError(f"ERROR: User {self.__username} is not a member of chatroomid {chatroomid}.")
+
+        check_rate_limit(self.__db, self.__userid, chatroomid,
+                         'admin' if self.__admin else 'owner' if member_row['owner'] else 'member')
+
+        return Message.add(content, chatroomid, self.__userid, self.__db, fast_ack)
 
     def get_chatrooms(self):
         return Chatroom.get_chatrooms_for_user(self.__userid, self.__db)
 
+    def get_chatroomids(self):
+        # The chatrooms the user owns or is a member of, read from the primary database so that a membership change
+        # shows up straight away
+        c = self.__db.cursor()
+        return {r['chatroomid'] for r in c.execute("SELECT chatroomid FROM ChatroomMember WHERE userid=?",
+                                                   [self.__userid]).fetchall()}
+
+    def join_chatroom(self, joincode):
+        return Chatroom.join_by_code(self, joincode, self.__db)
+
+    @staticmethod
+    def iter_records(db:sqlite3.Connection, batch_size=1000):
+        """
+        Streams every user as a UserRecord, fetching batch_size rows at a time, for exports and reports that don't
+        need full User objects.
+        """
+
+        try:
+            c = get_read_db(db).cursor()
+            c.row_factory = _make_user_record
+
+            c.execute("SELECT userid, username, last_login_ts, admin, active FROM User ORDER BY userid")
+
+            while rows := c.fetchmany(batch_size):
+                yield from rows
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to retrieve user records. Details\n{e}")
+            raise e
+
     @staticmethod
     def authenticate(username, password, db:sqlite3.Connection):
 
@@ -231,17 +538,46 @@ class ChatroomActionError(Exception):
     pass
 
 
+def _get_userids(users):
+    # Accepts User objects or plain userids
+    return [u.userid if isinstance(u, User) else int(u) for u in users]
+
+
+class ChatroomRecord(typing.NamedTuple):
+    """
+    Read-only copy of a chatroom's row, for bulk reads (see Chatroom.iter_records()). Use to_chatroom() to get a
+    Chatroom that can be changed.
+    """
+
+    chatroomid: int
+    name: str
+    description: str
+    joincode: str
+
+    def to_chatroom(self, db:sqlite3.Connection):
+        return Chatroom(self.chatroomid, db, self._asdict())
+
+
 class Chatroom(ChatterDB):
 
-    def __init__(self, chatroomid, db: sqlite3.Connection):
+    def __init__(self, chatroomid, db: sqlite3.Connection, chatroom_data=None, lazy=False):
+        # chatroom_data can be passed in by callers that already hold the chatroom's row to save looking it up again
 
         self.__db = db
         self.__chatroomid = chatroomid
 
-        c = self.__db.cursor()
+        if lazy and chatroom_data is None:
+            self._loaded = False
+        else:
+            self._load_row(chatroom_data)
 
-        chatroom_data = c.execute("SELECT name, description, joincode FROM Chatroom WHERE chatroomid=?",
-                              [self.__chatroomid]).fetchone()
+    def _load_row(self, chatroom_data=None):
+
+        if chatroom_data is None:
+            c = self.__db.cursor()
+
+            chatroom_data = c.execute("SELECT name, description, joincode FROM Chatroom WHERE chatroomid=?",
+                                  [self.__chatroomid]).fetchone()
 
         if chatroom_data:
             self.__name = chatroom_data['name']
@@ -249,7 +585,7 @@ class Chatroom(ChatterDB):
             self.__joincode = chatroom_data['joincode']
 
         else:
-            raise ChatroomNotFoundError(f"ERROR: No chatroom found with chatroomid {chatroomid}.")
+            raise ChatroomNotFoundError(f"ERROR: No chatroom found with chatroomid {self.__chatroomid}.")
 
     @property
     def chatroomid(self):
@@ -272,6 +608,32 @@ class Chatroom(ChatterDB):
     def joincode(self):
         return self.__joincode
 
+    @property
+    def retention_days(self):
+        # Messages older than this many days are deleted by chatter_retention.py; None means they are kept forever
+        row = self.__db.execute("SELECT retention_days FROM ChatroomRetention WHERE chatroomid=?",
+                                [self.__chatroomid]).fetchone()
+        return row[0] if row else None
+
+    def set_retention_days(self, days):
+
+        if days is not None and days < 1:
+            raise ChatroomActionError(f"ERROR: Retention for chatroomid {self.__chatroomid} must be at least one day.")
+
+        try:
+            if days is None:
+                self.__db.execute("DELETE FROM ChatroomRetention WHERE chatroomid=?", [self.__chatroomid])
+            else:
+                self.__db.execute("INSERT INTO ChatroomRetention (chatroomid, retention_days) VALUES (?, ?) "
+                                  "ON CONFLICT (chatroomid) DO UPDATE SET retention_days=excluded.retention_days",
+                                  [self.__chatroomid, int(days)])
+            self.__db.commit()
+
+        except sqlite3.Error as e:
+            self.__db.rollback()
+            print(f"ERROR: Exception raised when setting retention for chatroomid {self.__chatroomid}. Details:\n{e}")
+            raise e
+
     @property
     def json(self):
         return self.__encode_json()
@@ -303,12 +665,13 @@ class Chatroom(ChatterDB):
     def delete(self):
         try:
 
-            # Delete all messages associated with the chatroom
-            messages_to_delete = Message.get_msesages_for_chatroom(self.__chatroomid, None, self.__db)
+            # Delete all messages associated with the chatroom, including any a replica hasn't caught up on yet
+            messages_to_delete = Message.get_msesages_for_chatroom(self.__chatroomid, None, self.__db, primary=True)
 
             c = self.__db.cursor()
 
             c.execute("DELETE FROM Chatroom WHERE chatroomid=?", [self.__chatroomid])
+            c.execute("DELETE FROM ChatroomRetention WHERE chatroomid=?", [self.__chatroomid])
 
             # Hold off on deletings messages until the chatroom has been successfully deleted.
             for m in messages_to_delete:
@@ -403,8 +766,9 @@ class Chatroom(ChatterDB):
         member_rows = c.execute("SELECT userid FROM ChatroomMember WHERE chatroomid=? AND owner=0",
                                 [self.__chatroomid]).fetchall()
 
-        # Return a list of User objects for all Users that are members of this chatroom
-        return [User(m['userid'], self.__db) for m in member_rows]
+        # Return a list of User objects for all Users that are members of this chatroom. Callers often only need their
+        # ids, so each user's row is read when first needed.
+        return [User(m['userid'], self.__db, lazy=True) for m in member_rows]
 
     def get_all_owners(self):
 
@@ -412,8 +776,8 @@ class Chatroom(ChatterDB):
         member_rows = c.execute("SELECT userid FROM ChatroomMember WHERE chatroomid=? AND owner=1",
                                 [self.__chatroomid]).fetchall()
 
-        # Return a list of User objects for all Users that are members of this chatroom
-        return [User(m['userid'], self.__db) for m in member_rows]
+        # Return a list of User objects for all Users that are owners of this chatroom, read when first needed
+        return [User(m['userid'], self.__db, lazy=True) for m in member_rows]
 
     def user_is_owner(self, u:User):
 
@@ -423,6 +787,89 @@ class Chatroom(ChatterDB):
 
         return True if user_row else False
 
+    def add_members(self, users, owner=False):
+        """
+        Adds users to the chatroom in a single statement, so enrolling a whole group is one round trip. Users who are
+        already members are left as they are, except that owner=True makes them owners. Unknown and inactive users are
+        skipped.
+        :param users: User objects or userids
+        :return: The number of users added or made owners
+        """
+
+        userids = _get_userids(users)
+
+        try:
+            c = self.__db.cursor()
+
+            c.execute("INSERT INTO ChatroomMember (chatroomid, userid, owner) "
+                      "SELECT ?, userid, ? FROM User WHERE active=1 AND userid IN (SELECT value FROM json_each(?)) "
+                      "ON CONFLICT (chatroomid, userid) DO UPDATE SET owner=1 WHERE excluded.owner=1 AND owner=0",
+                      [self.__chatroomid, 1 if owner else 0, json.dumps(userids)])
+            changed = c.rowcount
+
+            self.__db.commit()
+
+        except sqlite3.Error as e:
+            self.__db.rollback()
+            print(f"ERROR: Exception raised when adding members to chatroomid {self.__chatroomid}. Details:\n{e}")
+            raise e
+
+        if changed:
+            notify_membership_changed(self.__chatroomid, userids)
+
+        return changed
+
+    def remove_members(self, users):
+        """
+        Removes users (members or owners) from the chatroom in a single statement.
+        :param users: User objects or userids
+        :return: The number of users removed
+        """
+
+        userids = _get_userids(users)
+
+        try:
+            c = self.__db.cursor()
+
+            c.execute("DELETE FROM ChatroomMember WHERE chatroomid=? AND userid IN (SELECT value FROM json_each(?))",
+                      [self.__chatroomid, json.dumps(userids)])
+            removed = c.rowcount
+
+            self.__db.commit()
+
+        except sqlite3.Error as e:
+            self.__db.rollback()
+            print(f"ERROR: Exception raised when removing members from chatroomid {self.__chatroomid}. Details:\n{e}")
+            raise e
+
+        if removed:
+            notify_membership_changed(self.__chatroomid, userids)
+
+        return removed
+
+    @staticmethod
+    def join_by_code(user:User, joincode, db:sqlite3.Connection):
+        """
+        Adds a user to the chatroom with the given join code, found through the unique index on Chatroom.joincode.
+        Joining a chatroom the user already belongs to changes nothing.
+        :return: The Chatroom joined
+        """
+
+        if not user.is_active:
+            raise UserPermissionError(f"ERROR: Inactive user {user.username} cannot join chatrooms.")
+
+        c = db.cursor()
+        chatroom_data = c.execute("SELECT chatroomid, name, description, joincode FROM Chatroom WHERE joincode=?",
+                                  [joincode]).fetchone()
+
+        if not chatroom_data:
+            raise ChatroomNotFoundError(f"ERROR: No chatroom found with join code {joincode}.")
+
+        chatroom = Chatroom(chatroom_data['chatroomid'], db, chatroom_data)
+        chatroom.add_members([user])
+
+        return chatroom
+
     def user_is_member(self, u: User):
 
         c = self.__db.cursor()
@@ -437,9 +884,134 @@ class Chatroom(ChatterDB):
     def get_message_count(self, since=None):
         return Message.get_message_count_for_chatroom(self.__chatroomid, since, self.__db)
 
+    def get_activity_stats(self, since=None, top_senders=10, utc_offset_hours=0, period_days=1):
+        """
+        Messages per hour and weekday, top senders, response times and active members per period, worked out with
+        NumPy from the chatroom's messages. See chatter_analytics.get_activity_stats().
+        :return: Dictionary of statistics, ready to be encoded as JSON
+        """
+
+        columns = chatter_analytics.load_columns(Message.iter_records(self.__db, self.__chatroomid, since))
+
+        return dict(chatroomid=self.__chatroomid, **chatter_analytics.get_activity_stats(
+            columns, top_senders, utc_offset_hours, period_days))
+
+    def get_message_page(self, before=None, limit=50):
+        return Message.get_message_page_for_chatroom(self.__chatroomid, before, limit, self.__db)
+
+    def get_newest_messageid(self):
+        return Message.get_newest_messageid_for_chatroom(self.__chatroomid, self.__db)
+
+    def json_history_page(self, before=None, limit=50, primary=False):
+        """
+        Encodes one page of the chatroom's history as JSON. A page holds up to `limit` messages with a messageid lower
+        than `before` (or the newest messages if `before` is None), newest first. Pages with a `before` cursor never
+        gain new messages, so they can safely be cached until a message in the chatroom is updated or deleted.
+        :param before: messageid cursor returned as 'next_cursor' by the previous page, or None for the newest page
+        :param limit: Maximum number of messages in the page
+        :param primary: Read the primary rather than a replica, for pages that will be cached. A replica that hasn't
+            caught up with the change that emptied the cache would otherwise put the old page back.
+        :return: JSON string containing the page's messages and the cursor for the next (older) page
+        """
+
+        entries = self.get_timeline(before, limit, primary)
+        stored = [e for e in entries if not e.pending]
+
+        return json.dumps({
+            'chatroomid': self.__chatroomid,
+            'before': before,
+            'messages': [e.json for e in entries],
+            'next_cursor': stored[-1].messageid if len(stored) == limit else None
+        }, sort_keys=False, indent=4)
+
+    def get_timeline(self, cursor=None, limit=50, primary=False):
+        """
+        The chatroom's messages as they are shown, newest first, each with its sender's username and attachments. See
+        Message.get_timeline_for_chatroom().
+        :param cursor: messageid of the oldest entry of the previous page, or None for the newest page
+        :param limit: Maximum number of entries (not counting pending ones), or None for the whole history
+        :param primary: Read the primary even if a replica is available (see get_read_db())
+        :return: List of TimelineEntry. The newest page starts with messages still waiting in the send log.
+        """
+
+        entries = Message.get_timeline_for_chatroom(self.__chatroomid, cursor, limit, self.__db, primary)
+
+        # Messages still waiting in the send log are newer than any in the table, so they top the newest page
+        pending = list(reversed(self.get_pending_messages())) if cursor is None else []
+
+        if pending:
+            usernames = _get_usernames(self.__db, [m.senderid for m in pending])
+            entries = [TimelineEntry(m.messageid, m.content, m.chatroomid, m.senderid, usernames.get(m.senderid),
+                                     m.timestamp, (), True) for m in pending] + entries
+
+        return entries
+
+    def get_pending_messages(self):
+        # Messages sent to the chatroom through this process's send log that haven't been added yet, oldest first
+        return send_log.get_pending(self.__chatroomid) if send_log is not None else []
+
     def add_message(self, content, senderid):
+        check_rate_limit(self.__db, senderid, self.__chatroomid)
         return Message.add(content, self.__chatroomid, senderid, self.__db)
 
+    def get_hourly_message_counts(self, since:datetime.datetime=None):
+        """
+        Reads the chatroom's message counts per hour from the rollup table rather than counting messages.
+        :param since: Start from the hour containing this time, or None for all history
+        :return: List of (start of hour as a datetime, message count), oldest first, leaving out hours with no messages
+        """
+
+        since_ts = since.timestamp() if since else 0
+        rows = chatter_rollups.get_hourly_counts(get_read_db(self.__db, self.__chatroomid), self.__chatroomid, since_ts)
+
+        return [(datetime.datetime.fromtimestamp(hour), count) for hour, count in rows]
+
+    def get_sender_message_counts(self, since:datetime.datetime=None):
+        # {senderid: message count} from the rollup table, from the hour containing since onwards
+        since_ts = since.timestamp() if since else 0
+        return chatter_rollups.get_sender_counts(get_read_db(self.__db, self.__chatroomid), self.__chatroomid, since_ts)
+
+    @staticmethod
+    def get_message_counts_by_chatroom(db:sqlite3.Connection, since:datetime.datetime=None):
+        """
+        Counts every chatroom's messages from the hourly rollup table, e.g. for "messages in the last 30 days per room",
+        which reads a few rows per chatroom per hour instead of every message. Counts start from the beginning of the
+        hour containing since.
+        :return: Dictionary of {chatroomid: message count} for chatrooms with any messages
+        """
+
+        since_ts = since.timestamp() if since else 0
+        counts = {}
+
+        try:
+            for shard in get_all_shards(db):
+                read_db = shard if is_sharded(db) else get_read_db(db)
+                for chatroomid, count in chatter_rollups.get_chatroom_counts(read_db, since_ts).items():
+                    counts[chatroomid] = counts.get(chatroomid, 0) + count
+
+            return counts
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to retrieve message counts by chatroom. Details\n{e}")
+            raise e
+
+    @staticmethod
+    def iter_records(db:sqlite3.Connection, batch_size=1000):
+        # Streams every chatroom as a ChatroomRecord, fetching batch_size rows at a time
+
+        try:
+            c = get_read_db(db).cursor()
+            c.row_factory = lambda cursor, row: ChatroomRecord._make(row)
+
+            c.execute("SELECT chatroomid, name, description, joincode FROM Chatroom ORDER BY chatroomid")
+
+            while rows := c.fetchmany(batch_size):
+                yield from rows
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to retrieve chatroom records. Details\n{e}")
+            raise e
+
     @staticmethod
     def get_chatrooms_for_user(userid, db: sqlite3.Connection) -> dict:
         """
@@ -452,15 +1024,17 @@ class Chatroom(ChatterDB):
 
         rooms = {'owner': [], 'member': []}
 
-        c = db.cursor()
+        c = get_read_db(db).cursor()
 
-        rows = c.execute("SELECT chatroomid, owner FROM ChatroomMember WHERE userid=?", [userid]).fetchall()
+        rows = c.execute("SELECT ChatroomMember.chatroomid, owner, name, description, joincode FROM ChatroomMember "
+                         "JOIN Chatroom ON Chatroom.chatroomid = ChatroomMember.chatroomid WHERE userid=?",
+                         [userid]).fetchall()
 
         for r in rows:
             if bool(r['owner']):
-                rooms['owner'].append(Chatroom(r['chatroomid'], db))
+                rooms['owner'].append(Chatroom(r['chatroomid'], db, r))
             else:
-                rooms['member'].append(Chatroom(r['chatroomid'], db))
+                rooms['member'].append(Chatroom(r['chatroomid'], db, r))
 
         return rooms
 
@@ -482,7 +1056,7 @@ class Chatroom(ChatterDB):
 
     def __encode_json_with_messages(self):
 
-        messages = [m.json for m in self.get_messages()]
+        messages = [e.json for e in reversed(self.get_timeline(limit=None))]
 
         owner_ids = [o.userid for o in self.get_all_owners()]
         member_ids = [m.userid for m in self.get_all_members()]
@@ -501,17 +1075,140 @@ class MessageNotFoundError(Exception):
     pass
 
 
+class MessageRecord(typing.NamedTuple):
+    """
+    Read-only copy of a message's row, for bulk reads such as exports and analytics (see Message.iter_records()). A
+    tuple, so it has no per-instance __dict__ and holds no database connection. timestamp is the stored Unix time
+    rather than a datetime. archived is True for messages read from an archive segment. Use to_message() to get a
+    Message that can be changed.
+    """
+
+    messageid: int
+    content: str
+    chatroomid: int
+    senderid: int
+    timestamp: float
+    archived: bool = False
+
+    def to_message(self, db:sqlite3.Connection):
+        return Message(self.messageid, db, self._asdict(), archived=self.archived)
+
+
+class PendingMessage(typing.NamedTuple):
+    """
+    A message that has been written to the send log but not yet added to the Message table. messageid is a
+    provisional id (a string, so it can't be mistaken for a real one); a 'message_applied' event gives the real id
+    once the message has been added.
+    """
+
+    messageid: str
+    content: str
+    chatroomid: int
+    senderid: int
+    timestamp: float
+
+    @property
+    def json(self):
+        return json.dumps(dict(self._asdict(), attachments=[], pending=True), sort_keys=False, indent=4)
+
+
+class TimelineEntry(typing.NamedTuple):
+    """
+    A message as a chatroom's timeline shows it, with its sender's username and its attachments, read in bulk without
+    creating Message, User or Attachment objects (see Chatroom.get_timeline()). For messages still waiting in the send
+    log, pending is True and messageid is the provisional id.
+    """
+
+    messageid: typing.Union[int, str]
+    content: str
+    chatroomid: int
+    senderid: int
+    sender_username: str
+    timestamp: float
+    attachments: tuple  # ((attachmentid, filepath), ...)
+    pending: bool = False
+
+    @property
+    def sent_at(self):
+        # timestamp as a datetime, as Message.timestamp gives it
+        return datetime.datetime.fromtimestamp(self.timestamp)
+
+    @property
+    def json(self):
+        # The same fields as Message.json (and PendingMessage.json), plus the sender's username
+
+        data = {
+            'messageid': self.messageid,
+            'content': self.content,
+            'chatroomid': self.chatroomid,
+            'senderid': self.senderid,
+            'sender_username': self.sender_username,
+            'timestamp': self.timestamp,
+            'attachments': [json.dumps({'attachmentid': attachmentid, 'filepath': filepath,
+                                        'messageid': self.messageid}, sort_keys=False, indent=4)
+                            for attachmentid, filepath in self.attachments]
+        }
+
+        if self.pending:
+            data['pending'] = True
+
+        return json.dumps(data, sort_keys=False, indent=4)
+
+
+def _get_usernames(db, userids):
+    # {userid: username}, for timeline entries whose usernames couldn't be joined in (see Message.get_timeline_for_chatroom)
+
+    userids = list(set(userids))
+    usernames = {}
+
+    for i in range(0, len(userids), 500):
+        batch = userids[i:i + 500]
+        usernames.update(db.execute(f"SELECT userid, username FROM User WHERE userid IN ({','.join('?' * len(batch))})",
+                                    batch).fetchall())
+
+    return usernames
+
+
 class Message(ChatterDB):
 
-    def __init__(self, messageid, db: sqlite3.Connection):
+    def __init__(self, messageid, db: sqlite3.Connection, message_data=None, lazy=False, archived=False):
+        # message_data can be passed in by callers that already hold the message's row to save looking it up again,
+        # with archived=True if the row came from an archive segment rather than the Message table
 
         self.__db = db
         self.__messageid = messageid
 
-        c = self.__db.cursor()
+        if lazy and message_data is None:
+            self._loaded = False
+        else:
+            self._load_row(message_data, archived)
+
+    def _load_row(self, message_data=None, archived=False):
+
+        messageid = self.__messageid
+        self.__archived = archived and message_data is not None
+        self.__shard = None
 
-        message_data = c.execute("SELECT content, chatroomid, senderid, timestamp FROM Message WHERE messageid=?",
-                              [self.__messageid]).fetchone()
+        if message_data is None:
+            for shard in get_shards_for_id(self.__db, messageid):
+                c = shard.cursor()
+
+                message_data = c.execute("SELECT content, chatroomid, senderid, timestamp FROM Message WHERE messageid=?",
+                                      [self.__messageid]).fetchone()
+
+                if message_data:
+                    self.__shard = shard
+                    break
+
+        if message_data is None:
+            # Older messages may have been moved out of the Message table into the archive
+            for shard in get_shards_for_id(self.__db, messageid):
+                message_data = chatter_archive.find_archived_message(shard, messageid)
+
+                if message_data:
+                    self.__shard = shard
+                    self.__archived = True
+                    break
 
         if message_data:
             self.__content = message_data['content']
@@ -519,6 +1216,9 @@ class Message(ChatterDB):
             self.__senderid = int(message_data['senderid'])
             self.__timestamp = message_data['timestamp']
 
+            if self.__shard is None:
+                self.__shard = get_shard(self.__db, self.__chatroomid)
+
         else:
             raise MessageNotFoundError(f"ERROR: No message found with mesageid {messageid}.")
 
@@ -536,7 +1236,7 @@ class Message(ChatterDB):
 
     @property
     def chatroom(self):
-        return Chatroom(self.__chatroomid, self.__db)
+        return Chatroom(self.__chatroomid, self.__db, lazy=True)
 
     @property
     def senderid(self):
@@ -544,7 +1244,7 @@ class Message(ChatterDB):
 
     @property
     def sender(self):
-        return User(self.__senderid, self.__db)
+        return User(self.__senderid, self.__db, lazy=True)
 
     @property
     def timestamp(self):
@@ -552,7 +1252,11 @@ class Message(ChatterDB):
 
     @property
     def attachments(self):
-        return Attachment.get_all_attachments_for_message(self.__messageid, self.__db)
+        return Attachment.get_all_attachments_for_message(self.__messageid, self.__db, self.__chatroomid)
+
+    @property
+    def is_archived(self):
+        return self.__archived
 
     @property
     def json(self):
@@ -562,26 +1266,39 @@ class Message(ChatterDB):
 
         try:
 
-            c = self.__db.cursor()
+            c = self.__shard.cursor()
 
             # Get all attachments for message and delete them also (files as well as entries in database)
-            attachments = Attachment.get_all_attachments_for_message(self.__messageid, self.__db)
+            attachments = Attachment.get_all_attachments_for_message(self.__messageid, self.__db, self.__chatroomid)
             for a in attachments:
                 a.delete()
 
-            c.execute("DELETE FROM Message WHERE messageid=?", [self.__messageid])
+            if self.__archived:
+                chatter_archive.delete_archived_message(self.__shard, self.__messageid)
+            else:
+                c.execute("DELETE FROM Message WHERE messageid=?", [self.__messageid])
 
-            self.__db.commit()
+            chatter_rollups.record_message(c, self.__chatroomid, self.__senderid, self.__get_ts(), -1)
+
+            self.__shard.commit()
+
+            notify_message_changed(self.__chatroomid, self.__messageid)
 
         except sqlite3.Error as e:
-            self.__db.rollback()
+            self.__shard.rollback()
             print(f"ERROR: Database exception raised when deleting messageid {self.__messageid}. Details:\n{e}")
             raise e
 
     def update(self, content=None, chatroomid=None, senderid=None, timestamp:datetime.datetime=None):
 
+        if self.__archived:
+            self.__update_archived(content, chatroomid, senderid, timestamp)
+            return
+
         try:
-            c = self.__db.cursor()
+            c = self.__shard.cursor()
+            original_chatroomid = self.__chatroomid
+            original_rollup = (self.__chatroomid, self.__senderid, self.__get_ts())
 
             if content is not None:
                 c.execute("UPDATE Message SET content=? WHERE messageid=?", [content, self.__messageid])
@@ -599,74 +1316,412 @@ class Message(ChatterDB):
                 c.execute("UPDATE Message SET timestamp=? WHERE messageid=?", [timestamp.timestamp(), self.__messageid])
                 self.__timestamp = timestamp
 
-            self.__db.commit()
+            self.__update_rollups(c, original_rollup)
+
+            self.__shard.commit()
+
+            # Moving a message to another chatroom can also mean moving it to another shard
+            if get_shard(self.__db, self.__chatroomid) is not self.__shard:
+                self.__move_to_shard(get_shard(self.__db, self.__chatroomid))
+
+            notify_message_changed(original_chatroomid, self.__messageid)
+            if self.__chatroomid != original_chatroomid:
+                notify_message_changed(self.__chatroomid, self.__messageid)
 
         except sqlite3.Error as e:
-            self.__db.rollback()
+            self.__shard.rollback()
             print(f"ERROR: Exception raised when updating messageid {self.__messageid}.\n"
                   f"Database rolled back to last commit. Details:\n{e}")
 
+    def __update_archived(self, content, chatroomid, senderid, timestamp):
+        # Archived messages are changed by rewriting their segment rather than with UPDATE statements. Segments hold
+        # one chatroom's messages for one month, so a message moving to another chatroom or month is first restored to
+        # the Message table and updated there; the next archive run puts it in the right segment.
+
+        if (chatroomid is not None and chatroomid != self.__chatroomid) or (timestamp is not None and
+                chatter_archive.get_month(timestamp.timestamp()) != chatter_archive.get_month(self.__get_ts())):
+            try:
+                chatter_archive.restore_archived_message(self.__shard, self.__messageid)
+            except sqlite3.Error as e:
+                print(f"ERROR: Exception raised when updating archived messageid {self.__messageid}. Details:\n{e}")
+                return
+
+            self.__archived = False
+            self.update(content, chatroomid, senderid, timestamp)
+            return
+
+        changes = {}
+        original_chatroomid = self.__chatroomid
+        original_rollup = (self.__chatroomid, self.__senderid, self.__get_ts())
+
+        if content is not None:
+            changes['content'] = self.__content = content
+
+        if chatroomid is not None:
+            changes['chatroomid'] = self.__chatroomid = chatroomid
+
+        if senderid is not None:
+            changes['senderid'] = self.__senderid = senderid
+
+        if timestamp is not None:
+            changes['timestamp'] = self.__timestamp = timestamp.timestamp()
+
+        try:
+            chatter_archive.update_archived_message(self.__shard, self.__messageid, **changes)
+
+            if self.__update_rollups(self.__shard.cursor(), original_rollup):
+                self.__shard.commit()
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Exception raised when updating archived messageid {self.__messageid}. Details:\n{e}")
+            return
+
+        notify_message_changed(original_chatroomid, self.__messageid)
+        if self.__chatroomid != original_chatroomid:
+            notify_message_changed(self.__chatroomid, self.__messageid)
+
+    def __get_ts(self):
+        # update() stores a datetime, whereas rows from the database hold the Unix time
+        if isinstance(self.__timestamp, datetime.datetime):
+            return self.__timestamp.timestamp()
+        return self.__timestamp
+
+    def __update_rollups(self, c:sqlite3.Cursor, original_rollup):
+        # Moves the message's count in the hourly rollups if its chatroom, sender or hour changed
+
+        if chatter_rollups.get_hour(original_rollup[2]) == chatter_rollups.get_hour(self.__get_ts()) and \
+                original_rollup[:2] == (self.__chatroomid, self.__senderid):
+            return False
+
+        chatter_rollups.record_message(c, *original_rollup, -1)
+        chatter_rollups.record_message(c, self.__chatroomid, self.__senderid, self.__get_ts())
+        return True
+
+    def __move_to_shard(self, new_shard:sqlite3.Connection):
+
+        old_shard = self.__shard
+
+        try:
+            attachment_rows = old_shard.execute("SELECT attachmentid, messageid, filepath FROM Attachment "
+                                                "WHERE messageid=?", [self.__messageid]).fetchall()
+
+            new_shard.execute("INSERT INTO Message (messageid, content, chatroomid, senderid, timestamp) "
+                              "VALUES (?, ?, ?, ?, ?)", [self.__messageid, self.__content, self.__chatroomid,
+                                                         self.__senderid, self.__timestamp])
+            new_shard.executemany("INSERT INTO Attachment (attachmentid, messageid, filepath) VALUES (?, ?, ?)",
+                                  [tuple(a) for a in attachment_rows])
+            chatter_rollups.record_message(new_shard.cursor(), self.__chatroomid, self.__senderid, self.__get_ts())
+            new_shard.commit()
+
+            old_shard.execute("DELETE FROM Attachment WHERE messageid=?", [self.__messageid])
+            old_shard.execute("DELETE FROM Message WHERE messageid=?", [self.__messageid])
+            chatter_rollups.record_message(old_shard.cursor(), self.__chatroomid, self.__senderid, self.__get_ts(), -1)
+            old_shard.commit()
+
+            self.__shard = new_shard
+
+        except sqlite3.Error as e:
+            new_shard.rollback()
+            old_shard.rollback()
+            print(f"ERROR: Exception raised when moving messageid {self.__messageid} to another shard. Details:\n{e}")
+            raise e
+
     def add_attachment(self, filepath):
         return Attachment.add(self.__messageid, filepath, self.__db)
 
     @staticmethod
-    def add(content, chatroomid, senderid, db:sqlite3.Connection):
+    def add(content, chatroomid, senderid, db:sqlite3.Connection, fast_ack=False):
+        # With fast_ack, and a send_log set, returns a PendingMessage as soon as the message is safely in the log
+
+        if fast_ack and send_log is not None:
+            return send_log.append(content, chatroomid, senderid)
+
+        shard = get_shard(db, chatroomid)
         try:
-            c = db.cursor()
+            c = shard.cursor()
             ts = int(round(datetime.datetime.now().timestamp(),0))
+            messageid = allocate_id(db, shard, 'Message')
             #          (content, chatroomid, senderid, int(round(datetime.datetime.now().timestamp(), 0))))
-            c.execute("INSERT INTO Message (content, chatroomid, senderid, timestamp) VALUES (?, ?, ?, ?)",
-                      (content, chatroomid, senderid, ts))
+            c.execute("INSERT INTO Message (messageid, content, chatroomid, senderid, timestamp) VALUES (?, ?, ?, ?, ?)",
+                      (messageid, content, chatroomid, senderid, ts))
             new_messageid = c.lastrowid
-            db.commit()
+            chatter_rollups.record_message(c, chatroomid, senderid, ts)
+            shard.commit()
+
+            notify_message_added(chatroomid, new_messageid)
 
             return Message(new_messageid, db)
 
         except sqlite3.Error as e:
-            db.rollback()
+            shard.rollback()
             print(f"ERROR: Exception raised when adding message.\n"
                   f"Database rolled back to last commit. Details:\n{e}")
             raise e
 
+    @staticmethod
+    def add_many(messages, db:sqlite3.Connection, before_commit=None):
+        """
+        Adds several messages with one transaction per shard, e.g. to apply a batch from the send log.
+        :param messages: List of (content, chatroomid, senderid, timestamp)
+        :param before_commit: Called as before_commit(shard, cursor, indexes) inside each shard's transaction, with the
+            indexes into messages of those added to that shard, so the caller can record something atomically with them
+        :return: The new messageids, in the same order as messages
+        """
+
+        by_shard = {}
+        for i, m in enumerate(messages):
+            by_shard.setdefault(get_shard(db, m[1]), []).append(i)
+
+        messageids = [None] * len(messages)
+
+        for shard, indexes in by_shard.items():
+            try:
+                c = shard.cursor()
+
+                for i in indexes:
+                    content, chatroomid, senderid, ts = messages[i]
+                    c.execute("INSERT INTO Message (messageid, content, chatroomid, senderid, timestamp) "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              (allocate_id(db, shard, 'Message'), content, chatroomid, senderid, ts))
+                    messageids[i] = c.lastrowid
+                    chatter_rollups.record_message(c, chatroomid, senderid, ts)
+
+                if before_commit:
+                    before_commit(shard, c, indexes)
+
+                shard.commit()
+
+            except sqlite3.Error as e:
+                shard.rollback()
+                print(f"ERROR: Exception raised when adding {len(indexes)} messages.\n"
+                      f"Database rolled back to last commit. Details:\n{e}")
+                raise e
+
+        for m, messageid in zip(messages, messageids):
+            notify_message_added(m[1], messageid)
+
+        return messageids
+
     @staticmethod
     def get_messages_for_user(userid, since:datetime.datetime, db:sqlite3.Connection):
 
         if not since:
             since = datetime.datetime(2010,1,1)
 
-        c = db.cursor()
+        messages_to_return = []
 
-        message_rows = c.execute("SELECT messageid FROM Message WHERE senderid = ? AND timestamp > ?",
-                                 [userid, since.timestamp()]).fetchall()
+        for shard in get_all_shards(db):
+            c = shard.cursor()
 
-        messages_to_return = []
+            message_rows = c.execute("SELECT messageid FROM Message WHERE senderid = ? AND timestamp > ?",
+                                     [userid, since.timestamp()]).fetchall()
 
-        for row in message_rows:
+            for row in message_rows:
 
-            messages_to_return.append(Message(int(row['messageid']), db))
+                messages_to_return.append(Message(int(row['messageid']), db))
 
         return messages_to_return
 
     @staticmethod
-    def get_msesages_for_chatroom(chatroomid, since:datetime.datetime, db:sqlite3.Connection):
+    def get_chatroomids_for_sender(userid, db:sqlite3.Connection):
+        # Chatrooms the user has sent messages to, live or archived (archived messages are still counted in the rollups)
+
+        chatroomids = set()
+
+        for shard in get_all_shards(db):
+            chatroomids.update(row[0] for row in shard.execute("SELECT DISTINCT chatroomid FROM Message WHERE senderid=?",
+                                                               [userid]))
+
+            if shard.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='MessageRollup'").fetchone():
+                chatroomids.update(row[0] for row in shard.execute("SELECT DISTINCT chatroomid FROM MessageRollup "
+                                                                   "WHERE senderid=?", [userid]))
+
+        return sorted(chatroomids)
+
+    @staticmethod
+    def get_msesages_for_chatroom(chatroomid, since:datetime.datetime, db:sqlite3.Connection, primary=False):
 
         if not since:
             since = datetime.datetime(2010,1,1)
 
         try:
-            c = db.cursor()
+            shard = get_shard(db, chatroomid)
+            c = get_read_db(db, chatroomid, primary).cursor()
 
             ts = int(round(since.timestamp(), 0))
 
-            message_rows = c.execute("SELECT messageid FROM Message WHERE chatroomid=? AND timestamp>?",
-                                     [chatroomid, ts]).fetchall()
+            message_rows = c.execute("SELECT messageid, content, chatroomid, senderid, timestamp FROM Message "
+                                     "WHERE chatroomid=? AND timestamp>?", [chatroomid, ts]).fetchall()
+
+            live_messages = [Message(int(row['messageid']), db, row) for row in message_rows]
 
-            return [Message(int(row['messageid']), db) for row in message_rows]
+            # Archived messages are older than anything still in the Message table, so they go first. A message can
+            # briefly be in both places while it is being archived, in which case the live copy wins.
+            live_messageids = {m.messageid for m in live_messages}
+            archived_messages = [Message(m['messageid'], db, m, archived=True)
+                                 for m in chatter_archive.get_archived_messages_for_chatroom(shard, chatroomid, ts)
+                                 if m['messageid'] not in live_messageids]
+
+            return archived_messages + live_messages
 
         except sqlite3.Error as e:
             print(f"ERROR: Unable to retrieve messages for chatroomid {chatroomid}. Details\n{e}")
             raise e
 
+    @staticmethod
+    def iter_records(db:sqlite3.Connection, chatroomid=None, since:datetime.datetime=None, batch_size=1000):
+        """
+        Streams messages as MessageRecords without building a Message for each, fetching batch_size rows at a time, so
+        reading every message for an export or analytics job doesn't hold them all in memory at once.
+        :param chatroomid: Only read this chatroom's messages, or None for every chatroom
+        :param since: Only read messages sent after this time, or None for all of them
+        :return: Generator of MessageRecords. Each chatroom's archived messages come before its live ones.
+        """
+
+        ts = int(round(since.timestamp(), 0)) if since else 0
+
+        try:
+            if chatroomid is None:
+                # Replicas are copies of a single database file, so a sharded database is read from its shards
+                sources = [(shard, shard if is_sharded(db) else get_read_db(db)) for shard in get_all_shards(db)]
+            else:
+                sources = [(get_shard(db, chatroomid), get_read_db(db, chatroomid))]
+
+            for shard, read_db in sources:
+                c = read_db.cursor()
+                chatroom_filter = "" if chatroomid is None else " AND chatroomid=?"
+                chatroom_params = [] if chatroomid is None else [chatroomid]
+
+                # Archived messages are older than every live message in their chatroom, except while one is part way
+                # through being archived, when it is in both places and the live copy wins
+                first_live = dict(c.execute("SELECT chatroomid, min(messageid) FROM Message WHERE 1=1"
+                                            + chatroom_filter + " GROUP BY chatroomid", chatroom_params).fetchall())
+
+                if chatroomid is None:
+                    archived = chatter_archive.iter_archived_messages(shard, ts)
+                else:
+                    archived = chatter_archive.get_archived_messages_for_chatroom(shard, chatroomid, ts)
+
+                for m in archived:
+                    if m['messageid'] < first_live.get(m['chatroomid'], 2 ** 62):
+                        yield MessageRecord(m['messageid'], m['content'], m['chatroomid'], m['senderid'],
+                                            m['timestamp'], True)
+
+                c = read_db.cursor()
+                c.row_factory = lambda cursor, row: MessageRecord(*row)
+
+                c.execute("SELECT messageid, content, chatroomid, senderid, timestamp FROM Message WHERE timestamp>?"
+                          + chatroom_filter + " ORDER BY messageid", [ts] + chatroom_params)
+
+                while rows := c.fetchmany(batch_size):
+                    yield from rows
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to retrieve message records. Details\n{e}")
+            raise e
+
+    @staticmethod
+    def get_message_page_for_chatroom(chatroomid, before, limit, db:sqlite3.Connection):
+
+        try:
+            shard = get_shard(db, chatroomid)
+            c = get_read_db(db, chatroomid).cursor()
+
+            if before is None:
+                message_rows = c.execute("SELECT messageid, content, chatroomid, senderid, timestamp FROM Message "
+                                         "WHERE chatroomid=? ORDER BY messageid DESC LIMIT ?",
+                                         [chatroomid, limit]).fetchall()
+            else:
+                message_rows = c.execute("SELECT messageid, content, chatroomid, senderid, timestamp FROM Message "
+                                         "WHERE chatroomid=? AND messageid<? ORDER BY messageid DESC LIMIT ?",
+                                         [chatroomid, before, limit]).fetchall()
+
+            messages = [Message(int(row['messageid']), db, row) for row in message_rows]
+
+            if len(messages) < limit:
+                # Fill the rest of the page from the archive, starting below the oldest live message on this page
+                archive_before = messages[-1].messageid if messages else before
+                if archive_before is None:
+                    archive_before = c.execute("SELECT coalesce(min(messageid), ?) AS first_live FROM Message "
+                                               "WHERE chatroomid=?", [2 ** 62, chatroomid]).fetchone()['first_live']
+
+                messages += [Message(m['messageid'], db, m, archived=True) for m in
+                             chatter_archive.get_archived_message_page(shard, chatroomid, archive_before,
+                                                                       limit - len(messages))]
+
+            return messages
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to retrieve message page for chatroomid {chatroomid}. Details\n{e}")
+            raise e
+
+    @staticmethod
+    def get_timeline_for_chatroom(chatroomid, before, limit, db:sqlite3.Connection, primary=False):
+        """
+        Reads a page of a chatroom's timeline, newest first, in one query: each message joined to its sender's
+        username and its attachments, which are aggregated into a JSON array so there is still one row per message.
+        Sharded databases keep the User table in the catalog, so there the usernames take one more query, as do
+        messages read from the archive.
+        :param before: Only messages with a lower messageid, or None for the newest
+        :param limit: Maximum number of entries, or None for the whole history
+        :return: List of TimelineEntry
+        """
+
+        # Usernames can only be joined in when User is in the same database as Message
+        join_users = not is_sharded(db)
+
+        sql = f"""SELECT m.messageid, m.content, m.chatroomid, m.senderid, m.timestamp,
+                        {'u.username' if join_users else 'NULL'} AS sender_username,
+                        CASE WHEN count(a.attachmentid) THEN json_group_array(json_array(a.attachmentid, a.filepath))
+                        END AS attachments
+                  FROM (SELECT messageid, content, chatroomid, senderid, timestamp FROM Message
+                        WHERE chatroomid=? AND messageid<? ORDER BY messageid DESC LIMIT ?) AS m
+                  {'LEFT JOIN User AS u ON u.userid=m.senderid' if join_users else ''}
+                  LEFT JOIN Attachment AS a ON a.messageid=m.messageid
+                  GROUP BY m.messageid
+                  ORDER BY m.messageid DESC"""
+
+        try:
+            shard = get_shard(db, chatroomid)
+            c = get_read_db(db, chatroomid, primary).cursor()
+
+            rows = [dict(row) for row in c.execute(sql, [chatroomid, 2 ** 62 if before is None else before,
+                                                         -1 if limit is None else limit]).fetchall()]
+            for row in rows:
+                row['attachments'] = sorted(tuple(a) for a in json.loads(row['attachments'] or '[]'))
+
+            if limit is None or len(rows) < limit:
+                # Fill the rest of the page from the archive, as get_message_page_for_chatroom() does
+                archive_before = rows[-1]['messageid'] if rows else before
+                if archive_before is None:
+                    archive_before = c.execute("SELECT coalesce(min(messageid), ?) AS first_live FROM Message "
+                                               "WHERE chatroomid=?", [2 ** 62, chatroomid]).fetchone()['first_live']
+
+                archived = chatter_archive.get_archived_message_page(shard, chatroomid, archive_before,
+                                                                     2 ** 62 if limit is None else limit - len(rows))
+
+                attachments = {}
+                messageids = [m['messageid'] for m in archived]
+                for i in range(0, len(messageids), 500):
+                    batch = messageids[i:i + 500]
+                    for row in shard.execute(f"SELECT messageid, attachmentid, filepath FROM Attachment WHERE "
+                                             f"messageid IN ({','.join('?' * len(batch))}) ORDER BY attachmentid",
+                                             batch):
+                        attachments.setdefault(row[0], []).append((row[1], row[2]))
+
+                rows += [dict(m, sender_username=None, attachments=attachments.get(m['messageid'], []))
+                         for m in archived]
+
+            usernames = _get_usernames(db, [row['senderid'] for row in rows if row['sender_username'] is None])
+
+            return [TimelineEntry(row['messageid'], row['content'], int(row['chatroomid']), int(row['senderid']),
+                                  row['sender_username'] or usernames.get(row['senderid']), row['timestamp'],
+                                  tuple(row['attachments'])) for row in rows]
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to retrieve timeline for chatroomid {chatroomid}. Details\n{e}")
+            raise e
+
     @staticmethod
     def get_message_count_for_chatroom(chatroomid, since:datetime.datetime, db:sqlite3.Connection):
 
@@ -674,19 +1729,43 @@ class Message(ChatterDB):
             since = datetime.datetime(2010,1,1)
 
         try:
-            c = db.cursor()
+            shard = get_shard(db, chatroomid)
+            c = get_read_db(db, chatroomid).cursor()
 
             ts = int(round(since.timestamp(), 0))
 
             row = c.execute("SELECT count(messageid) as message_count FROM Message WHERE chatroomid=? AND timestamp>?",
                                      [chatroomid, ts]).fetchone()
 
-            return row['message_count']
+            return row['message_count'] + chatter_archive.count_archived_messages_for_chatroom(shard, chatroomid, ts)
 
         except sqlite3.Error as e:
             print(f"ERROR: Unable to retrieve message count for chatroomid {chatroomid}. Details\n{e}")
             raise e
 
+    @staticmethod
+    def get_newest_messageid_for_chatroom(chatroomid, db:sqlite3.Connection):
+        """
+        Read from the primary rather than a replica, so a history page with a cursor no higher than this is known to be
+        complete: messages added from now on get higher messageids.
+        :return: The messageid of the chatroom's newest message, live or archived, or None if it has no messages
+        """
+
+        try:
+            shard = get_shard(db, chatroomid)
+
+            newest = shard.execute("SELECT max(messageid) FROM Message WHERE chatroomid=?", [chatroomid]).fetchone()[0]
+
+            if newest is None:
+                archived = chatter_archive.get_archived_message_page(shard, chatroomid, 2 ** 62, 1)
+                newest = archived[0]['messageid'] if archived else None
+
+            return newest
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to retrieve newest messageid for chatroomid {chatroomid}. Details\n{e}")
+            raise e
+
     def __encode_json(self):
 
         attachments = [a.json for a in self.attachments]
@@ -709,15 +1788,30 @@ class AttachmentNotFoundError(Exception):
 
 class Attachment(ChatterDB):
 
-    def __init__(self, attachmentid, db: sqlite3.Connection):
+    def __init__(self, attachmentid, db: sqlite3.Connection, lazy=False):
 
         self.__db = db
         self.__attachmentid = attachmentid
 
-        c = self.__db.cursor()
+        if lazy:
+            self._loaded = False
+        else:
+            self._load_row()
+
+    def _load_row(self):
+
+        attachmentid = self.__attachmentid
+        attachment_data = None
+
+        for shard in get_shards_for_id(self.__db, attachmentid):
+            c = shard.cursor()
 
-        attachment_data = c.execute("SELECT messageid, filepath FROM Attachment WHERE attachmentid=?",
-                              [self.__attachmentid]).fetchone()
+            attachment_data = c.execute("SELECT messageid, filepath FROM Attachment WHERE attachmentid=?",
+                                  [self.__attachmentid]).fetchone()
+
+            if attachment_data:
+                self.__shard = shard
+                break
 
         if attachment_data:
             self.__messageid = attachment_data['messageid']
@@ -741,7 +1835,7 @@ class Attachment(ChatterDB):
 
     @property
     def message(self):
-        return Message(self.__messageid, self.__db)
+        return Message(self.__messageid, self.__db, lazy=True)
 
     @property
     def json(self):
@@ -758,12 +1852,12 @@ class Attachment(ChatterDB):
 
         # Next remove data from database
         try:
-            c = self.__db.cursor()
+            c = self.__shard.cursor()
             c.execute("DELETE FROM Attachment WHERE attachmentid=?", [self.__attachmentid])
-            self.__db.commit()
+            self.__shard.commit()
 
         except sqlite3.Error as e:
-            self.__db.rollback()
+            self.__shard.rollback()
             print(f"ERROR: Exception raised when deleting attachmentid {self.__attachmentid}. Details:\n{e}")
             raise e
 
@@ -775,12 +1869,12 @@ class Attachment(ChatterDB):
             if not os.path.exists(filepath):
                 raise FileNotFoundError
 
-            c = self.__db.cursor()
+            c = self.__shard.cursor()
             c.execute("UPDATE Attachment SET filepath=? WHERE attachmentid=?", [self.__filepath, self.__attachmentid])
-            self.__db.commit()
+            self.__shard.commit()
 
         except sqlite3.Error as e:
-            self.__db.rollback()
+            self.__shard.rollback()
             print(f"ERROR: Exception raised when updating attachmentid {self.__attachmentid}. Details:\n{e}")
             raise e
 
@@ -791,25 +1885,34 @@ class Attachment(ChatterDB):
     def add(messageid, filepath, db:sqlite3.Connection):
         # TODO: Add ability to receive any file, copy it to the correct path and set the correct path location for this
         #  Attachment object
+        # Attachments are kept on the same shard as their message
+        shard = get_shard(db, Message(messageid, db).chatroomid) if is_sharded(db) else db
         try:
-            c = db.cursor()
-            c.execute("INSERT INTO Attachment (messageid, filepath) VALUES (?, ?)", [messageid, filepath])
+            c = shard.cursor()
+            attachmentid = allocate_id(db, shard, 'Attachment')
+            c.execute("INSERT INTO Attachment (attachmentid, messageid, filepath) VALUES (?, ?, ?)",
+                      [attachmentid, messageid, filepath])
             new_attachmentid = c.lastrowid
-            db.commit()
+            shard.commit()
             return Attachment(new_attachmentid, db)
 
         except sqlite3.Error as e:
-            db.rollback()
+            shard.rollback()
             print(f"ERROR: Exception raised when inserting a new attachment. Details:\n{e}")
             raise e
 
     @staticmethod
-    def get_all_attachments_for_message(messsageid, db:sqlite3.Connection):
+    def get_all_attachments_for_message(messsageid, db:sqlite3.Connection, chatroomid=None):
+        # Passing the message's chatroomid saves searching every shard of a sharded database for its attachments
 
         try:
-            c = db.cursor()
+            attachment_rows = []
+
+            for shard in get_all_shards(db) if chatroomid is None else [get_shard(db, chatroomid)]:
+                c = shard.cursor()
 
-            attachment_rows = c.execute("SELECT attachmentid FROM Attachment WHERE messageid=?", [messsageid]).fetchall()
+                attachment_rows += c.execute("SELECT attachmentid FROM Attachment WHERE messageid=?",
+                                             [messsageid]).fetchall()
 
             return [Attachment(int(row['attachmentid']), db) for row in attachment_rows]
 
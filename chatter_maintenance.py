@@ -0,0 +1,313 @@
+import sqlite3, os, time, datetime, threading, fcntl, argparse
+import chatter_classes, chatter_retention
+
+# Tasks run by default, in this order:
+#   analyze     Refreshes the query planner's statistics (ANALYZE), sampling at most ANALYSIS_LIMIT rows per index
+#   optimize    PRAGMA optimize, which re-analyzes only the tables whose statistics have gone stale
+#   checkpoint  Copies the write-ahead log into the database and truncates it (databases in WAL mode only)
+#   vacuum      Gives free pages back to the filesystem (databases using auto_vacuum=INCREMENTAL only)
+TASKS = ('analyze', 'optimize', 'checkpoint', 'vacuum')
+
+# Seconds the tasks of one run may take between them, for each database. A task still running when the budget runs out
+# is interrupted and the rest are skipped until the next run.
+BUDGET = 60.0
+
+ANALYSIS_LIMIT = 1000
+
+# Seconds between scheduled runs, and the local hours (start, end) they may start in. The window can wrap past
+# midnight, e.g. (23, 4); None allows any hour.
+INTERVAL = 86400.0
+HOURS = (2, 5)
+
+# Seconds between the scheduler's checks of whether a run is due
+CHECK_INTERVAL = 300.0
+
+# SQLite VM instructions between checks of the budget while a statement runs
+_PROGRESS_STEPS = 10000
+
+
+class MaintenanceError(Exception):
+    pass
+
+
+def get_databases(db) -> list:
+    # Every database file behind db: the catalog and shards of a chatter_shards.ShardRouter, or just db itself
+    return [db.catalog] + db.shards if chatter_classes.is_sharded(db) else [db]
+
+
+def get_path(dbcnx:sqlite3.Connection):
+    row = dbcnx.execute("PRAGMA database_list").fetchone()
+    return row[2] if row and row[2] else ':memory:'
+
+
+def _analyze(dbcnx, deadline):
+    dbcnx.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+    dbcnx.execute("ANALYZE")
+    dbcnx.commit()
+    return 0
+
+
+def _optimize(dbcnx, deadline):
+    dbcnx.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+    dbcnx.execute("PRAGMA optimize")
+    dbcnx.commit()
+    return 0
+
+
+def _checkpoint(dbcnx, deadline):
+
+    if dbcnx.execute("PRAGMA journal_mode").fetchone()[0] != 'wal':
+        return None
+
+    wal_path = get_path(dbcnx) + '-wal'
+    before = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+
+    # Returns busy=1 if readers or writers kept it from finishing; what it did manage is kept
+    busy = dbcnx.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+
+    after = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    if busy:
+        raise MaintenanceError("ERROR: Checkpoint could not finish while the database was in use.")
+
+    return before - after
+
+
+def _vacuum(dbcnx, deadline):
+
+    if dbcnx.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return None
+
+    return chatter_retention.incremental_vacuum(dbcnx, deadline=deadline)
+
+
+_TASK_FUNCTIONS = {'analyze': _analyze, 'optimize': _optimize, 'checkpoint': _checkpoint, 'vacuum': _vacuum}
+
+
+def check_tasks(tasks):
+
+    unknown = [t for t in tasks if t not in _TASK_FUNCTIONS]
+    if unknown:
+        raise MaintenanceError(f"ERROR: Unknown maintenance tasks {', '.join(unknown)}. "
+                               f"Choose from {', '.join(TASKS)}.")
+
+
+def run_maintenance(db, tasks=TASKS, budget=BUDGET):
+    """
+    Runs maintenance tasks on every database behind db, each database getting its own time budget.
+    :return: List of {'database', 'task', 'result', 'seconds', 'bytes_reclaimed', 'error'}, where result is
+        'completed', 'skipped' (not needed by this database, or no budget left), 'interrupted' or 'failed'
+    """
+
+    check_tasks(tasks)
+    results = []
+
+    for dbcnx in get_databases(db):
+        deadline = time.monotonic() + budget
+        path = get_path(dbcnx)
+
+        for task in tasks:
+            result = {'database': path, 'task': task, 'result': 'skipped', 'seconds': 0.0, 'bytes_reclaimed': 0,
+                      'error': None}
+            results.append(result)
+
+            if time.monotonic() >= deadline:
+                continue
+
+            started = time.monotonic()
+            # Stops long statements such as ANALYZE on a big table once the budget has run out
+            dbcnx.set_progress_handler(lambda: time.monotonic() >= deadline, _PROGRESS_STEPS)
+
+            try:
+                reclaimed = _TASK_FUNCTIONS[task](dbcnx, deadline)
+
+                if reclaimed is not None:
+                    result['result'] = 'completed'
+                    result['bytes_reclaimed'] = reclaimed
+
+            except (sqlite3.Error, MaintenanceError, OSError) as e:
+                if dbcnx.in_transaction:
+                    dbcnx.rollback()
+                result['result'] = 'interrupted' if 'interrupted' in str(e) else 'failed'
+                result['error'] = str(e)
+                print(f"ERROR: Maintenance task {task} did not finish on {path}. Details:\n{e}")
+
+            finally:
+                dbcnx.set_progress_handler(None, 0)
+
+            result['seconds'] = time.monotonic() - started
+
+    return results
+
+
+def is_quiet_hour(hours, now:datetime.datetime=None):
+
+    if hours is None:
+        return True
+
+    hour = (now or datetime.datetime.now()).hour
+    start, end = hours
+
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class MaintenanceScheduler:
+    """
+    Runs run_maintenance() every interval seconds, starting only during the quiet hours, on a background thread.
+    trigger() asks for a run straight away, whatever the time.
+
+    Worker processes share a state file: a run holds a lock on it, so only one worker runs maintenance at a time, and
+    its modification time records when the last run finished, so the other workers don't repeat it.
+    """
+
+    def __init__(self, connect, state_path, interval=INTERVAL, hours=HOURS, budget=BUDGET, tasks=TASKS,
+                 on_run=None, check_interval=CHECK_INTERVAL):
+        """
+        :param connect: Function returning a new database connection (or chatter_shards.ShardRouter)
+        :param interval: Seconds between scheduled runs, or None for only running when triggered
+        :param on_run: Called with run_maintenance()'s results after each run, e.g. to record metrics
+        """
+
+        check_tasks(tasks)
+
+        self.__connect = connect
+        self.__state_path = state_path
+        self.__interval = interval
+        self.__hours = hours
+        self.__budget = budget
+        self.__tasks = tuple(tasks)
+        self.__on_run = on_run
+        self.__check_interval = check_interval
+        self.__wake = threading.Event()
+        self.__stopping = False
+        self.__triggered_tasks = None
+        self.__running = False
+        self.__last_results = []
+        self.__thread = None
+
+    @property
+    def settings(self):
+        return {'interval': self.__interval, 'hours': self.__hours, 'budget': self.__budget,
+                'tasks': list(self.__tasks)}
+
+    @property
+    def running(self):
+        return self.__running
+
+    @property
+    def last_results(self):
+        # Results of this process's last run
+        return list(self.__last_results)
+
+    @property
+    def last_run(self):
+        # When any worker's last run finished, as a Unix time, or None if maintenance has never run
+        try:
+            return os.stat(self.__state_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def is_due(self, now=None):
+
+        if self.__interval is None:
+            return False
+
+        now = now or time.time()
+        last_run = self.last_run
+
+        return (last_run is None or now - last_run >= self.__interval) and \
+            is_quiet_hour(self.__hours, datetime.datetime.fromtimestamp(now))
+
+    def run(self, tasks=None):
+        """
+        Runs maintenance now, unless another worker is already running it.
+        :return: run_maintenance()'s results, or None if another worker is running maintenance
+        """
+
+        tasks = self.__tasks if tasks is None else tasks
+        check_tasks(tasks)
+
+        with open(self.__state_path, 'a') as state:
+            try:
+                fcntl.flock(state.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            self.__running = True
+            db = self.__connect()
+
+            try:
+                results = run_maintenance(db, tasks, self.__budget)
+            finally:
+                db.close()
+                self.__running = False
+
+            os.utime(self.__state_path)
+
+        self.__last_results = results
+        if self.__on_run:
+            self.__on_run(results)
+
+        return results
+
+    def trigger(self, tasks=None):
+        # Asks the background thread to run maintenance as soon as it can; returns straight away
+
+        tasks = self.__tasks if tasks is None else tuple(tasks)
+        check_tasks(tasks)
+
+        self.__triggered_tasks = tasks
+        self.__wake.set()
+
+    def start(self):
+
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run_loop, name='chatter-maintenance', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+
+        self.__stopping = True
+        self.__wake.set()
+        if self.__thread:
+            self.__thread.join()
+
+    def __run_loop(self):
+
+        while True:
+            self.__wake.wait(self.__check_interval)
+            self.__wake.clear()
+
+            if self.__stopping:
+                return
+
+            tasks, self.__triggered_tasks = self.__triggered_tasks, None
+
+            if tasks is not None or self.is_due():
+                try:
+                    self.run(tasks)
+                except OSError as e:
+                    # Tried again at the next check
+                    print(f"ERROR: Unable to run database maintenance. Details:\n{e}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run database maintenance (ANALYZE, PRAGMA optimize, WAL checkpoint "
+                                                 "and incremental vacuum).")
+    parser.add_argument('database', help="Path to the database file (the catalog, if sharded)")
+    parser.add_argument('--shards', nargs='*', default=[], help="Shard database files, if sharded")
+    parser.add_argument('--tasks', nargs='+', default=list(TASKS), choices=TASKS)
+    parser.add_argument('--budget', type=float, default=BUDGET, help="Seconds allowed for each database")
+    args = parser.parse_args()
+
+    if args.shards:
+        import chatter_shards
+        dbcnx = chatter_shards.ShardRouter(args.database, args.shards)
+    else:
+        dbcnx = sqlite3.connect(args.database, detect_types=sqlite3.PARSE_DECLTYPES)
+
+    for r in run_maintenance(dbcnx, args.tasks, args.budget):
+        print(f"{r['database']}: {r['task']} {r['result']} in {r['seconds']:.2f}s, "
+              f"{r['bytes_reclaimed']} bytes reclaimed{': ' + r['error'] if r['error'] else ''}")
+
+    dbcnx.close()
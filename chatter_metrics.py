@@ -0,0 +1,221 @@
+import os, json, time, threading, math
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms, rendered in the Prometheus text format.
+
+    Each worker process keeps its own values in memory and periodically writes a snapshot of them to a file in a shared
+    directory named after its pid. render() adds up the snapshots from every process, so whichever worker handles a
+    scrape reports totals for the whole deployment. Gauges are only included for processes that are still running.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0, buckets=DEFAULT_BUCKETS):
+
+        self.__directory = directory
+        self.__flush_interval = flush_interval
+        self.__buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        self.__last_flush = 0.0
+
+        # name -> (type, help)
+        self.__descriptions = {}
+
+        # name -> {labels: value}; histogram values are [bucket counts..., +Inf count, sum]
+        self.__values = {}
+
+        # (name, function) for gauges calculated from the deployment-wide totals, e.g. cache hit ratios
+        self.__derived = []
+
+        if self.__directory:
+            os.makedirs(self.__directory, exist_ok=True)
+
+    def describe(self, name, metric_type, help_text):
+        self.__descriptions[name] = (metric_type, help_text)
+
+    def derive(self, name, help_text, function):
+        """
+        Adds a gauge that is calculated when metrics are rendered, from the totals across every process. Useful for
+        ratios, which can't be added up per process.
+        :param function: Called with the totals from collect(), returning {labels: value}
+        """
+        self.describe(name, 'gauge', help_text)
+        self.__derived.append((name, function))
+
+    def inc(self, name, labels=None, amount=1.0):
+        key = self.__key(labels)
+        with self.__lock:
+            values = self.__values.setdefault(name, {})
+            values[key] = values.get(key, 0.0) + amount
+
+    def set(self, name, labels=None, value=0.0):
+        # For gauges, and for counters that are kept somewhere else (e.g. a cache's own hit count)
+        key = self.__key(labels)
+        with self.__lock:
+            self.__values.setdefault(name, {})[key] = float(value)
+
+    def observe(self, name, labels=None, value=0.0):
+
+        key = self.__key(labels)
+
+        with self.__lock:
+            values = self.__values.setdefault(name, {})
+            if key not in values:
+                values[key] = [0] * (len(self.__buckets) + 1) + [0.0]
+
+            histogram = values[key]
+            for i, bound in enumerate(self.__buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[len(self.__buckets)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self.__lock:
+            return {name: {json.dumps(key): (list(v) if isinstance(v, list) else v) for key, v in values.items()}
+                    for name, values in self.__values.items()}
+
+    def flush(self):
+
+        if not self.__directory:
+            return
+
+        path = os.path.join(self.__directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'pid': os.getpid(), 'values': self.snapshot()}, f)
+
+        os.replace(tmp_path, path)
+        self.__last_flush = time.time()
+
+    def maybe_flush(self):
+        # Cheap enough to call after every request; only writes once per flush_interval
+        if time.time() - self.__last_flush >= self.__flush_interval:
+            self.flush()
+
+    def collect(self):
+        """
+        Adds up this process's values with the latest snapshots written by every other process.
+        :return: Dictionary of {name: {labels: value}}
+        """
+
+        snapshots = [{'pid': os.getpid(), 'values': self.snapshot()}]
+
+        if self.__directory:
+            for filename in os.listdir(self.__directory):
+                if not filename.endswith('.json') or filename == f"{os.getpid()}.json":
+                    continue
+
+                try:
+                    with open(os.path.join(self.__directory, filename)) as f:
+                        snapshots.append(json.load(f))
+
+                except (OSError, ValueError):
+                    # The file may have been removed, or a snapshot may be part written on some filesystems
+                    continue
+
+        totals = {}
+
+        for snapshot in snapshots:
+            alive = snapshot['pid'] == os.getpid() or _process_is_running(snapshot['pid'])
+
+            for name, values in snapshot['values'].items():
+                if self.__descriptions.get(name, ('untyped',))[0] == 'gauge' and not alive:
+                    continue
+
+                name_totals = totals.setdefault(name, {})
+                for key, value in values.items():
+                    key = tuple(tuple(label) for label in json.loads(key))
+                    if isinstance(value, list):
+                        existing = name_totals.get(key, [0] * len(value))
+                        name_totals[key] = [a + b for a, b in zip(existing, value)]
+                    else:
+                        name_totals[key] = name_totals.get(key, 0.0) + value
+
+        return totals
+
+    def render(self):
+        # The whole deployment's metrics in the Prometheus text exposition format
+
+        lines = []
+        totals = self.collect()
+
+        for name, function in self.__derived:
+            totals[name] = function(totals)
+
+        for name, values in sorted(totals.items()):
+            metric_type, help_text = self.__descriptions.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+            for key, value in sorted(values.items()):
+                if metric_type == 'histogram':
+                    for bound, count in zip(self.__buckets, value):
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', _format_number(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {value[-2]}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_number(value[-1])}")
+                    lines.append(f"{name}_count{_format_labels(key)} {value[-2]}")
+                else:
+                    lines.append(f"{name}{_format_labels(key)} {_format_number(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __key(labels):
+        return tuple(sorted((str(k), str(v)) for k, v in (labels or {}).items()))
+
+
+def hit_ratios(totals, counter_name, group_label='cache', result_label='result'):
+    """
+    Works out hit ratios from a counter labelled with result="hit" or result="miss", for use with Metrics.derive().
+    :return: {((group_label, group),): hits / (hits + misses)} for each group with any requests
+    """
+
+    hits = {}
+    requests = {}
+
+    for key, value in totals.get(counter_name, {}).items():
+        labels = dict(key)
+        group = ((group_label, labels.get(group_label, '')),)
+        requests[group] = requests.get(group, 0.0) + value
+        if labels.get(result_label) == 'hit':
+            hits[group] = hits.get(group, 0.0) + value
+
+    return {group: hits.get(group, 0.0) / total for group, total in requests.items() if total}
+
+
+def _format_labels(key):
+
+    if not key:
+        return ''
+
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in key]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_number(value):
+
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def _process_is_running(pid):
+
+    try:
+        os.kill(pid, 0)
+        return True
+
+    except ProcessLookupError:
+        return False
+
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
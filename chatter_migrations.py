@@ -0,0 +1,251 @@
+import sqlite3, json, time, argparse, typing, os
+import chatter_archive, chatter_rollups, chatter_sendlog, chatter_retention
+
+# Rows of Message (by messageid) handled per backfill transaction, and seconds to pause between transactions so
+# requests waiting for the write lock get a turn
+BATCH_SIZE = 2000
+PAUSE = 0.05
+
+
+class SchemaError(Exception):
+    pass
+
+
+class Migration(typing.NamedTuple):
+    """
+    One step in the schema's history. schema(dbcnx) makes quick changes such as creating tables, and runs in the same
+    transaction that sets PRAGMA user_version to version. backfill(dbcnx, state, batch_size), if given, is called
+    repeatedly, each time doing one small transaction's worth of work and returning the state to carry on from, or None
+    once finished; user_version is only set to version when it has finished. An interrupted backfill carries on where
+    it left off.
+    """
+
+    version: int
+    description: str
+    schema: typing.Callable = None
+    backfill: typing.Callable = None
+
+
+def has_table(dbcnx:sqlite3.Connection, name):
+    return dbcnx.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", [name]).fetchone() is not None
+
+
+def get_version(dbcnx:sqlite3.Connection):
+    # Read from the database header, so cheap enough to check on every startup
+    return dbcnx.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _save_backfill_state(dbcnx, version, state):
+    dbcnx.execute("CREATE TABLE IF NOT EXISTS SchemaMigrationState (version INTEGER PRIMARY KEY, state TEXT NOT NULL)")
+    dbcnx.execute("INSERT INTO SchemaMigrationState (version, state) VALUES (?, ?) "
+                  "ON CONFLICT (version) DO UPDATE SET state=excluded.state", [version, json.dumps(state)])
+
+
+def _load_backfill_state(dbcnx, version):
+
+    if not has_table(dbcnx, 'SchemaMigrationState'):
+        return None
+
+    row = dbcnx.execute("SELECT state FROM SchemaMigrationState WHERE version=?", [version]).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+# Migrations. Databases created before versioning have user_version 0. Each step only touches the tables present in
+# the database it runs on, so the same steps serve a single database and the catalog and shards of a sharded one.
+
+def _add_archive_and_rollup_tables(dbcnx):
+
+    if not has_table(dbcnx, 'Message'):
+        return
+
+    chatter_archive.create_archive_table(dbcnx)
+
+    if not has_table(dbcnx, 'MessageRollup'):
+        chatter_rollups.create_rollup_table(dbcnx)
+
+        # Messages added from now on are counted as they are added, so the backfill counts those up to here
+        high = dbcnx.execute("SELECT coalesce(max(messageid), 0) FROM Message").fetchone()[0]
+        _save_backfill_state(dbcnx, 2, {'after': 0, 'high': high, 'archive_counted': False})
+
+
+def _backfill_rollups(dbcnx, state, batch_size):
+    """
+    Counts messages from before the rollup table existed, a range of messageids at a time. Archived messages are
+    counted in one go first, since they are read from segment files rather than the table.
+
+    Archiving shouldn't run while this does, or a message could be counted both in the archive and in the table.
+    Deleting an uncounted message while it runs can leave its hour's count one too low; chatter_rollups.py recounts
+    exactly if that matters.
+    """
+
+    if state is None:
+        return None
+
+    if not state['archive_counted']:
+        counts = {}
+        for m in chatter_archive.iter_archived_messages(dbcnx, -1):
+            if m['messageid'] <= state['high']:
+                key = (m['chatroomid'], m['senderid'], chatter_rollups.get_hour(m['timestamp']))
+                counts[key] = counts.get(key, 0) + 1
+
+        dbcnx.executemany("INSERT INTO MessageRollup (chatroomid, senderid, hour, message_count) VALUES (?, ?, ?, ?) "
+                          "ON CONFLICT (chatroomid, senderid, hour) "
+                          "DO UPDATE SET message_count=message_count+excluded.message_count",
+                          [key + (count,) for key, count in counts.items()])
+
+        return dict(state, archive_counted=True)
+
+    if state['after'] >= state['high']:
+        return None
+
+    upto = min(state['after'] + batch_size, state['high'])
+
+    dbcnx.execute("INSERT INTO MessageRollup (chatroomid, senderid, hour, message_count) "
+                  "SELECT chatroomid, senderid, CAST(timestamp AS INTEGER) / ? * ?, count(*) FROM Message "
+                  "WHERE messageid>? AND messageid<=? GROUP BY 1, 2, 3 "
+                  "ON CONFLICT (chatroomid, senderid, hour) "
+                  "DO UPDATE SET message_count=message_count+excluded.message_count",
+                  [chatter_rollups.ROLLUP_SECONDS, chatter_rollups.ROLLUP_SECONDS, state['after'], upto])
+
+    return dict(state, after=upto)
+
+
+def _add_sendlog_checkpoint_table(dbcnx):
+
+    if has_table(dbcnx, 'Message'):
+        chatter_sendlog.create_checkpoint_table(dbcnx)
+
+
+def _add_retention_tables(dbcnx):
+    # Indexes on a large Message table take a while to build, holding the write lock until they are done
+
+    if has_table(dbcnx, 'Chatroom'):
+        chatter_retention.create_retention_table(dbcnx)
+
+    if has_table(dbcnx, 'Message'):
+        dbcnx.execute("CREATE INDEX IF NOT EXISTS idx_message_chatroom_timestamp ON Message (chatroomid, timestamp)")
+
+    if has_table(dbcnx, 'Attachment'):
+        chatter_retention.create_file_queue_table(dbcnx)
+        dbcnx.execute("CREATE INDEX IF NOT EXISTS idx_attachment_messageid ON Attachment (messageid)")
+
+
+MIGRATIONS = [
+    Migration(1, "Add MessageArchive and MessageRollup tables", _add_archive_and_rollup_tables),
+    Migration(2, "Count existing messages into MessageRollup", backfill=_backfill_rollups),
+    Migration(3, "Add SendLogCheckpoint table", _add_sendlog_checkpoint_table),
+    Migration(4, "Add retention policy and attachment file queue tables, with indexes for purging",
+              _add_retention_tables),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def get_pending_migrations(dbcnx:sqlite3.Connection):
+    """
+    :return: The migrations not yet applied to the database, oldest first
+    :raises SchemaError: If the database has been migrated further than this code knows about
+    """
+
+    version = get_version(dbcnx)
+
+    if version > LATEST_VERSION:
+        raise SchemaError(f"ERROR: Database schema version {version} is newer than this code's ({LATEST_VERSION}).")
+
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def migrate(dbcnx:sqlite3.Connection, batch_size=BATCH_SIZE, pause=PAUSE, target=LATEST_VERSION):
+    """
+    Brings the database up to date, one migration at a time. Backfills commit every batch and pause in between, so
+    the app can keep running while they do.
+    :param target: Stop after this version, e.g. to test a migration
+    :return: The schema version reached
+    """
+
+    for migration in get_pending_migrations(dbcnx):
+        if migration.version > target:
+            break
+
+        try:
+            dbcnx.execute("BEGIN IMMEDIATE")
+
+            if migration.backfill:
+                state = _load_backfill_state(dbcnx, migration.version)
+
+                while state is not None:
+                    state = migration.backfill(dbcnx, state, batch_size)
+
+                    # The last batch commits along with the new version, so it can't be applied twice
+                    if state is not None:
+                        _save_backfill_state(dbcnx, migration.version, state)
+                        dbcnx.commit()
+                        time.sleep(pause)
+                        dbcnx.execute("BEGIN IMMEDIATE")
+
+            if migration.schema:
+                migration.schema(dbcnx)
+            if has_table(dbcnx, 'SchemaMigrationState'):
+                dbcnx.execute("DELETE FROM SchemaMigrationState WHERE version=?", [migration.version])
+
+            # Takes effect when the transaction commits, along with the changes above
+            dbcnx.execute(f"PRAGMA user_version={int(migration.version)}")
+            dbcnx.commit()
+
+            print(f"Success: Migrated to schema version {migration.version} ({migration.description}).")
+
+        except sqlite3.Error as e:
+            dbcnx.rollback()
+            print(f"ERROR: Unable to apply migration {migration.version} ({migration.description}). Details:\n{e}")
+            raise e
+
+    return get_version(dbcnx)
+
+
+def check_schema(paths):
+    """
+    Checks the databases an app is about to use are up to date, without changing them.
+    :return: {path: number of migrations still to apply} for the databases that are behind
+    """
+
+    behind = {}
+
+    for path in paths:
+        # Databases not created yet are left to init_db.py
+        if not os.path.exists(path):
+            continue
+
+        dbcnx = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            pending = get_pending_migrations(dbcnx)
+        finally:
+            dbcnx.close()
+
+        if pending:
+            behind[path] = len(pending)
+
+    return behind
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Bring Chatter databases up to the current schema version.")
+    parser.add_argument('databases', nargs='+', help="Database files to migrate (the catalog and every shard, if "
+                                                     "sharded)")
+    parser.add_argument('--check', action='store_true', help="Only report which databases are behind")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--pause', type=float, default=PAUSE)
+    args = parser.parse_args()
+
+    if args.check:
+        behind = check_schema(args.databases)
+        for path in args.databases:
+            print(f"{path}: {behind[path]} migrations to apply" if path in behind else f"{path}: up to date")
+
+    else:
+        for path in args.databases:
+            dbcnx = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+            dbcnx.row_factory = sqlite3.Row
+
+            print(f"{path}: at schema version {migrate(dbcnx, args.batch_size, args.pause)}.")
+            dbcnx.close()
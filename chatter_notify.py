@@ -0,0 +1,179 @@
+import socket, os, json, threading
+
+# Largest event datagram accepted; events are small JSON objects
+MAX_DATAGRAM = 65536
+
+_SUFFIX = '.sock'
+
+
+class NotifyError(Exception):
+    pass
+
+
+class NotifyChannel:
+    """
+    Passes broker events between the worker processes on one machine, so a message added by one worker reaches
+    subscribers connected to any of them.
+
+    Each process binds a Unix datagram socket named after it in a shared directory. send() writes the event to every
+    other socket in the directory, and a background thread publishes events received from other processes to this
+    process's broker, after passing them to on_receive. Events are never forwarded on, so each reaches every worker
+    once.
+
+    Sending never blocks: if a worker's socket buffer is full the event is dropped for that worker and counted, in the
+    same way as a full broker subscription. Sockets left behind by workers that have exited are removed when sending
+    to them fails.
+    """
+
+    def __init__(self, directory, broker, name=None, on_receive=None):
+        """
+        :param broker: The chatter_broker.Broker that received events are published to
+        :param on_receive: Called as on_receive(topic, event) for each event received, e.g. to clear cached copies of
+            a message changed by another process (see chatter_classes.receive_event())
+        :param name: Name of this process's socket, by default its pid. Tests give two channels in the same process
+            different names to stand in for two workers.
+        """
+
+        if not hasattr(socket, 'AF_UNIX'):
+            raise NotifyError("ERROR: Cross-process notification needs Unix domain sockets.")
+
+        self.__directory = directory
+        self.__broker = broker
+        self.__on_receive = on_receive
+        self.__path = os.path.join(directory, f"{name or os.getpid()}{_SUFFIX}")
+        self.__lock = threading.Lock()
+        self.__peers = []
+        self.__peers_mtime = None
+        self.__thread = None
+        self.__sent = 0
+        self.__received = 0
+        self.__dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # A socket file with our name is left over from an earlier process with the same pid
+        try:
+            os.remove(self.__path)
+        except FileNotFoundError:
+            pass
+
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__socket.bind(self.__path)
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def stats(self):
+        return {'sent': self.__sent, 'received': self.__received, 'dropped': self.__dropped}
+
+    def start(self):
+        # Starts publishing events from other processes to the broker
+
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__receive_loop, name='chatter-notify', daemon=True)
+            self.__thread.start()
+
+    def close(self):
+
+        try:
+            os.remove(self.__path)
+        except FileNotFoundError:
+            pass
+
+        # Shutting down wakes the receiving thread
+        try:
+            self.__socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        if self.__thread:
+            self.__thread.join()
+        self.__socket.close()
+
+    def send(self, topic, event):
+        """
+        Sends an event, already published to this process's broker, to the other processes.
+        :return: The number of processes it was sent to
+        """
+
+        data = json.dumps({'topic': topic, 'event': event}).encode()
+        sent = 0
+
+        for peer in self.__get_peers():
+            try:
+                # Reads by the receiving thread block, so only this send is non-blocking
+                self.__socket.sendto(data, socket.MSG_DONTWAIT, peer)
+                sent += 1
+
+            except BlockingIOError:
+                # That worker is behind on reading; it misses this event rather than holding up this request
+                self.__dropped += 1
+
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nothing is listening any more, so the worker has exited without closing its channel
+                self.__remove_peer(peer)
+
+        self.__sent += sent
+
+        return sent
+
+    def __get_peers(self):
+        # Sockets of the other processes, only listed again when one has been added to or removed from the directory
+
+        try:
+            mtime = os.stat(self.__directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        with self.__lock:
+            if mtime != self.__peers_mtime:
+                self.__peers = [os.path.join(self.__directory, f) for f in os.listdir(self.__directory)
+                                if f.endswith(_SUFFIX) and os.path.join(self.__directory, f) != self.__path]
+                self.__peers_mtime = mtime
+
+            return list(self.__peers)
+
+    def __remove_peer(self, peer):
+
+        try:
+            os.remove(peer)
+        except FileNotFoundError:
+            pass
+
+        with self.__lock:
+            self.__peers_mtime = None
+
+    def __receive_loop(self):
+
+        while True:
+            try:
+                data = self.__socket.recv(MAX_DATAGRAM)
+            except OSError:
+                return
+
+            if not data:
+                # The channel was closed
+                return
+
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+
+            # JSON has no tuples, so topics like ('user', 1) arrive as lists
+            topic = message['topic']
+            if isinstance(topic, list):
+                topic = tuple(topic)
+
+            self.__received += 1
+
+            if self.__on_receive:
+                try:
+                    self.__on_receive(topic, message['event'])
+                except Exception as e:
+                    # The event is still published, and the thread keeps receiving
+                    print(f"ERROR: Unable to handle event from another worker. Details:\n{e}")
+
+            self.__broker.publish(topic, message['event'])
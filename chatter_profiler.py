@@ -0,0 +1,202 @@
+import cProfile, pstats, os, re, json, time, random, threading, argparse
+
+MAX_DUMPS = 200
+
+_FILENAME = re.compile(r'^(?P<ts>\d+)-(?P<pid>\d+)-(?P<ms>\d+)ms-(?P<route>.*)\.prof$')
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class ProfileError(Exception):
+    pass
+
+
+class RequestProfiler:
+    """
+    Profiles a sample of live requests with cProfile and writes each profile to a dump file.
+
+    Profiling is off until enabled. The settings are kept in settings.json in the dump directory so an admin switching
+    profiling on or off through any worker process changes it for all of them. Only one request is profiled at a time
+    per process, because cProfile can't profile two threads' requests separately.
+    """
+
+    def __init__(self, directory, max_dumps=MAX_DUMPS):
+
+        self.__directory = directory
+        self.__max_dumps = max_dumps
+        self.__lock = threading.Lock()
+        self.__settings = {'enabled': False}
+        self.__settings_mtime = None
+
+        os.makedirs(self.__directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        return self.__directory
+
+    @property
+    def settings(self):
+        self.__load_settings()
+        return dict(self.__settings)
+
+    def configure(self, enabled, sample_rate=0.01, route=None, userid=None):
+        """
+        Changes which requests are profiled, for every process sharing the dump directory.
+        :param sample_rate: Fraction of matching requests to profile, from 0 to 1
+        :param route: Only profile requests for this route (e.g. /view/chatroom/<int:chatroomid>), or None for any
+        :param userid: Only profile requests made by this user, or None for any
+        """
+
+        if not 0 <= sample_rate <= 1:
+            raise ProfileError(f"Sample rate must be between 0 and 1, got {sample_rate}")
+
+        settings = {'enabled': bool(enabled), 'sample_rate': sample_rate, 'route': route, 'userid': userid}
+
+        path = os.path.join(self.__directory, 'settings.json')
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(settings, f)
+        os.replace(tmp_path, path)
+
+        self.__settings = settings
+        self.__settings_mtime = os.stat(path).st_mtime_ns
+
+    def __load_settings(self):
+
+        path = os.path.join(self.__directory, 'settings.json')
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != self.__settings_mtime:
+                with open(path) as f:
+                    self.__settings = json.load(f)
+                self.__settings_mtime = mtime
+
+        except (OSError, ValueError):
+            # No settings written yet, or a partly written file; keep what we had
+            pass
+
+    def should_profile(self, route, userid=None):
+
+        settings = self.settings
+
+        if not settings['enabled']:
+            return False
+        if settings.get('route') is not None and settings['route'] != route:
+            return False
+        if settings.get('userid') is not None and settings['userid'] != userid:
+            return False
+
+        return random.random() < settings.get('sample_rate', 0)
+
+    def start(self):
+        # Returns a running profile, or None if another request in this process is already being profiled
+
+        if not self.__lock.acquire(blocking=False):
+            return None
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Something else (e.g. a debugger) is already profiling
+            self.__lock.release()
+            return None
+
+        return profile
+
+    def finish(self, profile, route, elapsed):
+        """
+        Stops a profile from start() and writes it out, named after when it ran, the process, how long the request
+        took and its route. The oldest dumps are removed so there are never more than max_dumps.
+        :return: Path of the dump file
+        """
+
+        try:
+            profile.disable()
+        finally:
+            self.__lock.release()
+
+        filename = f"{int(time.time() * 1000)}-{os.getpid()}-{int(elapsed * 1000)}ms-{_UNSAFE.sub('_', route)}.prof"
+        path = os.path.join(self.__directory, filename)
+        profile.dump_stats(path)
+
+        self.__rotate()
+
+        return path
+
+    def __rotate(self):
+
+        dumps = sorted(f for f in os.listdir(self.__directory) if _FILENAME.match(f))
+
+        for filename in dumps[:max(0, len(dumps) - self.__max_dumps)]:
+            try:
+                os.remove(os.path.join(self.__directory, filename))
+            except FileNotFoundError:
+                # Another process rotated it first
+                pass
+
+
+def list_dumps(directory, route=None):
+    """
+    :param route: Only include dumps of this route (as written in the filename, with unsafe characters replaced by _)
+    :return: List of dictionaries describing each dump file, oldest first
+    """
+
+    dumps = []
+
+    for filename in sorted(os.listdir(directory)):
+        match = _FILENAME.match(filename)
+        if match and (route is None or match['route'] == _UNSAFE.sub('_', route)):
+            dumps.append({'filename': filename, 'timestamp': int(match['ts']) / 1000, 'pid': int(match['pid']),
+                          'elapsed_ms': int(match['ms']), 'route': match['route']})
+
+    return dumps
+
+
+def summarise(directory, route=None, limit=25):
+    """
+    Adds up the dumps in directory and lists the functions with the highest cumulative time across all of them.
+    :return: Dictionary with the number of dumps and the top functions, each with call counts and times in seconds
+    """
+
+    dumps = list_dumps(directory, route)
+    if not dumps:
+        return {'dumps': 0, 'functions': []}
+
+    stats = pstats.Stats(os.path.join(directory, dumps[0]['filename']))
+    for dump in dumps[1:]:
+        stats.add(os.path.join(directory, dump['filename']))
+
+    functions = []
+    for (filename, line, name), (primitive_calls, calls, total, cumulative, callers) in stats.stats.items():
+        # The parent directory too, since e.g. both this project and Flask have an app.py
+        short_filename = os.path.join(os.path.basename(os.path.dirname(filename)), os.path.basename(filename))
+        functions.append({'function': f"{short_filename}:{line}({name})", 'calls': calls,
+                          'total_s': total, 'cumulative_s': cumulative,
+                          'cumulative_per_dump_s': cumulative / len(dumps)})
+
+    functions.sort(key=lambda f: f['cumulative_s'], reverse=True)
+
+    return {'dumps': len(dumps), 'mean_elapsed_ms': sum(d['elapsed_ms'] for d in dumps) / len(dumps),
+            'functions': functions[:limit]}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Show the functions that took the most time across profile dumps.")
+    parser.add_argument('directory', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     'profiles'))
+    parser.add_argument('--route', help="Only include dumps of this route")
+    parser.add_argument('--limit', type=int, default=25)
+    args = parser.parse_args()
+
+    summary = summarise(args.directory, args.route, args.limit)
+    if not summary['dumps']:
+        print(f"No profile dumps found in {args.directory}")
+
+    else:
+        print(f"{summary['dumps']} dumps, mean request time {summary['mean_elapsed_ms']:.1f} ms\n")
+        print(f"{'calls':>10} {'total s':>10} {'cumul. s':>10} {'per dump s':>11}  function")
+        for f in summary['functions']:
+            print(f"{f['calls']:>10} {f['total_s']:>10.4f} {f['cumulative_s']:>10.4f} "
+                  f"{f['cumulative_per_dump_s']:>11.4f}  {f['function']}")
@@ -0,0 +1,184 @@
+import mmap, os, struct, time, threading, fcntl, typing
+
+# Number of buckets in the shared file. Each is 32 bytes, so the default file is 128 KiB.
+SLOTS = 4096
+
+# Slots looked at for each key before the least recently used bucket among them is given to it
+_PROBES = 4
+
+# key, tokens, time tokens was last worked out, time the bucket will be full again
+_SLOT = struct.Struct('=qddd')
+
+# Keys are stored as (id << 1 | scope) + 1, so 0 marks an empty slot
+_USER = 0
+_CHATROOM = 1
+
+
+class RateLimitError(Exception):
+
+    def __init__(self, message, scope, retry_after):
+        super().__init__(message)
+        # 'user' or 'chatroom', and seconds until a message would be accepted
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Limit(typing.NamedTuple):
+    rate: float     # Tokens added per second
+    burst: int      # Most tokens a bucket holds, i.e. messages that can be sent at once after a quiet spell
+
+
+# Per-user limits by the sender's role in the chatroom; None means no limit
+DEFAULT_LIMITS = {'member': Limit(1.0, 10), 'owner': Limit(2.0, 20), 'admin': None}
+
+# Shared by everyone in a chatroom
+DEFAULT_CHATROOM_LIMIT = Limit(10.0, 50)
+
+
+class TokenBuckets:
+    """
+    Token buckets kept in a memory-mapped file, so every worker process that opens the same path shares them.
+
+    The file is a fixed-size hash table. A key's bucket is found among a few neighbouring slots; when they are all in
+    use by other keys, the one that will be full soonest is reused, since a full bucket is the same as a new one.
+    Updates take an exclusive lock on the file, which is held only while a few slots are read and written.
+    """
+
+    def __init__(self, path, slots=SLOTS):
+
+        self.__path = path
+        self.__slots = slots
+        self.__lock = threading.Lock()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size < slots * _SLOT.size:
+                os.ftruncate(fd, slots * _SLOT.size)
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+            self.__map = mmap.mmap(fd, slots * _SLOT.size)
+            # The mapping holds its own reference, but the descriptor is kept for locking
+            self.__fd = fd
+
+        except OSError:
+            os.close(fd)
+            raise
+
+    @property
+    def path(self):
+        return self.__path
+
+    def close(self):
+        self.__map.close()
+        os.close(self.__fd)
+
+    def take(self, buckets, now=None):
+        """
+        Takes a token from each bucket, but only if every one of them has a token to give, so a refused message
+        doesn't use up any of its buckets.
+        :param buckets: List of (key, Limit), where key is a positive integer
+        :return: None if the tokens were taken, or (index into buckets, seconds until it has a token) for the bucket
+            that refused
+        """
+
+        now = time.time() if now is None else now
+
+        # fcntl locks belong to the process, so threads also need to take turns
+        with self.__lock:
+            fcntl.lockf(self.__fd, fcntl.LOCK_EX)
+            try:
+                found = []
+
+                for i, (key, limit) in enumerate(buckets):
+                    slot, tokens = self.__find(key, limit, now, [f[0] for f in found])
+
+                    if tokens < 1:
+                        return i, (1 - tokens) / limit.rate
+
+                    found.append((slot, key, limit, tokens))
+
+                for slot, key, limit, tokens in found:
+                    tokens -= 1
+                    _SLOT.pack_into(self.__map, slot * _SLOT.size, key, tokens, now,
+                                    now + (limit.burst - tokens) / limit.rate)
+
+                return None
+
+            finally:
+                fcntl.lockf(self.__fd, fcntl.LOCK_UN)
+
+    def __find(self, key, limit, now, exclude):
+        # Returns the slot for key and the tokens its bucket holds now, without reusing the slots in exclude
+
+        start = (key * 11400714819323198485) % (1 << 64) % self.__slots
+        reuse = None
+
+        for probe in range(_PROBES):
+            slot = (start + probe) % self.__slots
+            slot_key, tokens, updated, full_at = _SLOT.unpack_from(self.__map, slot * _SLOT.size)
+
+            if slot_key == key:
+                # The clock may have gone backwards
+                return slot, min(limit.burst, tokens + max(0.0, now - updated) * limit.rate)
+
+            if slot not in exclude and (reuse is None or full_at < reuse[1]):
+                reuse = (slot, full_at if slot_key else 0.0)
+
+        if reuse is None:
+            # Only possible with fewer slots than buckets taken at once
+            raise ValueError("Not enough slots for the buckets requested")
+
+        return reuse[0], float(limit.burst)
+
+
+class RateLimiter:
+    """
+    Limits how often each user can send messages, and how many messages each chatroom accepts, with token buckets
+    shared by every worker process through a file (see TokenBuckets).
+    """
+
+    def __init__(self, path, limits=None, chatroom_limit=DEFAULT_CHATROOM_LIMIT, slots=SLOTS):
+        """
+        :param limits: Per-user Limit for each role ('member', 'owner' and 'admin'), or None for no limit for that role.
+            Roles left out get DEFAULT_LIMITS.
+        :param chatroom_limit: Limit shared by all senders in a chatroom, or None for no limit
+        """
+
+        self.__buckets = TokenBuckets(path, slots)
+        self.__limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.__chatroom_limit = chatroom_limit
+
+    @property
+    def limits(self):
+        return dict(self.__limits)
+
+    def close(self):
+        self.__buckets.close()
+
+    def check_send(self, userid, chatroomid, role='member'):
+        """
+        Takes a token for one message from the sender's bucket and the chatroom's bucket.
+        :param role: 'member', 'owner' or 'admin'
+        :raises RateLimitError: If either bucket is empty; neither token is taken
+        """
+
+        buckets = []
+        scopes = []
+
+        user_limit = self.__limits.get(role)
+        if user_limit:
+            buckets.append(((userid << 1 | _USER) + 1, user_limit))
+            scopes.append('user')
+
+        if self.__chatroom_limit:
+            buckets.append(((chatroomid << 1 | _CHATROOM) + 1, self.__chatroom_limit))
+            scopes.append('chatroom')
+
+        refused = self.__buckets.take(buckets) if buckets else None
+
+        if refused:
+            scope, retry_after = scopes[refused[0]], refused[1]
+            target = f"from userid {userid}" if scope == 'user' else f"in chatroomid {chatroomid}"
+            raise RateLimitError(f"ERROR: Too many messages {target}, try again in {retry_after:.1f}s.", scope,
+                                 retry_after)
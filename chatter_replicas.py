@@ -0,0 +1,132 @@
+import sqlite3, os, time, threading, itertools, urllib.parse, argparse
+
+
+class ReplicaManager:
+    """
+    Keeps read-only snapshot copies of a database file up to date using sqlite3's online backup API, and hands out
+    connections to them for reads that can tolerate slightly old data.
+
+    Each replica file's modification time is set to the moment its snapshot was taken, so any process can tell how
+    stale a replica is. That means one process can do the refreshing (see start() or running this module) while every
+    app worker reads from the replicas.
+    """
+
+    def __init__(self, primary_path, replica_paths, refresh_interval=5.0, factory=sqlite3.Connection):
+
+        self.__primary_path = primary_path
+        self.__replica_paths = list(replica_paths)
+        self.__refresh_interval = refresh_interval
+        # Connection class for reads, e.g. chatter_slowlog.TimedConnection
+        self.__factory = factory
+        self.__next_replica = itertools.cycle(range(len(self.__replica_paths)))
+        self.__local = threading.local()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    @property
+    def replica_paths(self):
+        return list(self.__replica_paths)
+
+    def get_staleness(self, replica_path):
+        # Seconds since the replica's snapshot was taken, or None if it has never been refreshed
+        try:
+            return time.time() - os.stat(replica_path).st_mtime
+
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        # Replicas are refreshed one at a time, so the others stay readable while each one is copied
+        for replica_path in self.__replica_paths:
+            self.refresh_replica(replica_path)
+
+    def refresh_replica(self, replica_path):
+
+        snapshot_time = time.time()
+
+        try:
+            source = sqlite3.connect(self.__primary_path)
+            destination = sqlite3.connect(replica_path)
+
+            source.backup(destination)
+
+            destination.close()
+            source.close()
+
+            os.utime(replica_path, (snapshot_time, snapshot_time))
+
+        except sqlite3.Error as e:
+            print(f"ERROR: Unable to refresh replica {replica_path}. Details:\n{e}")
+
+    def get_connection(self, max_staleness) -> sqlite3.Connection:
+        """
+        Finds a replica refreshed within the last max_staleness seconds, trying each in turn so reads are spread across
+        them.
+        :param max_staleness: How old, in seconds, the replica's data may be
+        :return: A read-only connection for the calling thread, or None if every replica is too stale
+        """
+
+        for i in range(len(self.__replica_paths)):
+            replica_path = self.__replica_paths[next(self.__next_replica)]
+            staleness = self.get_staleness(replica_path)
+
+            if staleness is not None and staleness <= max_staleness:
+                return self.__get_thread_connection(replica_path)
+
+        return None
+
+    def start(self):
+        # Refreshes every replica once immediately, then every refresh_interval seconds on a background thread
+
+        self.refresh()
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__refresh_loop, name="ReplicaManager", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def close(self):
+        # Closes the calling thread's replica connections
+        for dbcnx in getattr(self.__local, 'connections', {}).values():
+            dbcnx.close()
+        self.__local.connections = {}
+
+    def __refresh_loop(self):
+        while not self.__stop.wait(self.__refresh_interval):
+            self.refresh()
+
+    def __get_thread_connection(self, replica_path):
+
+        # sqlite3 connections can only be used by the thread that created them, so each thread gets its own
+        if not hasattr(self.__local, 'connections'):
+            self.__local.connections = {}
+
+        if replica_path not in self.__local.connections:
+            uri = 'file:' + urllib.parse.quote(os.path.abspath(replica_path)) + '?mode=ro'
+            dbcnx = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES, factory=self.__factory)
+            dbcnx.row_factory = sqlite3.Row
+            self.__local.connections[replica_path] = dbcnx
+
+        return self.__local.connections[replica_path]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Keep read-only replicas of a Chatter database up to date.")
+    parser.add_argument('primary', help="Path to the primary database, e.g. chatter_db.db")
+    parser.add_argument('replicas', nargs='+', help="Paths to the replica databases")
+    parser.add_argument('--interval', type=float, default=5.0, help="Seconds between refreshes (default 5)")
+    args = parser.parse_args()
+
+    manager = ReplicaManager(args.primary, args.replicas, args.interval)
+    print(f"Refreshing {len(args.replicas)} replicas of {args.primary} every {args.interval} seconds.")
+
+    while True:
+        manager.refresh()
+        time.sleep(args.interval)
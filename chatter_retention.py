@@ -0,0 +1,322 @@
+import sqlite3, datetime, time, os, threading, argparse
+import chatter_classes, chatter_archive, chatter_rollups
+
+# Messages deleted per transaction, and seconds to pause between transactions so requests waiting for the write lock
+# get a turn
+BATCH_SIZE = 500
+PAUSE = 0.05
+
+# Attachment files removed per transaction of the file queue
+FILE_BATCH_SIZE = 200
+
+# Free pages given back to the filesystem per incremental vacuum step
+VACUUM_PAGES = 1000
+
+# Seconds between runs of RetentionScheduler
+INTERVAL = 3600.0
+
+
+def create_retention_table(dbcnx:sqlite3.Connection):
+    # Lives alongside the Chatroom table (the catalog, for sharded databases). Chatrooms without a row keep everything.
+    dbcnx.execute('''CREATE TABLE IF NOT EXISTS ChatroomRetention (
+                        chatroomid INTEGER PRIMARY KEY,
+                        retention_days INTEGER NOT NULL,
+                        FOREIGN KEY (chatroomid) REFERENCES Chatroom(chatroomid)
+                    )''')
+
+
+def create_file_queue_table(dbcnx:sqlite3.Connection):
+    # Files of attachments whose rows have been deleted, queued in the same transaction as the delete so a crash can't
+    # leave a file behind with nothing pointing to it. Lives alongside the Attachment table.
+    dbcnx.execute('''CREATE TABLE IF NOT EXISTS AttachmentFileQueue (
+                        queueid INTEGER PRIMARY KEY AUTOINCREMENT,
+                        filepath TEXT NOT NULL
+                    )''')
+
+
+def get_policies(db, default_days=None):
+    """
+    :param default_days: Retention for chatrooms without a policy of their own, or None to keep their messages forever
+    :return: {chatroomid: retention_days} for every chatroom with messages to expire
+    """
+
+    if default_days is None:
+        rows = db.execute("SELECT chatroomid, retention_days FROM ChatroomRetention").fetchall()
+    else:
+        rows = db.execute("SELECT c.chatroomid, coalesce(r.retention_days, ?) FROM Chatroom AS c "
+                          "LEFT JOIN ChatroomRetention AS r ON r.chatroomid=c.chatroomid", [default_days]).fetchall()
+
+    return {row[0]: row[1] for row in rows}
+
+
+def purge_chatroom(db, chatroomid, before:datetime.datetime, batch_size=BATCH_SIZE, pause=PAUSE):
+    """
+    Deletes a chatroom's messages sent before a cutoff, live and archived, along with their attachments. Deletes are
+    done batch_size messages per transaction, pausing in between, so the write lock is never held for long. Attachment
+    files are queued for remove_queued_files() rather than removed here.
+    :return: The number of messages deleted
+    """
+
+    shard = chatter_classes.get_shard(db, chatroomid)
+    before_ts = int(round(before.timestamp(), 0))
+    purged = 0
+
+    while True:
+        try:
+            shard.execute("BEGIN IMMEDIATE")
+
+            rows = shard.execute("SELECT messageid, senderid, timestamp FROM Message WHERE chatroomid=? AND timestamp<? "
+                                 "ORDER BY timestamp LIMIT ?", [chatroomid, before_ts, batch_size]).fetchall()
+            if not rows:
+                shard.rollback()
+                break
+
+            c = shard.cursor()
+            c.executemany("DELETE FROM Message WHERE messageid=?", [[row[0]] for row in rows])
+            _remove_message_data(c, chatroomid, [(row[0], row[1], row[2]) for row in rows])
+            shard.commit()
+
+        except sqlite3.Error as e:
+            shard.rollback()
+            print(f"ERROR: Exception raised when purging messages from chatroomid {chatroomid}. "
+                  f"Database rolled back to last commit. Details:\n{e}")
+            raise e
+
+        purged += len(rows)
+        chatter_classes.notify_messages_purged(chatroomid, before_ts)
+        time.sleep(pause)
+
+    # Archived messages are removed a segment (one month of the chatroom's history) at a time. The segment file is
+    # only replaced once its index row and rollup counts have committed.
+    for segment in chatter_archive.get_segments_before(shard, chatroomid, before_ts):
+        new_path = None
+
+        try:
+            shard.execute("BEGIN IMMEDIATE")
+
+            removed, path, new_path = chatter_archive.remove_archived_messages(shard, segment, before_ts)
+            _remove_message_data(shard.cursor(), chatroomid,
+                                 [(m['messageid'], m['senderid'], m['timestamp']) for m in removed])
+            shard.commit()
+
+        except (sqlite3.Error, OSError) as e:
+            shard.rollback()
+            chatter_archive.discard_segment(new_path)
+            print(f"ERROR: Exception raised when purging archived messages from chatroomid {chatroomid}. "
+                  f"Database rolled back to last commit. Details:\n{e}")
+            raise e
+
+        chatter_archive.replace_segment(path, new_path)
+
+        purged += len(removed)
+        chatter_classes.notify_messages_purged(chatroomid, before_ts)
+        time.sleep(pause)
+
+    return purged
+
+
+def _remove_message_data(c:sqlite3.Cursor, chatroomid, messages):
+    # Deletes the attachments and rollup counts of messages being deleted, in the caller's transaction
+    # :param messages: List of (messageid, senderid, timestamp)
+
+    messageids = [[m[0]] for m in messages]
+    c.executemany("INSERT INTO AttachmentFileQueue (filepath) SELECT filepath FROM Attachment WHERE messageid=?",
+                  messageids)
+    c.executemany("DELETE FROM Attachment WHERE messageid=?", messageids)
+
+    counts = {}
+    for messageid, senderid, ts in messages:
+        key = (senderid, chatter_rollups.get_hour(ts))
+        counts[key] = counts.get(key, 0) + 1
+
+    for (senderid, hour), count in counts.items():
+        chatter_rollups.record_message(c, chatroomid, senderid, hour, -count)
+
+
+def remove_queued_files(shard:sqlite3.Connection, batch_size=FILE_BATCH_SIZE):
+    """
+    Removes the files of deleted attachments. Files that can't be removed (other than those already gone) stay queued
+    for the next run.
+    :return: The number of files removed
+    """
+
+    removed = 0
+    failed = set()
+
+    while True:
+        rows = shard.execute(f"SELECT queueid, filepath FROM AttachmentFileQueue "
+                             f"WHERE queueid NOT IN ({','.join('?' * len(failed))}) ORDER BY queueid LIMIT ?",
+                             list(failed) + [batch_size]).fetchall()
+        if not rows:
+            return removed
+
+        done = []
+        for queueid, filepath in rows:
+            try:
+                os.remove(filepath)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"WARNING: Could not remove attachment file {filepath}, leaving it queued. Details:\n{e}")
+                failed.add(queueid)
+                continue
+
+            done.append([queueid])
+
+        try:
+            shard.executemany("DELETE FROM AttachmentFileQueue WHERE queueid=?", done)
+            shard.commit()
+
+        except sqlite3.Error as e:
+            shard.rollback()
+            print(f"ERROR: Exception raised when updating the attachment file queue. Details:\n{e}")
+            raise e
+
+
+def incremental_vacuum(dbcnx:sqlite3.Connection, pages=VACUUM_PAGES, pause=PAUSE, deadline=None):
+    """
+    Gives the database's free pages back to the filesystem, pages at a time. Only works on databases using
+    auto_vacuum=INCREMENTAL (see enable_incremental_vacuum()); others are left alone.
+    :param deadline: time.monotonic() value after which no more steps are started
+    :return: The number of bytes given back
+    """
+
+    if dbcnx.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+
+    page_size = dbcnx.execute("PRAGMA page_size").fetchone()[0]
+    start = dbcnx.execute("PRAGMA freelist_count").fetchone()[0]
+    free = start
+
+    while free > 0 and (deadline is None or time.monotonic() < deadline):
+        # The pragma frees one page per step, and execute() only steps once, so it is run as a script
+        dbcnx.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+
+        free = dbcnx.execute("PRAGMA freelist_count").fetchone()[0]
+        if free > 0:
+            time.sleep(pause)
+
+    return (start - free) * page_size
+
+
+def enable_incremental_vacuum(dbcnx:sqlite3.Connection):
+    # Existing databases need a full VACUUM for the setting to take effect, which locks and rewrites the whole file
+
+    dbcnx.commit()
+    dbcnx.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    dbcnx.execute("VACUUM")
+
+
+def apply_retention(db, default_days=None, batch_size=BATCH_SIZE, pause=PAUSE, now:datetime.datetime=None):
+    """
+    Purges every chatroom's expired messages, removes the files of their attachments and gives the freed space back.
+    :return: {'purged': messages deleted, 'files_removed': files removed, 'bytes_reclaimed': bytes given back}
+    """
+
+    now = now or datetime.datetime.now()
+    result = {'purged': 0, 'files_removed': 0, 'bytes_reclaimed': 0}
+
+    for chatroomid, days in get_policies(db, default_days).items():
+        result['purged'] += purge_chatroom(db, chatroomid, now - datetime.timedelta(days=days), batch_size, pause)
+
+    for shard in chatter_classes.get_all_shards(db):
+        result['files_removed'] += remove_queued_files(shard)
+        result['bytes_reclaimed'] += incremental_vacuum(shard, pause=pause)
+
+    return result
+
+
+class RetentionScheduler:
+    """
+    Runs apply_retention() every interval seconds on a background thread. With several worker processes, turn it on
+    in only one of them or run this module from cron instead; running it in several is safe, just wasted work.
+    """
+
+    def __init__(self, connect, interval=INTERVAL, default_days=None, batch_size=BATCH_SIZE, pause=PAUSE,
+                 on_run=None):
+        """
+        :param connect: Function returning a new database connection (or chatter_shards.ShardRouter)
+        :param on_run: Called as on_run(result, seconds_taken) after each run, e.g. to record metrics
+        """
+
+        self.__connect = connect
+        self.__interval = interval
+        self.__default_days = default_days
+        self.__batch_size = batch_size
+        self.__pause = pause
+        self.__on_run = on_run
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__last_result = None
+
+    @property
+    def last_result(self):
+        return self.__last_result
+
+    def run(self):
+
+        started = time.perf_counter()
+        db = self.__connect()
+
+        try:
+            result = apply_retention(db, self.__default_days, self.__batch_size, self.__pause)
+        finally:
+            db.close()
+
+        self.__last_result = result
+        if self.__on_run:
+            self.__on_run(result, time.perf_counter() - started)
+
+        return result
+
+    def start(self):
+        # The first run is after one interval, so starting a worker doesn't start a purge straight away
+
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run_loop, name='chatter-retention', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+
+    def __run_loop(self):
+
+        while not self.__stop.wait(self.__interval):
+            try:
+                self.run()
+            except (sqlite3.Error, OSError) as e:
+                # Tried again next interval
+                print(f"ERROR: Retention run failed. Details:\n{e}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Delete messages older than each chatroom's retention period.")
+    parser.add_argument('database', help="Path to the database file (the catalog, if sharded)")
+    parser.add_argument('--shards', nargs='*', default=[], help="Shard database files, if sharded")
+    parser.add_argument('--default-days', type=int, help="Retention for chatrooms without a policy of their own")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--pause', type=float, default=PAUSE)
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help="Switch the databases to auto_vacuum=INCREMENTAL first (runs a full VACUUM)")
+    args = parser.parse_args()
+
+    if args.shards:
+        import chatter_shards
+        dbcnx = chatter_shards.ShardRouter(args.database, args.shards)
+    else:
+        dbcnx = sqlite3.connect(args.database, detect_types=sqlite3.PARSE_DECLTYPES)
+        dbcnx.row_factory = sqlite3.Row
+
+    if args.enable_incremental_vacuum:
+        for shard in chatter_classes.get_all_shards(dbcnx):
+            enable_incremental_vacuum(shard)
+
+    totals = apply_retention(dbcnx, args.default_days, args.batch_size, args.pause)
+    print(f"Success: Purged {totals['purged']} messages, removed {totals['files_removed']} attachment files and "
+          f"reclaimed {totals['bytes_reclaimed']} bytes.")
+    dbcnx.close()
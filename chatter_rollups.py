@@ -0,0 +1,146 @@
+import sqlite3, datetime, argparse
+import chatter_archive
+
+# Messages are counted per chatroom, sender and period of this many seconds
+ROLLUP_SECONDS = 3600
+
+
+def create_rollup_table(dbcnx:sqlite3.Connection):
+    # Lives alongside the Message table (in each shard, for sharded databases) so it is updated in the same transaction
+    c = dbcnx.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS MessageRollup (
+                    chatroomid INTEGER NOT NULL,
+                    senderid INTEGER NOT NULL,
+                    hour INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    PRIMARY KEY (chatroomid, senderid, hour)
+                ) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messagerollup_hour ON MessageRollup (hour)")
+
+
+def get_hour(ts):
+    # Start of the rollup period containing the Unix time ts
+    return int(ts) // ROLLUP_SECONDS * ROLLUP_SECONDS
+
+
+def record_message(c:sqlite3.Cursor, chatroomid, senderid, ts, change=1):
+    """
+    Adds change to the count of messages sent by senderid in chatroomid during the hour containing ts. Runs in the
+    caller's transaction, so it should be called before the insert or delete it counts is committed.
+    :return: False if the database has no MessageRollup table (it was created before rollups existed), True otherwise
+    """
+
+    try:
+        c.execute("INSERT INTO MessageRollup (chatroomid, senderid, hour, message_count) VALUES (?, ?, ?, ?) "
+                  "ON CONFLICT (chatroomid, senderid, hour) DO UPDATE SET message_count=message_count+excluded.message_count",
+                  [chatroomid, senderid, get_hour(ts), change])
+
+        if change < 0:
+            c.execute("DELETE FROM MessageRollup WHERE chatroomid=? AND senderid=? AND hour=? AND message_count<=0",
+                      [chatroomid, senderid, get_hour(ts)])
+
+    except sqlite3.OperationalError as e:
+        # A failed statement leaves the rest of the transaction alone. Running rebuild_rollups() adds the table.
+        if 'no such table' in str(e):
+            return False
+        raise e
+
+    return True
+
+
+def rebuild_rollups(db:sqlite3.Connection, since:datetime.datetime=None):
+    """
+    Recounts the rollups from the Message table and the archive, for history loaded without going through
+    Message.add() (e.g. bulk imports) or from before the rollup table existed. Safe to run at any time.
+    :param since: Only recount hours from this time onwards, or None to recount everything
+    :return: The number of rollup rows written
+    """
+
+    start = get_hour(since.timestamp()) if since else 0
+
+    try:
+        create_rollup_table(db)
+        c = db.cursor()
+
+        # Write lock first so messages added while counting wait until the new counts are in place
+        if not db.in_transaction:
+            c.execute("BEGIN IMMEDIATE")
+
+        c.execute("DELETE FROM MessageRollup WHERE hour>=?", [start])
+
+        counts = {}
+        for row in c.execute("SELECT chatroomid, senderid, CAST(timestamp AS INTEGER) / ? * ? AS hour, count(*) "
+                             "FROM Message WHERE timestamp>=? GROUP BY 1, 2, 3",
+                             [ROLLUP_SECONDS, ROLLUP_SECONDS, start]):
+            counts[(row[0], row[1], row[2])] = row[3]
+
+        # Archived messages still count; they have only been moved out of the Message table
+        for m in chatter_archive.iter_archived_messages(db, start - 1):
+            if m['timestamp'] >= start:
+                key = (m['chatroomid'], m['senderid'], get_hour(m['timestamp']))
+                counts[key] = counts.get(key, 0) + 1
+
+        c.executemany("INSERT INTO MessageRollup (chatroomid, senderid, hour, message_count) VALUES (?, ?, ?, ?) "
+                      "ON CONFLICT (chatroomid, senderid, hour) "
+                      "DO UPDATE SET message_count=message_count+excluded.message_count",
+                      [key + (count,) for key, count in counts.items()])
+
+        db.commit()
+
+        return len(counts)
+
+    except sqlite3.Error as e:
+        db.rollback()
+        print(f"ERROR: Unable to rebuild message rollups. Details:\n{e}")
+        raise e
+
+
+def copy_rollups(source:sqlite3.Connection, destination:sqlite3.Connection, chatroomid):
+    # For moving a chatroom between shards; the caller commits destination and then deletes from source
+
+    rows = source.execute("SELECT chatroomid, senderid, hour, message_count FROM MessageRollup WHERE chatroomid=?",
+                          [chatroomid]).fetchall()
+
+    destination.executemany("INSERT INTO MessageRollup (chatroomid, senderid, hour, message_count) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (chatroomid, senderid, hour) "
+                            "DO UPDATE SET message_count=message_count+excluded.message_count",
+                            [tuple(r) for r in rows])
+
+
+def get_chatroom_counts(db:sqlite3.Connection, since_ts=0):
+    # {chatroomid: message count} for every chatroom with messages since the start of the hour containing since_ts
+
+    return dict(db.execute("SELECT chatroomid, sum(message_count) FROM MessageRollup WHERE hour>=? GROUP BY chatroomid",
+                           [get_hour(since_ts)]).fetchall())
+
+
+def get_sender_counts(db:sqlite3.Connection, chatroomid, since_ts=0):
+    # {senderid: message count} for one chatroom
+
+    return dict(db.execute("SELECT senderid, sum(message_count) FROM MessageRollup WHERE chatroomid=? AND hour>=? "
+                           "GROUP BY senderid", [chatroomid, get_hour(since_ts)]).fetchall())
+
+
+def get_hourly_counts(db:sqlite3.Connection, chatroomid, since_ts=0):
+    # [(hour, message count), ...] for one chatroom, oldest first, leaving out hours with no messages
+
+    return [tuple(r) for r in db.execute("SELECT hour, sum(message_count) FROM MessageRollup "
+                                         "WHERE chatroomid=? AND hour>=? GROUP BY hour ORDER BY hour",
+                                         [chatroomid, get_hour(since_ts)]).fetchall()]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Recount the hourly message rollups from the Message table.")
+    parser.add_argument('databases', nargs='+', help="Database files to recount (every shard, if sharded)")
+    parser.add_argument('--days', type=int, help="Only recount the last this many days (default everything)")
+    args = parser.parse_args()
+
+    since = datetime.datetime.now() - datetime.timedelta(days=args.days) if args.days else None
+
+    for path in args.databases:
+        dbcnx = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        dbcnx.row_factory = sqlite3.Row
+
+        print(f"Success: Wrote {rebuild_rollups(dbcnx, since)} rollup rows for {path}.")
+        dbcnx.close()
@@ -0,0 +1,317 @@
+import os, json, time, datetime, threading, fcntl, sqlite3
+import chatter_classes
+
+# Messages added to the Message table per transaction (per shard)
+BATCH_SIZE = 500
+
+# Once everything in the log has been applied, it is emptied if it has grown beyond this
+MAX_LOG_BYTES = 1 << 20
+
+# Seconds to wait before trying a batch again after a database error (e.g. the database is locked)
+RETRY_INTERVAL = 1.0
+
+_SUFFIX = '.log'
+
+
+class SendLogError(Exception):
+    pass
+
+
+def create_checkpoint_table(dbcnx:sqlite3.Connection):
+    # The last sequence number applied from each log, kept in each shard and updated in the same transaction as the
+    # messages, so replaying a log after a crash never adds a message twice
+    dbcnx.execute("CREATE TABLE IF NOT EXISTS SendLogCheckpoint (log TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+
+
+class SendLog:
+    """
+    An append-only log of sent messages, so a send can be acknowledged once the message is on local disk instead of
+    waiting for the SQLite write lock. Each worker process writes its own log file in a shared directory.
+
+    append() writes the message, waits for it to be fsynced and returns a chatter_classes.PendingMessage. Sends arriving
+    together share one fsync: whichever thread gets to sync first syncs everything written so far. A background thread
+    then adds logged messages to the Message table in large transactions (chatter_classes.Message.add_many()), after
+    which they are published as usual, followed by a 'message_applied' event linking the provisional id to the real one.
+
+    Each log file is locked while its process is running. When the applier starts, it replays the entries not yet
+    applied from any unlocked log left behind by a process that crashed, then removes it.
+
+    Until applied, messages are only visible to readers in the process that logged them (see get_pending()). Applying
+    normally takes a few milliseconds, so other processes miss them only briefly.
+    """
+
+    def __init__(self, directory, connect, batch_size=BATCH_SIZE, max_log_bytes=MAX_LOG_BYTES):
+        """
+        :param connect: Function returning a new database connection (or chatter_shards.ShardRouter), for the applier
+        """
+
+        self.__directory = directory
+        self.__connect = connect
+        self.__batch_size = batch_size
+        self.__max_log_bytes = max_log_bytes
+        self.__name = f"{os.getpid()}-{int(time.time() * 1000)}"
+
+        # Appends hold the write lock; fsyncs hold the sync lock so appends can carry on while one is running
+        self.__write_lock = threading.Lock()
+        self.__sync_lock = threading.Lock()
+        # Wakes the applier, and anything waiting in flush()
+        self.__condition = threading.Condition()
+
+        self.__written_seq = 0
+        self.__synced_seq = 0
+        self.__applied_seq = 0
+        # seq -> PendingMessage for messages written but not yet applied, oldest first
+        self.__pending = {}
+        self.__thread = None
+        self.__stopping = False
+        self.__error = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.__file = open(os.path.join(directory, self.__name + _SUFFIX), 'ab')
+        fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def stats(self):
+        with self.__condition:
+            return {'written': self.__written_seq, 'synced': self.__synced_seq, 'applied': self.__applied_seq,
+                    'pending': len(self.__pending), 'last_error': str(self.__error) if self.__error else None}
+
+    def start(self):
+
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__apply_loop, name='chatter-sendlog', daemon=True)
+            self.__thread.start()
+
+    def append(self, content, chatroomid, senderid) -> chatter_classes.PendingMessage:
+        """
+        Logs a message and returns once it is on disk. The caller has already checked the sender may send it.
+        """
+
+        ts = int(round(datetime.datetime.now().timestamp(), 0))
+
+        with self.__write_lock:
+            if self.__stopping:
+                raise SendLogError("ERROR: The send log has been closed.")
+
+            self.__written_seq += 1
+            seq = self.__written_seq
+            message = chatter_classes.PendingMessage(f"{self.__name}:{seq}", content, chatroomid, senderid, ts)
+
+            self.__file.write(json.dumps({'seq': seq, 'content': content, 'chatroomid': chatroomid,
+                                          'senderid': senderid, 'timestamp': ts}).encode() + b"\n")
+
+            with self.__condition:
+                self.__pending[seq] = message
+
+        self.__sync(seq)
+
+        return message
+
+    def __sync(self, seq):
+
+        with self.__sync_lock:
+            # Another thread's fsync may already have covered this entry
+            if self.__synced_seq >= seq:
+                return
+
+            with self.__write_lock:
+                self.__file.flush()
+                target = self.__written_seq
+
+            os.fsync(self.__file.fileno())
+
+            with self.__condition:
+                self.__synced_seq = target
+                self.__condition.notify_all()
+
+    def get_pending(self, chatroomid):
+        # PendingMessages for the chatroom that have been logged but not applied, oldest first
+
+        with self.__condition:
+            return [m for m in self.__pending.values() if m.chatroomid == chatroomid]
+
+    def flush(self, timeout=None):
+        """
+        Waits until every message logged so far has been added to the Message table.
+        :return: True if they have, False if the timeout passed first
+        """
+
+        with self.__write_lock:
+            seq = self.__written_seq
+
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__applied_seq >= seq, timeout)
+
+    def close(self, timeout=None):
+        # Stops taking messages, applies those already logged and removes the log if nothing is left in it
+
+        with self.__write_lock:
+            self.__stopping = True
+
+        with self.__condition:
+            self.__condition.notify_all()
+
+        if self.__thread:
+            self.__thread.join(timeout)
+
+        with self.__condition:
+            finished = not self.__pending
+
+        path = self.__file.name
+        self.__file.close()
+
+        if finished:
+            os.remove(path)
+
+            db = self.__connect()
+            try:
+                delete_checkpoints(db, self.__name)
+            except sqlite3.Error as e:
+                print(f"ERROR: Unable to remove send log checkpoints for {self.__name}. Details:\n{e}")
+            finally:
+                db.close()
+
+    def __apply_loop(self):
+
+        db = self.__connect()
+
+        try:
+            try:
+                for shard in chatter_classes.get_all_shards(db):
+                    create_checkpoint_table(shard)
+                    shard.commit()
+
+                self.__recover(db)
+
+            except sqlite3.Error as e:
+                # Logs that couldn't be replayed are left for the next process to start
+                self.__error = e
+                print(f"ERROR: Unable to replay send logs. Details:\n{e}")
+
+            while True:
+                with self.__condition:
+                    self.__condition.wait_for(lambda: self.__synced_seq > self.__applied_seq or
+                                              (self.__stopping and self.__synced_seq == self.__written_seq))
+
+                    if self.__synced_seq == self.__applied_seq:
+                        # Stopping, and everything has been applied
+                        return
+
+                    batch = [(seq, m) for seq, m in self.__pending.items()
+                             if seq <= self.__synced_seq][:self.__batch_size]
+
+                try:
+                    apply_entries(db, self.__name, batch)
+
+                except sqlite3.Error as e:
+                    self.__error = e
+                    if self.__stopping:
+                        # Left in the log, to be replayed by the next process to start
+                        return
+                    time.sleep(RETRY_INTERVAL)
+                    continue
+
+                with self.__condition:
+                    for seq, m in batch:
+                        del self.__pending[seq]
+                    self.__applied_seq = batch[-1][0]
+                    self.__error = None
+                    self.__condition.notify_all()
+
+                self.__maybe_truncate()
+
+        finally:
+            db.close()
+
+    def __maybe_truncate(self):
+
+        with self.__write_lock:
+            if self.__applied_seq == self.__written_seq and self.__file.tell() > self.__max_log_bytes:
+                self.__file.truncate(0)
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+
+    def __recover(self, db):
+        # Replays logs left behind by processes that stopped without applying everything
+
+        for filename in sorted(os.listdir(self.__directory)):
+            name = filename[:-len(_SUFFIX)]
+            if not filename.endswith(_SUFFIX) or name == self.__name:
+                continue
+
+            with open(os.path.join(self.__directory, filename), 'rb') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its process is still running
+                    continue
+
+                entries = read_entries(f)
+                for i in range(0, len(entries), self.__batch_size):
+                    apply_entries(db, name, entries[i:i + self.__batch_size])
+
+                # The log goes before its checkpoints, so a crash in between can't leave it to be replayed from the
+                # start; at worst its checkpoint rows are left behind
+                os.remove(f.name)
+                delete_checkpoints(db, name)
+
+            print(f"Success: Replayed {len(entries)} logged messages from {filename}.")
+
+
+def delete_checkpoints(db, log):
+
+    for shard in chatter_classes.get_all_shards(db):
+        shard.execute("DELETE FROM SendLogCheckpoint WHERE log=?", [log])
+        shard.commit()
+
+
+def read_entries(f):
+    # [(seq, PendingMessage), ...] from a log file, leaving out a last line cut short by a crash
+
+    name = os.path.basename(f.name)[:-len(_SUFFIX)]
+    entries = []
+
+    for line in f:
+        try:
+            e = json.loads(line)
+        except ValueError:
+            break
+
+        entries.append((e['seq'], chatter_classes.PendingMessage(f"{name}:{e['seq']}", e['content'], e['chatroomid'],
+                                                                 e['senderid'], e['timestamp'])))
+
+    return entries
+
+
+def apply_entries(db, log, entries):
+    """
+    Adds logged messages to the Message table, skipping any that an earlier attempt already added, and records how
+    far through the log each shard has got in the same transaction.
+    :param entries: [(seq, PendingMessage), ...] in sequence order
+    """
+
+    checkpoints = {}
+    for shard in {chatter_classes.get_shard(db, m.chatroomid) for seq, m in entries}:
+        row = shard.execute("SELECT seq FROM SendLogCheckpoint WHERE log=?", [log]).fetchone()
+        checkpoints[shard] = row[0] if row else 0
+
+    entries = [(seq, m) for seq, m in entries if seq > checkpoints[chatter_classes.get_shard(db, m.chatroomid)]]
+    if not entries:
+        return []
+
+    def record_checkpoint(shard, c, indexes):
+        c.execute("INSERT INTO SendLogCheckpoint (log, seq) VALUES (?, ?) ON CONFLICT (log) DO UPDATE SET seq=excluded.seq",
+                  [log, max(entries[i][0] for i in indexes)])
+
+    messageids = chatter_classes.Message.add_many([(m.content, m.chatroomid, m.senderid, m.timestamp)
+                                                   for seq, m in entries], db, record_checkpoint)
+
+    for (seq, m), messageid in zip(entries, messageids):
+        chatter_classes.publish(m.chatroomid, {'type': 'message_applied', 'chatroomid': m.chatroomid,
+                                               'messageid': messageid, 'provisionalid': m.messageid})
+
+    return messageids
@@ -0,0 +1,399 @@
+import sqlite3, os, argparse, shutil
+import chatter_rollups, chatter_migrations
+
+# Each shard hands out message and attachment ids from its own block of this size, so ids stay unique across shards
+SHARD_ID_RANGE = 10 ** 12
+
+# Tables that live in every shard rather than in the shared catalog
+SHARDED_TABLES = ('Message', 'Attachment')
+
+
+class ShardError(Exception):
+    pass
+
+
+def connect(path, factory=sqlite3.Connection):
+    dbcnx = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, factory=factory)
+    dbcnx.row_factory = sqlite3.Row
+    return dbcnx
+
+
+class ShardRouter:
+    """
+    Connection provider for a database split across several SQLite files. User, Chatroom and ChatroomMember data stays
+    in one shared catalog database, while each chatroom's Message and Attachment rows live in one of the shard
+    databases, so writes to chatrooms on different shards do not wait on each other's writer lock.
+
+    A ShardRouter can be passed anywhere chatter_classes expects a database connection. cursor(), execute(), commit()
+    and rollback() act on the catalog; chatroom-scoped queries are sent to shard_for_chatroom().
+    """
+
+    def __init__(self, catalog_path, shard_paths, factory=sqlite3.Connection):
+
+        if not shard_paths:
+            raise ShardError("ERROR: At least one shard database is required.")
+
+        self.__catalog = connect(catalog_path, factory)
+        self.__shards = [connect(p, factory) for p in shard_paths]
+
+        # chatroomid -> shard index, saving a catalog lookup for every message of the same chatroom
+        self.__placements = {}
+
+    @property
+    def catalog(self):
+        return self.__catalog
+
+    @property
+    def shards(self):
+        return list(self.__shards)
+
+    def cursor(self):
+        return self.__catalog.cursor()
+
+    def execute(self, sql, parameters=()):
+        return self.__catalog.execute(sql, parameters)
+
+    def commit(self):
+        self.__catalog.commit()
+
+    def rollback(self):
+        self.__catalog.rollback()
+
+    def close(self):
+        self.__catalog.close()
+        for shard in self.__shards:
+            shard.close()
+
+    def get_shard_index(self, chatroomid):
+
+        if chatroomid not in self.__placements:
+            # Chatrooms placed by rebalance() have an explicit entry; any others are placed by id
+            row = self.__catalog.execute("SELECT shard FROM ChatroomShard WHERE chatroomid=?", [chatroomid]).fetchone()
+
+            if row and row['shard'] < len(self.__shards):
+                self.__placements[chatroomid] = row['shard']
+            else:
+                self.__placements[chatroomid] = int(chatroomid) % len(self.__shards)
+
+        return self.__placements[chatroomid]
+
+    def clear_placements(self):
+        self.__placements.clear()
+
+    def shard_for_chatroom(self, chatroomid) -> sqlite3.Connection:
+        return self.__shards[self.get_shard_index(chatroomid)]
+
+    def shards_for_id(self, rowid):
+        # The shard that allocated an id is the most likely place to find it, but rebalancing may have moved it since
+        first = (int(rowid) - 1) // SHARD_ID_RANGE
+        if 0 <= first < len(self.__shards):
+            return [self.__shards[first]] + [s for i, s in enumerate(self.__shards) if i != first]
+
+        return list(self.__shards)
+
+    def allocate_id(self, shard:sqlite3.Connection, table):
+        """
+        Reserves the next id for a new row in one of the SHARDED_TABLES. This opens a write transaction on the shard,
+        which the caller should commit along with the insert that uses the id.
+        :param shard: Shard connection that the row will be inserted into
+        :param table: 'Message' or 'Attachment'
+        :return: The reserved id
+        """
+
+        c = shard.cursor()
+        c.execute("UPDATE ShardSequence SET next_id=next_id+1 WHERE name=?", [table])
+        return c.execute("SELECT next_id-1 AS new_id FROM ShardSequence WHERE name=?", [table]).fetchone()['new_id']
+
+
+def init_sharded_db(catalog_path, shard_paths):
+    """
+    Creates empty catalog and shard databases. Any existing data in them is erased.
+    """
+
+    # Imported here as init_db opens its own default database when imported
+    import init_db
+
+    catalog = connect(catalog_path)
+    init_db.reset_schema_version(catalog)
+    init_db.create_user_table(catalog)
+    init_db.create_chatroom_table(catalog)
+    init_db.create_chatroommember_table(catalog)
+    create_chatroomshard_table(catalog)
+    chatter_migrations.migrate(catalog)
+    catalog.close()
+
+    for index, path in enumerate(shard_paths):
+        shard = connect(path)
+        # See init_db.init_db()
+        shard.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        init_db.reset_schema_version(shard)
+        init_db.create_message_table(shard)
+        init_db.create_attachment_table(shard)
+        init_db.create_message_archive_table(shard)
+        init_db.create_message_rollup_table(shard)
+        create_shardsequence_table(shard, index)
+        chatter_migrations.migrate(shard)
+        shard.close()
+
+
+def create_chatroomshard_table(dbcnx:sqlite3.Connection):
+
+    try:
+        c = dbcnx.cursor()
+        c.execute("DROP TABLE IF EXISTS ChatroomShard")
+        c.execute('''CREATE TABLE ChatroomShard (
+                        chatroomid INTEGER PRIMARY KEY,
+                        shard INTEGER NOT NULL
+                    )''')
+        dbcnx.commit()
+        print("Success: ChatroomShard table initialised.")
+
+    except sqlite3.Error as e:
+        dbcnx.rollback()
+        print("ERROR: Unable to create ChatroomShard table. Details:", e)
+        raise e
+
+
+def create_shardsequence_table(dbcnx:sqlite3.Connection, shard_index):
+
+    try:
+        c = dbcnx.cursor()
+        c.execute("DROP TABLE IF EXISTS ShardSequence")
+        c.execute('''CREATE TABLE ShardSequence (
+                        name TEXT PRIMARY KEY,
+                        next_id INTEGER NOT NULL
+                    )''')
+
+        # Shard 0 carries on from any ids already in use, so an existing single database can become shard 0
+        for table in SHARDED_TABLES:
+            start = shard_index * SHARD_ID_RANGE + 1
+            if shard_index == 0:
+                start = max(start, c.execute(f"SELECT coalesce(max(rowid), 0) + 1 FROM {table}").fetchone()[0])
+            c.execute("INSERT INTO ShardSequence VALUES (?, ?)", [table, start])
+
+        dbcnx.commit()
+        print(f"Success: ShardSequence table initialised for shard {shard_index}.")
+
+    except sqlite3.Error as e:
+        dbcnx.rollback()
+        print("ERROR: Unable to create ShardSequence table. Details:", e)
+        raise e
+
+
+def get_chatroom_message_counts(router:ShardRouter):
+    # {chatroomid: {shard index: message count}} for every chatroom that has messages on any shard
+
+    counts = {}
+
+    for index, shard in enumerate(router.shards):
+        for row in shard.execute("SELECT chatroomid, count(*) AS message_count FROM Message GROUP BY chatroomid"):
+            counts.setdefault(row['chatroomid'], {})[index] = row['message_count']
+
+    return counts
+
+
+def plan_rebalance(router:ShardRouter, tolerance=0.1):
+    """
+    Works out where each chatroom should live so that message counts are spread evenly across the shards. Chatrooms
+    stay where they are unless their shard is overloaded, and the largest chatroom that can be moved without
+    overshooting is moved first, so as few messages as possible are copied.
+    :param router: Sharded database
+    :param tolerance: Fraction of the average shard size that shards may differ by before chatrooms are moved
+    :return: Dictionary of {chatroomid: target shard index}
+    """
+
+    counts = get_chatroom_message_counts(router)
+    targets = {chatroomid: router.get_shard_index(chatroomid) for chatroomid in counts}
+    sizes = {chatroomid: sum(shard_counts.values()) for chatroomid, shard_counts in counts.items()}
+
+    loads = [0] * len(router.shards)
+    for chatroomid, shard in targets.items():
+        loads[shard] += sizes[chatroomid]
+
+    average = sum(loads) / len(loads)
+
+    while True:
+        heaviest = loads.index(max(loads))
+        lightest = loads.index(min(loads))
+        gap = loads[heaviest] - loads[lightest]
+
+        if gap <= tolerance * average:
+            break
+
+        # Moving a chatroom of size s changes the gap to |gap - 2s|, so only chatrooms smaller than the gap help
+        candidates = [c for c, shard in targets.items() if shard == heaviest and 0 < sizes[c] < gap]
+        if not candidates:
+            break
+
+        chatroomid = max(candidates, key=lambda c: sizes[c])
+        targets[chatroomid] = lightest
+        loads[heaviest] -= sizes[chatroomid]
+        loads[lightest] += sizes[chatroomid]
+
+    return targets
+
+
+def move_chatroom(router:ShardRouter, chatroomid, target):
+    """
+    Moves all of a chatroom's messages, attachments, archive segments and rollups to another shard and records the chatroom's
+    new location in the catalog. Messages keep their ids, and if they came from a higher block than the destination's,
+    the destination moves on to a new block (see _raise_sequence()) so the chatroom's ids keep rising.
+
+    Source shards are write-locked while their rows are copied, but a process that looked up the chatroom's location
+    just before the move could still write to the old shard afterwards, so this is best run while the app is quiet.
+    """
+
+    destination = router.shards[target]
+
+    try:
+        for index, source in enumerate(router.shards):
+            if index == target:
+                continue
+
+            source.execute("BEGIN IMMEDIATE")
+
+            messages = source.execute("SELECT messageid, content, chatroomid, senderid, timestamp FROM Message "
+                                      "WHERE chatroomid=?", [chatroomid]).fetchall()
+            attachments = source.execute("SELECT attachmentid, messageid, filepath FROM Attachment WHERE messageid IN "
+                                         "(SELECT messageid FROM Message WHERE chatroomid=?)", [chatroomid]).fetchall()
+            segments = _get_archive_segments(source, chatroomid)
+
+            if not messages and not attachments and not segments:
+                source.rollback()
+                continue
+
+            destination.executemany("INSERT INTO Message VALUES (?, ?, ?, ?, ?)", [tuple(m) for m in messages])
+            destination.executemany("INSERT INTO Attachment VALUES (?, ?, ?)", [tuple(a) for a in attachments])
+            _copy_archive_segments(source, destination, segments)
+            _raise_sequence(router, destination, 'Message',
+                            max([m['messageid'] for m in messages] + [s['last_messageid'] for s in segments] + [0]))
+            _raise_sequence(router, destination, 'Attachment', max([a['attachmentid'] for a in attachments] + [0]))
+            chatter_rollups.copy_rollups(source, destination, chatroomid)
+            destination.commit()
+
+            source.execute("DELETE FROM Attachment WHERE messageid IN "
+                           "(SELECT messageid FROM Message WHERE chatroomid=?)", [chatroomid])
+            source.execute("DELETE FROM Message WHERE chatroomid=?", [chatroomid])
+            if segments:
+                source.execute("DELETE FROM MessageArchive WHERE chatroomid=?", [chatroomid])
+            source.execute("DELETE FROM MessageRollup WHERE chatroomid=?", [chatroomid])
+            source.commit()
+
+            _remove_archive_segments(source, segments)
+
+            print(f"Success: Moved {len(messages)} messages for chatroomid {chatroomid} "
+                  f"from shard {index} to shard {target}.")
+
+        router.execute("INSERT OR REPLACE INTO ChatroomShard (chatroomid, shard) VALUES (?, ?)", [chatroomid, target])
+        router.commit()
+        router.clear_placements()
+
+    except sqlite3.Error as e:
+        for shard in router.shards:
+            shard.rollback()
+        router.rollback()
+        print(f"ERROR: Exception raised when moving chatroomid {chatroomid} to shard {target}. Details:\n{e}")
+        raise e
+
+
+def _raise_sequence(router:ShardRouter, destination:sqlite3.Connection, table, moved_id):
+    """
+    Makes sure the destination's next id is above moved_id, in the move's transaction. Raising it to just above moved_id
+    could run into the block another shard allocates from, so it skips to the start of the first block above every
+    shard's sequence, which no shard has used. Moves are run one at a time, so no other shard can take that block first.
+    """
+
+    if moved_id < destination.execute("SELECT next_id FROM ShardSequence WHERE name=?", [table]).fetchone()['next_id']:
+        return
+
+    highest = max(shard.execute("SELECT next_id FROM ShardSequence WHERE name=?", [table]).fetchone()['next_id']
+                  for shard in router.shards)
+
+    destination.execute("UPDATE ShardSequence SET next_id=? WHERE name=?",
+                        [((highest - 1) // SHARD_ID_RANGE + 1) * SHARD_ID_RANGE + 1, table])
+
+
+def rebalance(router:ShardRouter, targets=None):
+    """
+    Moves chatrooms between shards. Chatrooms are found wherever their messages currently are, so this can also be
+    used after adding shards or changing the order of the shard files.
+    :param router: Sharded database
+    :param targets: Dictionary of {chatroomid: shard index}, by default from plan_rebalance()
+    :return: The number of chatrooms moved
+    """
+
+    if targets is None:
+        targets = plan_rebalance(router)
+
+    counts = get_chatroom_message_counts(router)
+    moved = 0
+
+    for chatroomid, target in targets.items():
+        if set(counts.get(chatroomid, {})) - {target} or router.get_shard_index(chatroomid) != target:
+            move_chatroom(router, chatroomid, target)
+            moved += 1
+
+    return moved
+
+
+def _get_archive_segments(shard:sqlite3.Connection, chatroomid):
+
+    if not shard.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='MessageArchive'").fetchone():
+        return []
+
+    return shard.execute("SELECT chatroomid, month, filename, first_messageid, last_messageid, first_ts, last_ts, "
+                         "message_count FROM MessageArchive WHERE chatroomid=?", [chatroomid]).fetchall()
+
+
+def _copy_archive_segments(source:sqlite3.Connection, destination:sqlite3.Connection, segments):
+
+    if not segments:
+        return
+
+    # Imported here to keep this module usable on its own for routing
+    import chatter_archive
+
+    source_dir = chatter_archive.get_archive_dir(source)
+    destination_dir = chatter_archive.get_archive_dir(destination)
+    os.makedirs(destination_dir, exist_ok=True)
+
+    chatter_archive.create_archive_table(destination)
+
+    for segment in segments:
+        shutil.copyfile(os.path.join(source_dir, segment['filename']),
+                        os.path.join(destination_dir, segment['filename']))
+        destination.execute("INSERT OR REPLACE INTO MessageArchive (chatroomid, month, filename, first_messageid, "
+                            "last_messageid, first_ts, last_ts, message_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            tuple(segment))
+
+
+def _remove_archive_segments(shard:sqlite3.Connection, segments):
+
+    if not segments:
+        return
+
+    import chatter_archive
+
+    for segment in segments:
+        try:
+            os.remove(os.path.join(chatter_archive.get_archive_dir(shard), segment['filename']))
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Create or rebalance a sharded Chatter database.")
+    parser.add_argument('catalog', help="Path to the catalog database holding users, chatrooms and memberships")
+    parser.add_argument('shards', nargs='+', help="Paths to the shard databases, in order")
+    parser.add_argument('--init', action='store_true', help="Create empty catalog and shard databases")
+    parser.add_argument('--rebalance', action='store_true', help="Spread chatrooms evenly across the shards")
+    args = parser.parse_args()
+
+    if args.init:
+        init_sharded_db(args.catalog, args.shards)
+
+    if args.rebalance:
+        r = ShardRouter(args.catalog, args.shards)
+        print(f"Success: Moved {rebalance(r)} chatrooms.")
+        r.close()
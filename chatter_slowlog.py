@@ -0,0 +1,215 @@
+import sqlite3, os, sys, time, json, threading, collections, logging
+import chatter_sqltrace
+
+THRESHOLD_MS = 100.0
+
+# Statements EXPLAIN QUERY PLAN can be run on
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+# The SlowQueryLog that TimedCursor reports to, set by the app (None to stop logging)
+active_log = None
+
+
+class SlowQueryLog:
+    """
+    Records statements that took longer than a threshold, along with the chatter_classes method that ran them, the
+    types of their parameters (not the values, which may be private) and the statement's query plan.
+
+    EXPLAIN QUERY PLAN is run the first time each statement shape is slow, and reused for later entries of the same
+    shape. Entries are kept in memory for /debug/slow-queries and, if a path is given, appended to it as JSON lines so
+    every worker process writes to the same file.
+    """
+
+    def __init__(self, threshold_ms=THRESHOLD_MS, path=None, max_entries=200, logger=None):
+
+        self.__threshold = threshold_ms / 1000
+        self.__path = path
+        self.__logger = logger or logging.getLogger(__name__)
+        self.__entries = collections.deque(maxlen=max_entries)
+        self.__plans = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def threshold(self):
+        return self.__threshold
+
+    @property
+    def entries(self):
+        # Newest first
+        with self.__lock:
+            return list(reversed(self.__entries))
+
+    @property
+    def plans(self):
+        with self.__lock:
+            return dict(self.__plans)
+
+    def record(self, dbcnx, sql, parameters, elapsed, caller):
+
+        shape = chatter_sqltrace.normalise_statement(sql)
+
+        with self.__lock:
+            capture_plan = shape not in self.__plans
+            if capture_plan:
+                # Claim the shape now so two threads don't both explain it
+                self.__plans[shape] = None
+
+        if capture_plan:
+            plan = explain(dbcnx, sql, parameters)
+            with self.__lock:
+                self.__plans[shape] = plan
+        else:
+            plan = self.__plans[shape]
+
+        entry = {'timestamp': time.time(), 'pid': os.getpid(), 'caller': caller, 'elapsed_ms': elapsed * 1000,
+                 'shape': shape, 'parameters': describe_parameters(parameters), 'plan': plan}
+
+        with self.__lock:
+            self.__entries.append(entry)
+
+        self.__logger.warning(f"Slow query ({entry['elapsed_ms']:.1f} ms) in {caller}: {shape}")
+
+        if self.__path:
+            with open(self.__path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+def describe_parameters(parameters):
+    # The type of each parameter, e.g. ['int', 'float'], so entries show how a statement was called without the data
+
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {k: type(v).__name__ for k, v in parameters.items()}
+
+    return [type(p).__name__ for p in parameters]
+
+
+def explain(dbcnx, sql, parameters):
+    """
+    Runs EXPLAIN QUERY PLAN for a statement on the connection it ran on.
+    :return: List of plan lines, indented to show nesting, or None if the statement can't be explained
+    """
+
+    if parameters is None or not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return None
+
+    try:
+        # A plain cursor, so explaining is not itself timed and logged
+        rows = dbcnx.cursor(sqlite3.Cursor).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+
+    except sqlite3.Error as e:
+        return [f"ERROR: {e}"]
+
+    depths = {0: -1}
+    lines = []
+    for row in rows:
+        node, parent, detail = row[0], row[1], row[3]
+        depths[node] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[node] + detail)
+
+    return lines
+
+
+def get_caller():
+    # The chatter_classes method that is running the statement, or failing that the nearest caller outside this module
+
+    fallback = None
+    frame = sys._getframe(1)
+
+    while frame:
+        filename = frame.f_code.co_filename
+        if os.path.basename(filename) == 'chatter_classes.py':
+            return frame.f_code.co_qualname
+
+        if fallback is None and os.path.basename(filename) != os.path.basename(__file__):
+            fallback = f"{os.path.splitext(os.path.basename(filename))[0]}.{frame.f_code.co_qualname}"
+
+        frame = frame.f_back
+
+    return fallback
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor that times each statement and reports slow ones to active_log.
+
+    A statement's time includes fetchone(), fetchmany() and fetchall() calls made on its results, since for a SELECT
+    most of the work happens while rows are fetched. Rows read by iterating over the cursor are not timed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__sql = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.__start_statement(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # The parameters have been used up, so there are none to describe or explain with
+            self.__start_statement(sql, None, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.__add_time(time.perf_counter() - started)
+
+    def fetchmany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args, **kwargs)
+        finally:
+            self.__add_time(time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.__add_time(time.perf_counter() - started)
+
+    def __start_statement(self, sql, parameters, elapsed):
+        self.__sql = sql
+        self.__parameters = parameters
+        self.__elapsed = 0.0
+        self.__logged = False
+        self.__add_time(elapsed)
+
+    def __add_time(self, elapsed):
+
+        if self.__sql is None:
+            return
+
+        self.__elapsed += elapsed
+
+        # Each statement is logged at most once, when it first goes over the threshold
+        log = active_log
+        if log and not self.__logged and self.__elapsed >= log.threshold:
+            self.__logged = True
+            log.record(self.connection, self.__sql, self.__parameters, self.__elapsed, get_caller())
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection whose statements are timed by TimedCursor. Pass it as the factory argument of sqlite3.connect().
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # sqlite3.Connection.execute() doesn't go through cursor(), so route it there
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,101 @@
+import re, time
+
+# Statements of the same shape run more often than this in one request are reported as likely N+1 query patterns,
+# e.g. one "SELECT ... FROM User WHERE userid=?" per message when rendering a chatroom
+REPEAT_THRESHOLD = 10
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalise_statement(sql):
+    """
+    Reduces a statement to its shape by replacing literal values with ? and collapsing whitespace, so that the same
+    query run with different parameters is counted together. sqlite3 passes statements to the trace callback with
+    their bound parameters filled in, so this also undoes that.
+    """
+
+    shape = _STRING_LITERAL.sub('?', sql)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = _VALUE_LIST.sub('(...)', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+def get_connections(db):
+    # Every sqlite3 connection behind db, which may be a chatter_shards.ShardRouter rather than a single connection
+    if hasattr(db, 'catalog') and hasattr(db, 'shards'):
+        return [db.catalog] + db.shards
+
+    return [db]
+
+
+class RequestTrace:
+    """
+    Counts and times every statement run on the connections it is installed on, normally for a single web request.
+
+    The trace callback only reports when each statement starts, so a statement's time is measured up to the start of
+    the next one (or finish()). That includes fetching its rows and any Python work done before the next statement,
+    which makes it an upper bound, but a fair measure of what each query costs the request.
+    """
+
+    def __init__(self, repeat_threshold=REPEAT_THRESHOLD):
+
+        self.__repeat_threshold = repeat_threshold
+        self.__shapes = {}
+        self.__statement_count = 0
+        self.__started = time.perf_counter()
+        self.__current_shape = None
+        self.__current_started = None
+        self.__summary = None
+
+    def install(self, db):
+        for dbcnx in get_connections(db):
+            dbcnx.set_trace_callback(self.on_statement)
+
+    @staticmethod
+    def uninstall(db):
+        for dbcnx in get_connections(db):
+            dbcnx.set_trace_callback(None)
+
+    def on_statement(self, sql):
+
+        now = time.perf_counter()
+        self.__end_current(now)
+
+        self.__statement_count += 1
+        self.__current_shape = normalise_statement(sql)
+        self.__current_started = now
+
+    def __end_current(self, now):
+
+        if self.__current_shape is not None:
+            count, total = self.__shapes.get(self.__current_shape, (0, 0.0))
+            self.__shapes[self.__current_shape] = (count + 1, total + now - self.__current_started)
+            self.__current_shape = None
+
+    def finish(self):
+        """
+        Stops timing and summarises the statements seen. Calling finish() again returns the same summary.
+        :return: Dictionary with the statement count, total statement time, per-shape counts and times (busiest first)
+            and the shapes that ran more than repeat_threshold times
+        """
+
+        if self.__summary is None:
+            now = time.perf_counter()
+            self.__end_current(now)
+
+            shapes = [{'shape': shape, 'count': count, 'total_ms': total * 1000}
+                      for shape, (count, total) in self.__shapes.items()]
+            shapes.sort(key=lambda s: (s['count'], s['total_ms']), reverse=True)
+
+            self.__summary = {
+                'statement_count': self.__statement_count,
+                'statement_ms': sum(s['total_ms'] for s in shapes),
+                'elapsed_ms': (now - self.__started) * 1000,
+                'shapes': shapes,
+                'repeated': [s for s in shapes if s['count'] > self.__repeat_threshold]
+            }
+
+        return self.__summary
@@ -0,0 +1,308 @@
+import socket, struct, hashlib, base64, os, threading
+
+# Minimal RFC 6455 WebSocket support, for servers that hand over the client's socket (Werkzeug's, and so the Flask
+# development server and load_test.start_local_server()). Text and binary messages, fragmentation, ping/pong and the
+# closing handshake are handled; extensions such as compression are not offered.
+
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+CLOSE_TRY_AGAIN_LATER = 1013
+
+# Largest message accepted from the other end, in bytes
+MAX_MESSAGE = 65536
+
+
+class WebSocketError(Exception):
+    pass
+
+
+class WebSocketUnsupported(WebSocketError):
+    pass
+
+
+class ConnectionClosed(WebSocketError):
+
+    def __init__(self, code=None, reason=''):
+        super().__init__(f"WebSocket closed ({code}{': ' + reason if reason else ''})")
+        self.code = code
+        self.reason = reason
+
+
+def get_accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + _GUID).encode()).digest()).decode()
+
+
+class WebSocket:
+    """
+    One end of a WebSocket connection. Use accept() on the server, in a view function, or connect() for a client.
+
+    receive() should only be called from one thread at a time, but send() and close() can be called from any thread,
+    e.g. one thread reading what the client sends while another pushes events to it.
+    """
+
+    def __init__(self, sock:socket.socket, client=False):
+        # Clients mask what they send, servers don't
+        self.__socket = sock
+        self.__client = client
+        self.__write_lock = threading.Lock()
+        self.__buffer = b''
+        self.__close_sent = False
+        self.__closed = None
+
+    @property
+    def closed(self):
+        return self.__closed is not None
+
+    @staticmethod
+    def accept(environ):
+        """
+        Completes the opening handshake for a WSGI request asking to upgrade to a WebSocket.
+        :raises WebSocketError: If the request is not a WebSocket handshake
+        :raises WebSocketUnsupported: If the server doesn't hand over the client's socket
+        """
+
+        if environ.get('HTTP_UPGRADE', '').lower() != 'websocket' or \
+                'upgrade' not in environ.get('HTTP_CONNECTION', '').lower():
+            raise WebSocketError("ERROR: Not a WebSocket handshake request.")
+
+        if environ.get('HTTP_SEC_WEBSOCKET_VERSION') != '13' or not environ.get('HTTP_SEC_WEBSOCKET_KEY'):
+            raise WebSocketError("ERROR: Unsupported WebSocket version or missing key.")
+
+        sock = environ.get('werkzeug.socket')
+        if sock is None:
+            raise WebSocketUnsupported("ERROR: This server doesn't hand over its sockets for WebSockets.")
+
+        sock.sendall(("HTTP/1.1 101 Switching Protocols\r\n"
+                      "Upgrade: websocket\r\n"
+                      "Connection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {get_accept_key(environ['HTTP_SEC_WEBSOCKET_KEY'])}\r\n\r\n").encode())
+
+        return WebSocket(sock)
+
+    @staticmethod
+    def connect(address, path, headers=None, timeout=10.0):
+        """
+        Opens a client connection, e.g. for tests and load generation.
+        :param address: (host, port) of the server
+        :param headers: Extra request headers, such as {'Cookie': ...}
+        """
+
+        sock = socket.create_connection(address, timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+
+        request = f"GET {path} HTTP/1.1\r\nHost: {address[0]}:{address[1]}\r\nUpgrade: websocket\r\n" \
+                  f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n"
+        for name, value in (headers or {}).items():
+            request += f"{name}: {value}\r\n"
+        sock.sendall((request + "\r\n").encode())
+
+        ws = WebSocket(sock, client=True)
+        response = ws.__read_until(b'\r\n\r\n').decode('latin-1')
+        status = response.split('\r\n', 1)[0]
+
+        if status.split(' ')[1:2] != ['101'] or get_accept_key(key) not in response:
+            sock.close()
+            raise WebSocketError(f"ERROR: WebSocket handshake refused: {status}")
+
+        sock.settimeout(None)
+
+        return ws
+
+    def send(self, message):
+        # Sends a str as a text message, or bytes as a binary message
+
+        if isinstance(message, str):
+            self.__send_frame(OP_TEXT, message.encode())
+        else:
+            self.__send_frame(OP_BINARY, bytes(message))
+
+    def receive(self, timeout=None):
+        """
+        Waits for the next message, answering pings and the closing handshake along the way. The timeout applies to
+        the socket, so while a receive with a timeout is waiting, sends from other threads time out too.
+        :return: str for text messages, bytes for binary messages, or None if the timeout passed first
+        :raises ConnectionClosed: Once the connection has been closed by either end
+        """
+
+        if self.__closed:
+            raise self.__closed
+
+        self.__socket.settimeout(timeout)
+        message = None
+        message_opcode = None
+
+        try:
+            while True:
+                opcode, final, payload = self.__read_frame()
+
+                if opcode == OP_PING:
+                    self.__send_frame(OP_PONG, payload)
+
+                elif opcode == OP_PONG:
+                    pass
+
+                elif opcode == OP_CLOSE:
+                    code = struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else None
+                    self.close(code or CLOSE_NORMAL)
+                    self.__finish(ConnectionClosed(code, payload[2:].decode('utf-8', 'replace')))
+
+                else:
+                    if opcode == OP_CONTINUATION:
+                        if message is None:
+                            self.__fail(CLOSE_PROTOCOL_ERROR, "Continuation without a message to continue")
+                        message += payload
+                    else:
+                        if message is not None:
+                            self.__fail(CLOSE_PROTOCOL_ERROR, "New message before the last one finished")
+                        message, message_opcode = payload, opcode
+
+                    if len(message) > MAX_MESSAGE:
+                        self.__fail(CLOSE_TOO_BIG, "Message too big")
+
+                    if final:
+                        if message_opcode == OP_TEXT:
+                            try:
+                                return message.decode('utf-8')
+                            except UnicodeDecodeError:
+                                self.__fail(CLOSE_PROTOCOL_ERROR, "Text message is not UTF-8")
+                        return message
+
+        except socket.timeout:
+            if message is not None:
+                # Part of a message has been read and would be lost, so don't leave the connection half way through
+                self.__fail(CLOSE_PROTOCOL_ERROR, "Message not finished in time")
+            return None
+
+        except OSError as e:
+            self.__finish(ConnectionClosed(CLOSE_GOING_AWAY, str(e)))
+
+    def close(self, code=CLOSE_NORMAL, reason=''):
+        # Starts (or answers) the closing handshake; receive() raises ConnectionClosed once the other end has answered
+
+        with self.__write_lock:
+            if self.__close_sent:
+                return
+            self.__close_sent = True
+
+        try:
+            self.__send_frame(OP_CLOSE, struct.pack('!H', code) + reason.encode()[:120], force=True)
+        except OSError:
+            pass
+
+    def shutdown(self):
+        # Closes the socket without waiting for the closing handshake
+        self.__finish(ConnectionClosed(CLOSE_GOING_AWAY), raise_error=False)
+
+    def __fail(self, code, reason):
+        self.close(code, reason)
+        self.__finish(ConnectionClosed(code, reason))
+
+    def __finish(self, error, raise_error=True):
+
+        if self.__closed is None:
+            self.__closed = error
+            try:
+                self.__socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.__socket.close()
+
+        if raise_error:
+            raise self.__closed
+
+    def __send_frame(self, opcode, payload, force=False):
+
+        header = bytes([0x80 | opcode])
+        mask_bit = 0x80 if self.__client else 0
+
+        if len(payload) < 126:
+            header += bytes([mask_bit | len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([mask_bit | 126]) + struct.pack('!H', len(payload))
+        else:
+            header += bytes([mask_bit | 127]) + struct.pack('!Q', len(payload))
+
+        if self.__client:
+            mask = os.urandom(4)
+            header += mask
+            payload = _apply_mask(payload, mask)
+
+        with self.__write_lock:
+            if self.__close_sent and not force:
+                raise ConnectionClosed(None, "Closing")
+            self.__socket.sendall(header + payload)
+
+    def __read_frame(self):
+        # Nothing is taken from the buffer until the whole frame has arrived, so a timeout part way through loses nothing
+
+        self.__fill_to(2)
+        first, second = self.__buffer[0], self.__buffer[1]
+        opcode = first & 0x0F
+        final = bool(first & 0x80)
+        length = second & 0x7F
+        offset = 2
+
+        if length == 126:
+            self.__fill_to(4)
+            length = struct.unpack('!H', self.__buffer[2:4])[0]
+            offset = 4
+        elif length == 127:
+            self.__fill_to(10)
+            length = struct.unpack('!Q', self.__buffer[2:10])[0]
+            offset = 10
+
+        if length > MAX_MESSAGE:
+            self.__fail(CLOSE_TOO_BIG, "Frame too big")
+
+        masked = bool(second & 0x80)
+        if masked == self.__client:
+            # Only clients mask their frames
+            self.__fail(CLOSE_PROTOCOL_ERROR, "Frame masking is wrong")
+
+        if masked:
+            offset += 4
+
+        self.__fill_to(offset + length)
+        payload = self.__buffer[offset:offset + length]
+        if masked:
+            payload = _apply_mask(payload, self.__buffer[offset - 4:offset])
+        self.__buffer = self.__buffer[offset + length:]
+
+        return opcode, final, payload
+
+    def __fill_to(self, count):
+        while len(self.__buffer) < count:
+            self.__fill_buffer()
+
+    def __read_until(self, terminator):
+
+        while terminator not in self.__buffer:
+            if len(self.__buffer) > MAX_MESSAGE:
+                raise WebSocketError("ERROR: WebSocket handshake response too long.")
+            self.__fill_buffer()
+
+        data, self.__buffer = self.__buffer.split(terminator, 1)
+        return data + terminator
+
+    def __fill_buffer(self):
+        data = self.__socket.recv(65536)
+        if not data:
+            raise ConnectionResetError("Connection closed without a closing handshake")
+        self.__buffer += data
+
+
+def _apply_mask(payload, mask):
+    # XOR with the repeated 4 byte mask, a whole message at a time rather than byte by byte
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(payload), 'big')
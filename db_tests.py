@@ -1,4 +1,5 @@
-import init_db, sqlite3, time, unittest, chatter_classes, datetime
+import init_db, sqlite3, time, unittest, chatter_classes, chatter_cache, chatter_archive, chatter_shards, chatter_replicas, synthetic_data, load_test, chatter_sqltrace, chatter_metrics, chatter_profiler, chatter_slowlog, chatter_analytics, chatter_rollups, chatter_broker, chatter_notify, chatter_websocket, chatter_ratelimit, chatter_sendlog, chatter_migrations, chatter_retention, chatter_maintenance, datetime, tempfile, os, json, socket, fcntl
+import urllib.request, urllib.parse, http.cookiejar
 
 db = sqlite3.connect('test.db', detect_types=sqlite3.PARSE_DECLTYPES)
 db.row_factory = sqlite3.Row
@@ -130,6 +131,22 @@ def add_attachments(db:sqlite3.Connection):
     db.commit()
 
 
+def create_test_database(path):
+    # Builds a separate copy of the test data for tests that need to change it wholesale (e.g. archiving every message)
+
+    test_db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    test_db.row_factory = sqlite3.Row
+
+    init_db.init_db(test_db)
+    add_test_users(test_db)
+    add_test_chatrooms(test_db)
+    add_chatroom_members(test_db)
+    add_messages(test_db)
+    add_attachments(test_db)
+
+    return test_db
+
+
 class SetupTestData(unittest.TestCase):
 
     def test_setup_initialise_database(self):
@@ -209,6 +226,9 @@ class TestUser(unittest.TestCase):
 
         self.assertEqual(message_count + 1, chatter_classes.Chatroom(1, db).get_message_count())
 
+        # TestUser1 does not belong to chatroom 2
+        self.assertRaises(chatter_classes.UserPermissionError, u.send_message, "Not sent", 2)
+
     def test_user_memberships(self):
 
         u = chatter_classes.User(2, db)
@@ -360,6 +380,74 @@ class TestChatroom(unittest.TestCase):
         print(js)
         self.assertNotEqual(0, len(js))
 
+    def test_lazy_objects(self):
+        chatroom = chatter_classes.Chatroom(1, db)
+
+        sql_trace = chatter_sqltrace.RequestTrace()
+        sql_trace.install(db)
+        try:
+            # Only the ids are needed, so no User rows are read
+            owner_ids = [u.userid for u in chatroom.get_all_owners()]
+        finally:
+            sql_trace.uninstall(db)
+
+        self.assertEqual([1], owner_ids)
+        self.assertEqual(1, sql_trace.finish()['statement_count'])
+
+        # Read on first use
+        self.assertEqual('TestUser1', chatter_classes.User(1, db, lazy=True).username)
+        self.assertEqual(1, chatter_classes.Message(1, db, lazy=True).chatroomid)
+        self.assertEqual('TestRoom1', chatter_classes.Chatroom(1, db, lazy=True).name)
+
+        # Missing rows raise when first used, or straight away with check_exists()
+        missing = chatter_classes.User(9999, db, lazy=True)
+        self.assertEqual(9999, missing.userid)
+        self.assertRaises(chatter_classes.UserNotFoundError, lambda: missing.username)
+        self.assertRaises(chatter_classes.UserNotFoundError, missing.check_exists)
+        self.assertRaises(chatter_classes.MessageNotFoundError, chatter_classes.Message(9999, db, lazy=True).check_exists)
+        self.assertRaises(chatter_classes.AttachmentNotFoundError,
+                          chatter_classes.Attachment(9999, db, lazy=True).check_exists)
+        self.assertEqual('donald.png', chatter_classes.Attachment(1, db, lazy=True).check_exists().filepath)
+
+        self.assertRaises(AttributeError, lambda: chatter_classes.User(1, db, lazy=True).no_such_attribute)
+
+    def test_get_timeline(self):
+        cr = chatter_classes.Chatroom(1, db)
+
+        timeline = cr.get_timeline(limit=4)
+        self.assertEqual([m.messageid for m in cr.get_message_page(limit=4)], [e.messageid for e in timeline])
+
+        # Other tests add messages to this chatroom, so page through to its first message
+        while timeline:
+            first = timeline[-1]
+            timeline = cr.get_timeline(first.messageid, 4)
+
+        self.assertEqual(1, first.messageid)
+        self.assertEqual(chatter_classes.Message(first.messageid, db).content, first.content)
+        self.assertEqual(chatter_classes.Message(first.messageid, db).timestamp, first.sent_at)
+        self.assertEqual(chatter_classes.User(first.senderid, db).username, first.sender_username)
+        self.assertEqual([a.filepath for a in chatter_classes.Message(first.messageid, db).attachments],
+                         [filepath for attachmentid, filepath in first.attachments])
+
+        # Same fields as Message.json, plus the username
+        message_json = json.loads(chatter_classes.Message(first.messageid, db).json)
+        self.assertEqual(dict(message_json, sender_username=first.sender_username), json.loads(first.json))
+
+    def test_get_message_pages(self):
+        cr = chatter_classes.Chatroom(3, db)
+
+        first_page = json.loads(cr.json_history_page(limit=5))
+        self.assertEqual(5, len(first_page['messages']))
+
+        # Following the cursor should return the remaining four of the chatroom's nine messages, with no further page
+        second_page = json.loads(cr.json_history_page(first_page['next_cursor'], limit=5))
+        self.assertEqual(4, len(second_page['messages']))
+        self.assertIsNone(second_page['next_cursor'])
+
+        newest_ids = [m.messageid for m in cr.get_message_page(limit=5)]
+        self.assertEqual(sorted(newest_ids, reverse=True), newest_ids)
+        self.assertTrue(all(m.messageid < min(newest_ids) for m in cr.get_message_page(min(newest_ids), 5)))
+
 
 class TestMessage(unittest.TestCase):
 
@@ -409,6 +497,76 @@ class TestMessage(unittest.TestCase):
         self.assertNotEqual(0, len(js))
 
 
+class TestRecords(unittest.TestCase):
+
+    def test_message_records_match_messages(self):
+        messages = chatter_classes.Chatroom(1, db).get_messages()
+        records = list(chatter_classes.Message.iter_records(db, 1, batch_size=2))
+
+        self.assertEqual([(m.messageid, m.content, m.senderid) for m in messages],
+                         [(r.messageid, r.content, r.senderid) for r in records])
+        self.assertEqual(messages[0].timestamp, datetime.datetime.fromtimestamp(records[0].timestamp))
+
+        # Records are immutable and much smaller than Message objects, but can be turned into one to make changes
+        self.assertFalse(hasattr(records[0], '__dict__'))
+        self.assertRaises(AttributeError, setattr, records[0], 'content', "Changed")
+        self.assertEqual(messages[0].json, records[0].to_message(db).json)
+
+    def test_all_message_records(self):
+        count = db.execute("SELECT count(*) FROM Message").fetchone()[0]
+        self.assertEqual(count, len(list(chatter_classes.Message.iter_records(db))))
+
+    def test_user_and_chatroom_records(self):
+        users = {u.userid: u for u in chatter_classes.User.iter_records(db)}
+        self.assertEqual('TestUser1', users[1].username)
+        self.assertTrue(users[1].active)
+        self.assertEqual(chatter_classes.User(1, db).json, users[1].to_user(db).json)
+
+        chatrooms = list(chatter_classes.Chatroom.iter_records(db))
+        self.assertEqual(chatter_classes.Chatroom(chatrooms[0].chatroomid, db).name, chatrooms[0].name)
+
+
+@unittest.skipIf(chatter_analytics.np is None, "NumPy is not installed")
+class TestActivityStats(unittest.TestCase):
+
+    def test_chatroom_stats(self):
+        stats = chatter_classes.Chatroom(3, db).get_activity_stats(top_senders=2)
+        messages = chatter_classes.Chatroom(3, db).get_messages()
+
+        self.assertEqual(len(messages), stats['message_count'])
+        self.assertEqual(len(messages), sum(stats['messages_per_hour']))
+        self.assertEqual(len(messages), sum(stats['messages_per_weekday'].values()))
+        self.assertEqual(2, len(stats['top_senders']))
+        self.assertEqual(len({m.senderid for m in messages}), sum(p['active_members'] for p in stats['active_members']))
+
+    def test_stats_route_parameters(self):
+        import app
+
+        client = app.app.test_client()
+        with client.session_transaction() as s:
+            # TestAdmin
+            s['active_userid'] = 6
+
+        for query in ('utc_offset=inf', 'utc_offset=nan', 'utc_offset=25', 'top=-1', 'period_days=0', 'days=-1'):
+            self.assertEqual(400, client.get(f'/json/chatroom/3/stats?{query}').status_code, query)
+
+        # Longer than the data covers is the same as all of it
+        stats = client.get('/json/chatroom/3/stats?period_days=99999999999&days=99999999999').get_json()
+        self.assertEqual(1, len(stats['active_members']))
+        self.assertEqual(stats['message_count'], stats['active_members'][0]['message_count'])
+
+    def test_response_times(self):
+        # Responses after 5, 5 and 50 seconds; sender 1's second message in a row is not a response
+        records = [chatter_classes.MessageRecord(i, "", 1, senderid, ts)
+                   for i, (senderid, ts) in enumerate([(1, 0), (2, 5), (1, 10), (1, 20), (2, 70)])]
+        columns = chatter_analytics.load_columns(records)
+        response_times = chatter_analytics.get_response_times(columns['timestamp'], columns['senderid'])
+
+        self.assertEqual(3, response_times['count'])
+        self.assertEqual([2, 0, 1], [b['count'] for b in response_times['histogram'][:3]])
+        self.assertEqual(5, response_times['percentiles']['p50_s'])
+
+
 class TestAttachment(unittest.TestCase):
 
     def test_constructor_existing_attachment(self):
@@ -430,6 +588,1200 @@ class TestAttachment(unittest.TestCase):
     # TODO: Add test for adding an attachment
 
 
+class TestMessageArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = create_test_database(os.path.join(self.tmp_dir.name, 'archive_test.db'))
+
+        # All of the test messages were sent an hour ago, so this archives every one of them
+        self.archived_count = chatter_archive.archive_messages(self.db, datetime.datetime.now())
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_messages_moved_to_segments(self):
+        self.assertEqual(21, self.archived_count)
+        self.assertEqual(0, self.db.execute("SELECT count(*) FROM Message").fetchone()[0])
+
+        # One segment per chatroom, as all of the test messages were sent in the same month
+        self.assertEqual(3, self.db.execute("SELECT count(*) FROM MessageArchive").fetchone()[0])
+
+    def test_timeline_reads_archive(self):
+        new_message = chatter_classes.Message.add("Added by test_timeline_reads_archive()", 1, 2, self.db)
+
+        timeline = chatter_classes.Chatroom(1, self.db).get_timeline(limit=None)
+        self.assertEqual([new_message.messageid, 6, 5, 4, 3, 2, 1], [e.messageid for e in timeline])
+        self.assertEqual('TestUser1', timeline[-1].sender_username)
+        self.assertEqual(['donald.png', 'gary.png'], [filepath for attachmentid, filepath in timeline[-1].attachments])
+
+    def test_read_through(self):
+        m = chatter_classes.Message(1, self.db)
+        self.assertTrue(m.is_archived)
+        self.assertEqual(1, m.chatroomid)
+
+        cr = chatter_classes.Chatroom(3, self.db)
+        self.assertEqual(9, len(cr.get_messages()))
+        self.assertEqual(9, cr.get_message_count())
+
+        # New messages go to the live table but are returned alongside the archived ones
+        cr.add_message("Added by test_read_through()", 1)
+        self.assertEqual(10, len(cr.get_messages()))
+        self.assertEqual(10, len(cr.get_message_page(limit=20)))
+        self.assertEqual(1, len(cr.get_messages(datetime.datetime.now() - datetime.timedelta(minutes=5))))
+
+        # Bulk reads include archived messages too, before the live ones
+        records = list(chatter_classes.Message.iter_records(self.db))
+        self.assertEqual(22, len(records))
+        self.assertEqual("Added by test_read_through()", records[-1].content)
+        self.assertEqual([m.messageid for m in cr.get_messages()],
+                         [r.messageid for r in chatter_classes.Message.iter_records(self.db, 3)])
+
+    def test_update_and_delete_archived_message(self):
+        m = chatter_classes.Message(2, self.db)
+        m.update(content="Updated by test_update_and_delete_archived_message()")
+        self.assertEqual("Updated by test_update_and_delete_archived_message()",
+                         chatter_classes.Message(2, self.db).content)
+
+        m.delete()
+        self.assertRaises(chatter_classes.MessageNotFoundError, chatter_classes.Message, 2, self.db)
+        self.assertEqual(5, chatter_classes.Chatroom(1, self.db).get_message_count())
+
+    def test_archived_message_moved_to_other_chatroom_or_month(self):
+        # Segments hold one chatroom's messages for one month, so these changes must take the message out of its segment
+        chatter_classes.Message(2, self.db).update(chatroomid=2)
+        self.assertEqual([6, 5, 4, 3, 1], [e.messageid for e in chatter_classes.Chatroom(1, self.db).get_timeline()])
+        self.assertIn(2, [e.messageid for e in chatter_classes.Chatroom(2, self.db).get_timeline()])
+        self.assertEqual(2, chatter_classes.Message(2, self.db).chatroomid)
+
+        m = chatter_classes.Message(3, self.db)
+        m.update(timestamp=datetime.datetime(2021, 1, 15))
+        self.assertFalse(m.is_archived)
+        self.assertEqual(datetime.datetime(2021, 1, 15), chatter_classes.Message(3, self.db).timestamp)
+
+        # Archiving again files both in the segments they now belong in
+        chatter_archive.archive_messages(self.db, datetime.datetime.now())
+        self.assertEqual(0, self.db.execute("SELECT count(*) FROM Message").fetchone()[0])
+        self.assertIn(2, [m['messageid'] for m in chatter_archive.get_archived_message_page(self.db, 2, 2 ** 62, 20)])
+        months = self.db.execute("SELECT month FROM MessageArchive WHERE chatroomid=1").fetchall()
+        self.assertIn('2021-01', [row['month'] for row in months])
+
+    def test_newest_messageid(self):
+        cr = chatter_classes.Chatroom(1, self.db)
+        self.assertEqual(6, cr.get_newest_messageid())
+
+        new_message = cr.add_message("Added by test_newest_messageid()", 1)
+        self.assertEqual(new_message.messageid, cr.get_newest_messageid())
+
+    def test_change_archived_messages_from_bulk_reads(self):
+        cr = chatter_classes.Chatroom(1, self.db)
+
+        # Messages built from segment rows know they are archived, so their changes go to the archive
+        messages = {m.messageid: m for m in cr.get_messages()}
+        self.assertTrue(all(m.is_archived for m in messages.values()))
+
+        messages[2].update(content="Updated through get_messages()")
+        self.assertEqual("Updated through get_messages()", chatter_classes.Message(2, self.db).content)
+
+        messages[3].delete()
+        self.assertRaises(chatter_classes.MessageNotFoundError, chatter_classes.Message, 3, self.db)
+
+        page = cr.get_message_page(limit=20)
+        self.assertTrue(all(m.is_archived for m in page))
+        page[0].delete()
+        self.assertEqual(4, cr.get_message_count())
+
+        records = list(chatter_classes.Message.iter_records(self.db, 1))
+        self.assertTrue(all(r.archived for r in records))
+        message = records[0].to_message(self.db)
+        self.assertTrue(message.is_archived)
+        message.delete()
+        self.assertEqual(3, cr.get_message_count())
+
+
+class TestMembership(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = create_test_database(os.path.join(self.tmp_dir.name, 'membership_test.db'))
+        self.changes = []
+        chatter_classes.membership_change_listeners.append(self.record_change)
+
+    def tearDown(self):
+        chatter_classes.membership_change_listeners.remove(self.record_change)
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def record_change(self, chatroomid, userids):
+        self.changes.append((chatroomid, userids))
+
+    def test_join_by_code(self):
+        cr = chatter_classes.Chatroom(3, self.db)
+        u = chatter_classes.User(6, self.db)
+        self.assertFalse(cr.user_is_member(u))
+
+        self.assertEqual(3, u.join_chatroom(cr.joincode).chatroomid)
+        self.assertTrue(cr.user_is_member(u))
+        self.assertEqual([(3, [6])], self.changes)
+
+        # Joining again changes nothing
+        chatter_classes.Chatroom.join_by_code(u, cr.joincode, self.db)
+        self.assertEqual(1, len(self.changes))
+
+        self.assertRaises(chatter_classes.ChatroomNotFoundError, u.join_chatroom, "nosuchcode")
+
+    def test_add_and_remove_members(self):
+        cr = chatter_classes.Chatroom(1, self.db)
+        members = {u.userid for u in cr.get_all_members()}
+
+        # Unknown users are skipped, and existing members are only changed if they are being made owners
+        self.assertEqual(1, cr.add_members([chatter_classes.User(6, self.db), 999] + list(members)))
+        self.assertEqual(members | {6}, {u.userid for u in cr.get_all_members()})
+
+        self.assertEqual(1, cr.add_members([6], owner=True))
+        self.assertTrue(cr.user_is_owner(chatter_classes.User(6, self.db)))
+
+        self.assertEqual(2, cr.remove_members([6, min(members), 999]))
+        self.assertEqual(members - {min(members)}, {u.userid for u in cr.get_all_members()})
+        self.assertEqual(3, len(self.changes))
+
+
+class TestMessageRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = create_test_database(os.path.join(self.tmp_dir.name, 'rollup_test.db'))
+
+        # The test messages are inserted directly rather than through Message.add(), so need counting first
+        chatter_rollups.rebuild_rollups(self.db)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def get_counts(self):
+        return chatter_classes.Chatroom.get_message_counts_by_chatroom(self.db)
+
+    def test_rebuild_matches_messages(self):
+        self.assertEqual({r: chatter_classes.Chatroom(r, self.db).get_message_count() for r in (1, 2, 3)},
+                         self.get_counts())
+
+        # Archived messages are still counted
+        chatter_archive.archive_messages(self.db, datetime.datetime.now())
+        chatter_rollups.rebuild_rollups(self.db)
+        self.assertEqual(21, sum(self.get_counts().values()))
+
+    def test_counts_kept_up_to_date(self):
+        before = self.get_counts()
+
+        m = chatter_classes.Message.add("Added by test_counts_kept_up_to_date()", 1, 1, self.db)
+        self.assertEqual(before[1] + 1, self.get_counts()[1])
+
+        m.update(chatroomid=2)
+        self.assertEqual(before[1], self.get_counts()[1])
+        self.assertEqual(before[2] + 1, self.get_counts()[2])
+
+        m.update(timestamp=datetime.datetime.now() - datetime.timedelta(days=2))
+        self.assertEqual(1, chatter_classes.Chatroom(2, self.db).get_hourly_message_counts()[0][1])
+        self.assertEqual(before[2], sum(chatter_classes.Chatroom(2, self.db).get_sender_message_counts(
+            datetime.datetime.now() - datetime.timedelta(days=1)).values()))
+
+        m.delete()
+        self.assertEqual(before, self.get_counts())
+
+
+class TestShardRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        catalog_path = os.path.join(self.tmp_dir.name, 'catalog.db')
+        shard_paths = [os.path.join(self.tmp_dir.name, f'shard{i}.db') for i in range(2)]
+
+        chatter_shards.init_sharded_db(catalog_path, shard_paths)
+        self.router = chatter_shards.ShardRouter(catalog_path, shard_paths)
+
+        add_test_users(self.router.catalog)
+        for name in ["ShardRoom1", "ShardRoom2", "ShardRoom3"]:
+            chatter_classes.Chatroom.add(name, "Created by TestShardRouter", self.router)
+
+    def tearDown(self):
+        self.router.close()
+        self.tmp_dir.cleanup()
+
+    def test_timeline(self):
+        message = chatter_classes.Message.add("Sharded timeline message", 2, 1, self.router)
+        message.add_attachment('shard.png')
+
+        timeline = chatter_classes.Chatroom(2, self.router).get_timeline()
+        self.assertEqual([(message.messageid, 'TestUser1')], [(e.messageid, e.sender_username) for e in timeline])
+        self.assertEqual(['shard.png'], [filepath for attachmentid, filepath in timeline[0].attachments])
+
+    def test_messages_routed_to_shards(self):
+        # Chatrooms without an explicit placement are spread by id, so chatroom 1 is on shard 1 and chatroom 2 on shard 0
+        m1 = chatter_classes.Message.add("Message in ShardRoom1", 1, 1, self.router)
+        # Only members can send, and memberships are kept in the catalog
+        chatter_classes.Chatroom(2, self.router).add_members([2])
+        m2 = chatter_classes.User(2, self.router).send_message("Message in ShardRoom2", 2)
+        m1.add_attachment("gary.png")
+
+        self.assertEqual(1, self.router.shards[1].execute("SELECT count(*) FROM Message").fetchone()[0])
+        self.assertEqual(1, self.router.shards[0].execute("SELECT count(*) FROM Message").fetchone()[0])
+        self.assertNotEqual(m1.messageid, m2.messageid)
+
+        m = chatter_classes.Message(m1.messageid, self.router)
+        self.assertEqual("TestUser1", m.sender.username)
+        self.assertEqual("ShardRoom1", m.chatroom.name)
+        self.assertEqual(["gary.png"], [a.filepath for a in m.attachments])
+        self.assertEqual(1, chatter_classes.Chatroom(2, self.router).get_message_count())
+
+    def test_rebalance(self):
+        for i in range(5):
+            chatter_classes.Message.add(f"Message {i} in ShardRoom1", 1, 1, self.router)
+            chatter_classes.Message.add(f"Message {i} in ShardRoom3", 3, 1, self.router)
+        attachment = chatter_classes.Chatroom(3, self.router).get_messages()[0].add_attachment("will.png")
+
+        # Both chatrooms start on shard 1, leaving shard 0 empty
+        self.assertEqual(1, chatter_shards.rebalance(self.router))
+        self.assertEqual({0: 5, 1: 5}, {i: s.execute("SELECT count(*) FROM Message").fetchone()[0]
+                                        for i, s in enumerate(self.router.shards)})
+
+        for chatroomid in [1, 3]:
+            cr = chatter_classes.Chatroom(chatroomid, self.router)
+            self.assertEqual(5, len(cr.get_messages()))
+            cr.add_message("Added after rebalancing", 1)
+            self.assertEqual(6, cr.get_message_count())
+
+        self.assertEqual("will.png", chatter_classes.Attachment(attachment.attachmentid, self.router).filepath)
+        self.assertEqual({1: 6, 3: 6}, chatter_classes.Chatroom.get_message_counts_by_chatroom(self.router))
+
+        # Already balanced, so nothing else should move
+        self.assertEqual(0, chatter_shards.rebalance(self.router))
+
+    def test_ids_rise_after_move(self):
+        # Chatroom 1 is on shard 1, whose ids are above shard 0's
+        moved = [chatter_classes.Message.add(f"Message {i} in ShardRoom1", 1, 1, self.router) for i in range(2)]
+        chatter_classes.Message.add("Message in ShardRoom2", 2, 1, self.router)
+        chatter_shards.move_chatroom(self.router, 1, 0)
+
+        new_message = chatter_classes.Message.add("Added after the move", 1, 1, self.router)
+        self.assertGreater(new_message.messageid, moved[-1].messageid)
+        self.assertEqual([new_message.messageid, moved[-1].messageid],
+                         [e.messageid for e in chatter_classes.Chatroom(1, self.router).get_timeline(limit=2)])
+
+        # Shard 1 carries on in its own block, which shard 0 no longer allocates from
+        other = chatter_classes.Message.add("Message in ShardRoom3", 3, 1, self.router)
+        self.assertLess(other.messageid, new_message.messageid)
+        self.assertEqual(new_message.messageid, chatter_classes.Chatroom(1, self.router).get_newest_messageid())
+
+
+class TestReadReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        primary_path = os.path.join(self.tmp_dir.name, 'primary.db')
+        self.db = create_test_database(primary_path)
+
+        self.manager = chatter_replicas.ReplicaManager(primary_path, [os.path.join(self.tmp_dir.name, 'replica.db')])
+        self.manager.refresh()
+        chatter_classes.read_replicas = self.manager
+
+    def tearDown(self):
+        chatter_classes.read_replicas = None
+        chatter_classes.READ_REPLICA_MAX_STALENESS = 5.0
+        self.manager.close()
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_reads_routed_to_replica(self):
+        cr = chatter_classes.Chatroom(3, self.db)
+        cr.add_message("Added by test_reads_routed_to_replica()", 1)
+
+        # The replica was refreshed before the message was added, so it isn't visible there until the next refresh
+        self.assertEqual(9, len(cr.get_messages()))
+        self.assertEqual(9, len(cr.get_timeline(limit=None)))
+        # Pages built to be cached read the primary
+        self.assertEqual(10, len(json.loads(cr.json_history_page(limit=20, primary=True))['messages']))
+        self.manager.refresh()
+        self.assertEqual(10, len(cr.get_messages()))
+
+        rooms = chatter_classes.User(2, self.db).get_chatrooms()
+        self.assertEqual(2, len(rooms['owner']))
+
+        # Objects read from the replica still write to the primary
+        rooms['owner'][0].update(description="Updated by test_reads_routed_to_replica()")
+        self.assertEqual("Updated by test_reads_routed_to_replica()",
+                         chatter_classes.Chatroom(rooms['owner'][0].chatroomid, self.db).description)
+
+    def test_delete_reads_primary(self):
+        cr = chatter_classes.Chatroom(3, self.db)
+        message = cr.add_message("Added by test_delete_reads_primary()", 1)
+        message.add_attachment('replica.png')
+
+        # The replica hasn't seen the new message, but it is deleted along with the chatroom all the same
+        cr.delete()
+        self.assertEqual(0, self.db.execute("SELECT count(*) FROM Message WHERE chatroomid=3").fetchone()[0])
+        self.assertEqual(0, self.db.execute("SELECT count(*) FROM Attachment WHERE messageid=?",
+                                            [message.messageid]).fetchone()[0])
+
+    def test_stale_replica_not_used(self):
+        cr = chatter_classes.Chatroom(3, self.db)
+        cr.add_message("Added by test_stale_replica_not_used()", 1)
+
+        chatter_classes.READ_REPLICA_MAX_STALENESS = -1
+        self.assertEqual(10, len(cr.get_messages()))
+
+
+class TestSyntheticData(unittest.TestCase):
+
+    def test_generate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sizes = {'users': 40, 'chatrooms': 6, 'messages': 500}
+            db_a = synthetic_data.generate(os.path.join(tmp_dir, 'a.db'), seed=1, **sizes)
+            db_b = synthetic_data.generate(os.path.join(tmp_dir, 'b.db'), seed=1, **sizes)
+
+            self.assertEqual(500, db_a.execute("SELECT count(*) FROM Message").fetchone()[0])
+
+            # The same seed gives the same data, apart from timestamps which are relative to when it was generated
+            sql = "SELECT messageid, content, chatroomid, senderid FROM Message ORDER BY messageid"
+            self.assertEqual([tuple(r) for r in db_a.execute(sql)], [tuple(r) for r in db_b.execute(sql)])
+
+            # Every message is sent by a member of its chatroom, and synthetic users can log in
+            self.assertIsNone(db_a.execute("SELECT messageid FROM Message WHERE senderid NOT IN (SELECT userid FROM "
+                                           "ChatroomMember WHERE chatroomid=Message.chatroomid)").fetchone())
+            u = chatter_classes.User.authenticate(synthetic_data.get_username(3), synthetic_data.get_password(3), db_a)
+            self.assertEqual(3, u.userid)
+
+            db_a.close()
+            db_b.close()
+
+
+class TestLoadTestStats(unittest.TestCase):
+
+    def test_route_summary(self):
+        stats = load_test.RouteStats()
+        for i in range(1, 101):
+            stats.record(load_test.get_route(f'/view/chatroom/{i % 3}'), i / 1000, i % 10 == 0)
+
+        summary = stats.summarise(elapsed=2.0)['/view/chatroom/<chatroomid>']
+        self.assertEqual(100, summary['requests'])
+        self.assertEqual(50, summary['throughput_rps'])
+        self.assertAlmostEqual(0.1, summary['error_rate'])
+        self.assertAlmostEqual(51, summary['p50_ms'])
+        self.assertAlmostEqual(100, summary['p99_ms'])
+        self.assertEqual('/json/chatroom/<chatroomid>/messages', load_test.get_route('/json/chatroom/4/messages?before=9'))
+
+
+class TestRequestTrace(unittest.TestCase):
+
+    def test_normalise_statement(self):
+        self.assertEqual("SELECT content FROM Message WHERE messageid=? AND content=?",
+                         chatter_sqltrace.normalise_statement("SELECT content FROM Message\n  WHERE messageid=12 "
+                                                              "AND content='It''s 5pm'"))
+        self.assertEqual("INSERT INTO Attachment VALUES (...)",
+                         chatter_sqltrace.normalise_statement("INSERT INTO Attachment VALUES (?, 1, 'gary.png')"))
+
+    def test_repeated_statements_flagged(self):
+        trace = chatter_sqltrace.RequestTrace(repeat_threshold=1)
+        trace.install(db)
+
+        try:
+            # One query for the member ids, then one User query per member as each member's username is read
+            members = chatter_classes.Chatroom(1, db).get_all_members()
+            usernames = [m.username for m in members]
+        finally:
+            trace.uninstall(db)
+
+        summary = trace.finish()
+        self.assertEqual(len(members) + 2, summary['statement_count'])
+        self.assertEqual(1, len(summary['repeated']))
+        self.assertEqual(len(members), summary['repeated'][0]['count'])
+        self.assertIn("FROM User WHERE userid=?", summary['repeated'][0]['shape'])
+
+    def test_trace_headers(self):
+        import app
+
+        client = app.app.test_client()
+        with client.session_transaction() as s:
+            # TestAdmin
+            s['active_userid'] = 6
+
+        connect_db = app.connect_db
+        connections = []
+        app.connect_db = lambda: connections.append(1) or connect_db()
+
+        try:
+            # A request that never touches the database is not traced, and the trace does not open a connection itself
+            response = client.get('/')
+            self.assertNotIn('X-SQL-Count', response.headers)
+            self.assertEqual([], connections)
+
+            response = client.get('/json/chatroom/3/stats')
+            self.assertGreater(int(response.headers['X-SQL-Count']), 0)
+            self.assertEqual(1, len(connections))
+        finally:
+            app.connect_db = connect_db
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        metrics = chatter_metrics.Metrics(buckets=(0.1, 1.0))
+        metrics.describe('requests_total', 'counter', "Requests.")
+        metrics.describe('latency_seconds', 'histogram', "Latency.")
+
+        metrics.inc('requests_total', {'route': '/a'})
+        metrics.inc('requests_total', {'route': '/a'}, 2)
+        metrics.observe('latency_seconds', value=0.5)
+
+        text = metrics.render()
+        self.assertIn("# TYPE requests_total counter", text)
+        self.assertIn('requests_total{route="/a"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 1', text)
+        self.assertIn("latency_seconds_count 1", text)
+
+    def test_totals_across_processes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics = chatter_metrics.Metrics(tmp_dir)
+            metrics.describe('connections_open', 'gauge', "Open connections.")
+            metrics.inc('messages_total', amount=2)
+            metrics.set('connections_open', value=1)
+
+            # Snapshots left by another worker: one still running (this test's parent) and one that has exited
+            for pid in [os.getppid(), 2 ** 22 + 1]:
+                with open(os.path.join(tmp_dir, f"{pid}.json"), 'w') as f:
+                    json.dump({'pid': pid, 'values': {'messages_total': {'[]': 3},
+                                                      'connections_open': {'[]': 4}}}, f)
+
+            totals = metrics.collect()
+            self.assertEqual(8, totals['messages_total'][()])
+            self.assertEqual(5, totals['connections_open'][()])
+
+    def test_hit_ratios(self):
+        totals = {'cache_requests_total': {(('cache', 'page'), ('result', 'hit')): 3,
+                                           (('cache', 'page'), ('result', 'miss')): 1,
+                                           (('cache', 'segment'), ('result', 'miss')): 2}}
+        self.assertEqual({(('cache', 'page'),): 0.75, (('cache', 'segment'),): 0.0},
+                         chatter_metrics.hit_ratios(totals, 'cache_requests_total'))
+
+
+class TestRequestProfiler(unittest.TestCase):
+
+    def test_should_profile(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler = chatter_profiler.RequestProfiler(tmp_dir)
+            self.assertFalse(profiler.should_profile('/view/chatroom/<int:chatroomid>', 1))
+
+            profiler.configure(True, 1.0, route='/view/chatroom/<int:chatroomid>', userid=1)
+            self.assertTrue(profiler.should_profile('/view/chatroom/<int:chatroomid>', 1))
+            self.assertFalse(profiler.should_profile('/view/chatroom/<int:chatroomid>', 2))
+            self.assertFalse(profiler.should_profile('/view/chatroom/list', 1))
+
+            # Another process sharing the directory sees the same settings
+            self.assertEqual(profiler.settings, chatter_profiler.RequestProfiler(tmp_dir).settings)
+
+            self.assertRaises(chatter_profiler.ProfileError, profiler.configure, True, 1.5)
+
+    def test_dumps_rotated_and_summarised(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler = chatter_profiler.RequestProfiler(tmp_dir, max_dumps=2)
+
+            for i in range(3):
+                profile = profiler.start()
+                chatter_classes.Chatroom(1, db).get_messages()
+                profiler.finish(profile, '/view/chatroom/<int:chatroomid>', 0.01)
+                time.sleep(0.002)
+
+            self.assertEqual(2, len(chatter_profiler.list_dumps(tmp_dir)))
+
+            summary = chatter_profiler.summarise(tmp_dir, '/view/chatroom/<int:chatroomid>')
+            self.assertEqual(2, summary['dumps'])
+            self.assertTrue(any('get_messages' in f['function'] for f in summary['functions']))
+            self.assertEqual(0, chatter_profiler.summarise(tmp_dir, '/view/chatroom/list')['dumps'])
+
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    def setUp(self):
+        self.timed_db = sqlite3.connect('test.db', detect_types=sqlite3.PARSE_DECLTYPES,
+                                        factory=chatter_slowlog.TimedConnection)
+        self.timed_db.row_factory = sqlite3.Row
+
+    def tearDown(self):
+        chatter_slowlog.active_log = None
+        self.timed_db.close()
+
+    def test_slow_statements_logged(self):
+        # With a threshold of 0 every statement counts as slow
+        chatter_slowlog.active_log = chatter_slowlog.SlowQueryLog(0)
+        chatter_classes.Chatroom(1, self.timed_db).get_messages()
+
+        entry = chatter_slowlog.active_log.entries[0]
+        self.assertEqual('Message.get_msesages_for_chatroom', entry['caller'])
+        self.assertEqual(['int', 'int'], entry['parameters'])
+        self.assertTrue(any('Message' in line for line in entry['plan']))
+
+        # Running the same statements again logs them again, but their plans are only captured once
+        plans = chatter_slowlog.active_log.plans
+        entry_count = len(chatter_slowlog.active_log.entries)
+        chatter_classes.Chatroom(1, self.timed_db).get_messages()
+        self.assertEqual(2 * entry_count, len(chatter_slowlog.active_log.entries))
+        self.assertEqual(plans, chatter_slowlog.active_log.plans)
+
+    def test_fast_statements_not_logged(self):
+        chatter_slowlog.active_log = chatter_slowlog.SlowQueryLog(10000)
+        chatter_classes.Chatroom(1, self.timed_db).get_messages()
+        self.assertEqual([], chatter_slowlog.active_log.entries)
+
+
+class TestBroker(unittest.TestCase):
+
+    def test_backpressure_policies(self):
+        events = []
+        broker = chatter_broker.Broker(max_queue=2, metrics_hook=lambda name, topic, count: events.append(name))
+        dropping = broker.subscribe([1])
+        disconnecting = broker.subscribe([1], policy=chatter_broker.DISCONNECT)
+
+        for i in range(3):
+            broker.publish(1, i)
+
+        # The oldest event made way for the newest
+        self.assertEqual([(1, 1), (1, 2)], [dropping.get(0), dropping.get(0)])
+        self.assertIsNone(dropping.get(0))
+        self.assertEqual(1, dropping.dropped)
+
+        # Events already queued can still be read before the subscription reports that it was closed
+        self.assertEqual('overflow', disconnecting.closed_reason)
+        self.assertEqual([(1, 0), (1, 1)], [disconnecting.get(0), disconnecting.get(0)])
+        self.assertRaises(chatter_broker.SubscriptionClosed, disconnecting.get, 0)
+
+        self.assertEqual(1, broker.subscriber_count(1))
+        self.assertIn('dropped', events)
+        self.assertIn('disconnected', events)
+
+    def test_topics(self):
+        broker = chatter_broker.Broker()
+        subscription = broker.subscribe([1])
+        subscription.add_topics([2])
+        subscription.remove_topics([1])
+
+        self.assertEqual(0, broker.publish(1, "Not delivered"))
+        self.assertEqual(1, broker.publish(2, "Delivered"))
+        self.assertEqual((2, "Delivered"), subscription.get(0))
+
+        subscription.close()
+        self.assertEqual(0, broker.subscriber_count())
+
+    def test_message_add_published(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_db = create_test_database(os.path.join(tmp_dir, 'broker_test.db'))
+            subscription = chatter_classes.broker.subscribe([1, chatter_classes.get_user_topic(6)])
+
+            try:
+                m = chatter_classes.Message.add("Added by test_message_add_published()", 1, 1, test_db)
+                self.assertEqual((1, {'type': 'message_added', 'chatroomid': 1, 'messageid': m.messageid}),
+                                 subscription.get(0))
+
+                # Published to the chatroom's topic and to the new member's own topic
+                chatter_classes.Chatroom(1, test_db).add_members([6])
+                topics = {topic for topic, event in (subscription.get(0), subscription.get(0))
+                          if event['type'] == 'membership_changed'}
+                self.assertEqual({1, chatter_classes.get_user_topic(6)}, topics)
+
+            finally:
+                subscription.close()
+                test_db.close()
+
+
+class TestNotifyChannel(unittest.TestCase):
+
+    def test_message_add_reaches_other_worker(self):
+        # Two channels in one process stand in for two workers, each with its own broker
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_db = create_test_database(os.path.join(tmp_dir, 'notify_test.db'))
+            other_broker = chatter_broker.Broker()
+            this_worker = chatter_notify.NotifyChannel(os.path.join(tmp_dir, 'notify'), chatter_classes.broker, 'a')
+            other_worker = chatter_notify.NotifyChannel(os.path.join(tmp_dir, 'notify'), other_broker, 'b',
+                                                        chatter_classes.receive_event)
+            other_worker.start()
+            changes = []
+            chatter_classes.message_change_listeners.append(lambda *args: changes.append(args))
+            subscription = other_broker.subscribe([1, chatter_classes.get_user_topic(6)])
+            chatter_classes.notify_channel = this_worker
+
+            try:
+                m = chatter_classes.Message.add("Added by test_message_add_reaches_other_worker()", 1, 1, test_db)
+                self.assertEqual((1, {'type': 'message_added', 'chatroomid': 1, 'messageid': m.messageid}),
+                                 subscription.get(5))
+
+                # Tuple topics survive the trip
+                chatter_classes.notify_membership_changed(1, [6])
+                self.assertEqual({1, chatter_classes.get_user_topic(6)},
+                                 {subscription.get(5)[0], subscription.get(5)[0]})
+
+                # Change listeners are called in this worker, then again in the other one when the event arrives, so
+                # its cached copies are cleared too
+                m.update(content="Changed by test_message_add_reaches_other_worker()")
+                self.assertEqual('message_changed', subscription.get(5)[1]['type'])
+                self.assertEqual([(1, m.messageid), (1, m.messageid)], changes)
+
+                # A worker that has closed its channel is no longer sent events
+                other_worker.close()
+                self.assertEqual(0, this_worker.send(1, {}))
+                self.assertEqual({'sent': 4, 'received': 0, 'dropped': 0}, this_worker.stats)
+                self.assertEqual(4, other_worker.stats['received'])
+
+            finally:
+                chatter_classes.notify_channel = None
+                chatter_classes.message_change_listeners.pop()
+                subscription.close()
+                this_worker.close()
+                test_db.close()
+
+
+class TestWebSocket(unittest.TestCase):
+
+    def test_framing(self):
+        server_socket, client_socket = socket.socketpair()
+        server = chatter_websocket.WebSocket(server_socket)
+        client = chatter_websocket.WebSocket(client_socket, client=True)
+
+        try:
+            # Long enough to need the 16 bit length
+            client.send("Sent by test_framing() " * 20)
+            self.assertEqual("Sent by test_framing() " * 20, server.receive(5))
+            server.send(b"\x00\x01")
+            self.assertEqual(b"\x00\x01", client.receive(5))
+            self.assertIsNone(server.receive(0.01))
+
+            client.close(chatter_websocket.CLOSE_NORMAL, "Done")
+            with self.assertRaises(chatter_websocket.ConnectionClosed) as cm:
+                server.receive(5)
+            self.assertEqual((chatter_websocket.CLOSE_NORMAL, "Done"), (cm.exception.code, cm.exception.reason))
+
+            # The server answered the closing handshake
+            self.assertRaises(chatter_websocket.ConnectionClosed, client.receive, 5)
+
+        finally:
+            server.shutdown()
+            client.shutdown()
+
+    def test_chat_session(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            database_path = os.path.join(tmp_dir, 'websocket_test.db')
+            create_test_database(database_path).close()
+            server = load_test.start_local_server(database_path, os.path.join(tmp_dir, 'page_cache'))
+            address = ('127.0.0.1', server.server_port)
+
+            try:
+                cookies = http.cookiejar.CookieJar()
+                opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
+                opener.open(f"http://{address[0]}:{address[1]}/login",
+                            urllib.parse.urlencode({'username': 'TestUser1', 'password': 'test1'}).encode())
+
+                ws = chatter_websocket.WebSocket.connect(address, '/ws', {
+                    'Cookie': '; '.join(f"{c.name}={c.value}" for c in cookies)})
+
+                ws.send(json.dumps({'type': 'send', 'chatroomid': 1, 'content': "Sent by test_chat_session()", 'ref': 1}))
+                replies = {r['type']: r for r in (json.loads(ws.receive(5)), json.loads(ws.receive(5)))}
+                self.assertEqual(replies['sent']['messageid'], replies['message_added']['message']['messageid'])
+                self.assertEqual("Sent by test_chat_session()", replies['message_added']['message']['content'])
+
+                # Membership is checked before sending
+                ws.send(json.dumps({'type': 'send', 'chatroomid': 999, 'content': "Not sent", 'ref': 2}))
+                self.assertEqual({'type': 'error', 'ref': 2}, {k: v for k, v in json.loads(ws.receive(5)).items()
+                                                               if k != 'error'})
+
+                ws.close()
+                self.assertRaises(chatter_websocket.ConnectionClosed, ws.receive, 5)
+
+            finally:
+                server.shutdown()
+                # Starting the app turned on its rate limiting, which other tests don't expect
+                chatter_classes.rate_limiter = None
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_token_buckets(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'buckets.bin')
+            limit = chatter_ratelimit.Limit(rate=1.0, burst=2)
+            buckets = chatter_ratelimit.TokenBuckets(path, slots=8)
+            # A second instance on the same file stands in for another worker process
+            other_worker = chatter_ratelimit.TokenBuckets(path, slots=8)
+
+            try:
+                self.assertIsNone(buckets.take([(1, limit)], now=100))
+                self.assertIsNone(other_worker.take([(1, limit)], now=100))
+                self.assertEqual((0, 1.0), buckets.take([(1, limit)], now=100))
+                self.assertIsNone(buckets.take([(1, limit)], now=101))
+
+                # A refused take leaves every bucket alone
+                self.assertEqual((1, 0.5), buckets.take([(2, limit), (1, limit)], now=101.5))
+                self.assertIsNone(other_worker.take([(2, limit)], now=101.5))
+                self.assertIsNone(other_worker.take([(2, limit)], now=101.5))
+
+                # More keys than slots: buckets that have refilled are reused
+                for key in range(3, 20):
+                    self.assertIsNone(buckets.take([(key, limit)], now=200 + key * 10))
+
+            finally:
+                buckets.close()
+                other_worker.close()
+
+    def test_send_message_limited(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_db = create_test_database(os.path.join(tmp_dir, 'rate_limit_test.db'))
+            chatter_classes.rate_limiter = chatter_ratelimit.RateLimiter(
+                os.path.join(tmp_dir, 'buckets.bin'), {'member': chatter_ratelimit.Limit(0.001, 1)}, None)
+
+            try:
+                # TestUser2 is a member of chatroom 1, and TestUser1 its owner
+                member = chatter_classes.User(2, test_db)
+                member.send_message("Sent by test_send_message_limited()", 1)
+
+                with self.assertRaises(chatter_ratelimit.RateLimitError) as cm:
+                    member.send_message("Not sent", 1)
+                self.assertEqual('user', cm.exception.scope)
+                self.assertRaises(chatter_ratelimit.RateLimitError, chatter_classes.Chatroom(1, test_db).add_message,
+                                  "Not sent", 2)
+
+                chatter_classes.User(1, test_db).send_message("Owners have their own limit", 1)
+
+            finally:
+                chatter_classes.rate_limiter.close()
+                chatter_classes.rate_limiter = None
+                test_db.close()
+
+
+class TestSendLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_path = os.path.join(self.tmp_dir.name, 'send_log_test.db')
+        self.log_dir = os.path.join(self.tmp_dir.name, 'send_log')
+        self.db = create_test_database(self.database_path)
+
+    def tearDown(self):
+        chatter_classes.send_log = None
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def connect(self):
+        test_db = sqlite3.connect(self.database_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        test_db.row_factory = sqlite3.Row
+        return test_db
+
+    def test_fast_ack(self):
+        send_log = chatter_sendlog.SendLog(self.log_dir, self.connect)
+        chatter_classes.send_log = send_log
+        message_count = chatter_classes.Chatroom(1, self.db).get_message_count()
+
+        # Not applied until the applier starts, but readers in this process see it
+        m = chatter_classes.User(2, self.db).send_message("Sent by test_fast_ack()", 1, fast_ack=True)
+        self.assertIsInstance(m, chatter_classes.PendingMessage)
+        page = json.loads(chatter_classes.Chatroom(1, self.db).json_history_page())
+        self.assertEqual(m.messageid, json.loads(page['messages'][0])['messageid'])
+        self.assertEqual(message_count, chatter_classes.Chatroom(1, self.db).get_message_count())
+
+        subscription = chatter_classes.broker.subscribe([1])
+        try:
+            send_log.start()
+            self.assertTrue(send_log.flush(5))
+
+            self.assertEqual(message_count + 1, chatter_classes.Chatroom(1, self.db).get_message_count())
+            self.assertEqual([], chatter_classes.Chatroom(1, self.db).get_pending_messages())
+
+            added, applied = subscription.get(0)[1], subscription.get(0)[1]
+            self.assertEqual(('message_added', 'message_applied'), (added['type'], applied['type']))
+            self.assertEqual((added['messageid'], m.messageid), (applied['messageid'], applied['provisionalid']))
+
+        finally:
+            subscription.close()
+            send_log.close()
+
+        # Everything was applied, so the log was removed along with its checkpoint
+        self.assertEqual([], os.listdir(self.log_dir))
+        self.assertEqual(0, self.db.execute("SELECT count(*) FROM SendLogCheckpoint").fetchone()[0])
+
+    def test_recovery(self):
+        # A log left by a crashed worker: its first message was applied before the crash, and its last line is torn
+        os.makedirs(self.log_dir)
+        with open(os.path.join(self.log_dir, '1-1.log'), 'w') as f:
+            for seq in (1, 2, 3):
+                f.write(json.dumps({'seq': seq, 'content': f"Logged message {seq}", 'chatroomid': 2, 'senderid': 3,
+                                    'timestamp': 1700000000 + seq}) + "\n")
+            f.write('{"seq": 4, "content": "Torn')
+
+        chatter_sendlog.create_checkpoint_table(self.db)
+        with open(os.path.join(self.log_dir, '1-1.log'), 'rb') as f:
+            chatter_sendlog.apply_entries(self.db, '1-1', chatter_sendlog.read_entries(f)[:1])
+
+        message_count = chatter_classes.Chatroom(2, self.db).get_message_count()
+
+        send_log = chatter_sendlog.SendLog(self.log_dir, self.connect)
+        send_log.start()
+        send_log.close()
+
+        self.assertEqual(message_count + 2, chatter_classes.Chatroom(2, self.db).get_message_count())
+        self.assertEqual(1, self.db.execute("SELECT count(*) FROM Message WHERE content='Logged message 1'").fetchone()[0])
+        self.assertEqual([], os.listdir(self.log_dir))
+        self.assertEqual(0, self.db.execute("SELECT count(*) FROM SendLogCheckpoint").fetchone()[0])
+
+
+class TestMigrations(unittest.TestCase):
+
+    def test_migrate_old_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # A database from before versioning, without the rollup table
+            path = os.path.join(tmp_dir, 'migration_test.db')
+            old_db = create_test_database(path)
+            old_db.execute("DROP TABLE MessageRollup")
+            old_db.execute("PRAGMA user_version=0")
+            old_db.commit()
+
+            self.assertEqual({path: chatter_migrations.LATEST_VERSION}, chatter_migrations.check_schema([path]))
+
+            # Stop after creating the table, then add a message, which is counted as it is added
+            chatter_migrations.migrate(old_db, target=1)
+            chatter_classes.Message.add("Added during test_migrate_old_database()", 1, 1, old_db)
+
+            self.assertEqual(chatter_migrations.LATEST_VERSION, chatter_migrations.migrate(old_db, batch_size=4, pause=0))
+            self.assertEqual({}, chatter_migrations.check_schema([path]))
+
+            migrated = old_db.execute("SELECT * FROM MessageRollup ORDER BY 1, 2, 3").fetchall()
+            chatter_rollups.rebuild_rollups(old_db)
+            self.assertEqual([tuple(r) for r in old_db.execute("SELECT * FROM MessageRollup ORDER BY 1, 2, 3")],
+                             [tuple(r) for r in migrated])
+
+            old_db.execute(f"PRAGMA user_version={chatter_migrations.LATEST_VERSION + 1}")
+            self.assertRaises(chatter_migrations.SchemaError, chatter_migrations.check_schema, [path])
+            old_db.close()
+
+    def test_new_database_current(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_db = create_test_database(os.path.join(tmp_dir, 'migration_test.db'))
+            self.assertEqual([], chatter_migrations.get_pending_migrations(test_db))
+            test_db.close()
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = create_test_database(os.path.join(self.tmp_dir.name, 'retention_test.db'))
+
+        # Messages 1-3 of TestRoom1 were sent 20 days ago and archived, 4-5 are 10 days old and 6 is recent
+        now = int(time.time())
+        self.db.execute("UPDATE Message SET timestamp=? WHERE messageid<=3", [now - 20 * 86400])
+        self.db.execute("UPDATE Message SET timestamp=? WHERE messageid IN (4, 5)", [now - 10 * 86400])
+        self.db.commit()
+        chatter_rollups.rebuild_rollups(self.db)
+        chatter_archive.archive_messages(self.db, datetime.datetime.now() - datetime.timedelta(days=15))
+
+        # Message 1's attachments, as real files
+        self.attachment_paths = []
+        for row in self.db.execute("SELECT attachmentid, filepath FROM Attachment WHERE messageid=1").fetchall():
+            path = os.path.join(self.tmp_dir.name, row['filepath'])
+            open(path, 'wb').close()
+            self.db.execute("UPDATE Attachment SET filepath=? WHERE attachmentid=?", [path, row['attachmentid']])
+            self.attachment_paths.append(path)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_purge(self):
+        chatroom = chatter_classes.Chatroom(1, self.db)
+        self.assertIsNone(chatroom.retention_days)
+        self.assertRaises(chatter_classes.ChatroomActionError, chatroom.set_retention_days, 0)
+        chatroom.set_retention_days(7)
+        self.assertEqual(7, chatroom.retention_days)
+
+        self.assertEqual({1: 7}, chatter_retention.get_policies(self.db))
+        self.assertEqual({1: 7, 2: 30, 3: 30}, chatter_retention.get_policies(self.db, 30))
+
+        result = chatter_retention.apply_retention(self.db, batch_size=1, pause=0)
+        self.assertEqual(5, result['purged'])
+        self.assertEqual(len(self.attachment_paths), result['files_removed'])
+
+        self.assertEqual([6], [m.messageid for m in chatroom.get_messages()])
+        self.assertEqual(16, self.db.execute("SELECT count(*) FROM Message").fetchone()[0])
+        self.assertEqual([], self.db.execute("SELECT * FROM Attachment WHERE messageid=1").fetchall())
+        self.assertEqual([], self.db.execute("SELECT * FROM AttachmentFileQueue").fetchall())
+        self.assertEqual([], self.db.execute("SELECT * FROM MessageArchive").fetchall())
+        self.assertEqual([], os.listdir(chatter_archive.get_archive_dir(self.db)))
+        for path in self.attachment_paths:
+            self.assertFalse(os.path.exists(path))
+
+        # The rollups match a recount
+        purged_counts = self.db.execute("SELECT * FROM MessageRollup ORDER BY 1, 2, 3").fetchall()
+        chatter_rollups.rebuild_rollups(self.db)
+        self.assertEqual([tuple(r) for r in self.db.execute("SELECT * FROM MessageRollup ORDER BY 1, 2, 3")],
+                         [tuple(r) for r in purged_counts])
+
+        # Nothing left to do
+        self.assertEqual(0, chatter_retention.apply_retention(self.db)['purged'])
+
+    def test_failed_purge_leaves_segment(self):
+        # Message 3 is younger than the rest of its segment, so the segment is rewritten rather than removed
+        chatter_archive.update_archived_message(self.db, 3, timestamp=int(time.time()) - 18 * 86400)
+        chatter_classes.Chatroom(1, self.db).set_retention_days(19)
+        archive_dir = chatter_archive.get_archive_dir(self.db)
+        segment_files = sorted(os.listdir(archive_dir))
+
+        # Queueing the purged messages' attachment files fails, so the transaction rolls back
+        self.db.execute("DROP TABLE AttachmentFileQueue")
+        self.db.commit()
+        self.assertRaises(sqlite3.OperationalError, chatter_retention.purge_chatroom, self.db, 1,
+                          datetime.datetime.now() - datetime.timedelta(days=19), pause=0)
+
+        self.assertEqual(segment_files, sorted(os.listdir(archive_dir)))
+        self.assertEqual([1, 2, 3], [m.messageid for m in chatter_classes.Chatroom(1, self.db).get_messages()][:3])
+
+        chatter_retention.create_file_queue_table(self.db)
+        self.assertEqual(2, chatter_retention.purge_chatroom(self.db, 1, datetime.datetime.now() -
+                                                             datetime.timedelta(days=19), pause=0))
+        self.assertEqual(segment_files, sorted(os.listdir(archive_dir)))
+        self.assertEqual([3, 4, 5, 6], [m.messageid for m in chatter_classes.Chatroom(1, self.db).get_messages()])
+
+    def test_incremental_vacuum(self):
+        # New databases are set up for it
+        self.assertEqual(2, self.db.execute("PRAGMA auto_vacuum").fetchone()[0])
+
+        for auto_vacuum in ('INCREMENTAL', 'NONE'):
+            path = os.path.join(self.tmp_dir.name, f'vacuum_{auto_vacuum}.db')
+            vacuum_db = sqlite3.connect(path)
+            vacuum_db.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+            vacuum_db.execute("CREATE TABLE Filler (data TEXT)")
+            vacuum_db.executemany("INSERT INTO Filler VALUES (?)", [['x' * 1000] for i in range(1000)])
+            vacuum_db.commit()
+            vacuum_db.execute("DELETE FROM Filler")
+            vacuum_db.commit()
+
+            size = os.path.getsize(path)
+            free_bytes = vacuum_db.execute("PRAGMA freelist_count").fetchone()[0] * \
+                vacuum_db.execute("PRAGMA page_size").fetchone()[0]
+            reclaimed = chatter_retention.incremental_vacuum(vacuum_db, pages=100, pause=0)
+            vacuum_db.close()
+
+            if auto_vacuum == 'INCREMENTAL':
+                # Every free page, not just the first of each step
+                self.assertGreater(free_bytes, 0)
+                self.assertEqual(free_bytes, reclaimed)
+            else:
+                # Left alone
+                self.assertEqual(0, reclaimed)
+            self.assertEqual(size - reclaimed, os.path.getsize(path))
+
+
+class TestMaintenance(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = create_test_database(os.path.join(self.tmp_dir.name, 'maintenance_test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_run_maintenance(self):
+        # Enough deleted messages to leave free pages behind
+        self.db.executemany("INSERT INTO Message (content, chatroomid, senderid, timestamp) VALUES (?, 1, 1, 0)",
+                            [['x' * 1000] for i in range(500)])
+        self.db.commit()
+        self.db.execute("DELETE FROM Message")
+        self.db.commit()
+
+        results = chatter_maintenance.run_maintenance(self.db)
+        self.assertEqual(list(chatter_maintenance.TASKS), [r['task'] for r in results])
+        outcomes = {r['task']: r['result'] for r in results}
+
+        # Not in WAL mode, so there is nothing to checkpoint
+        self.assertEqual({'analyze': 'completed', 'optimize': 'completed', 'checkpoint': 'skipped',
+                          'vacuum': 'completed'}, outcomes)
+        self.assertGreater(sum(r['bytes_reclaimed'] for r in results), 0)
+        self.assertEqual(0, self.db.execute("PRAGMA freelist_count").fetchone()[0])
+        self.assertIsNotNone(self.db.execute("SELECT * FROM sqlite_master WHERE name='sqlite_stat1'").fetchone())
+
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("UPDATE Chatroom SET description='Changed by test_run_maintenance()'")
+        self.db.commit()
+        self.assertEqual('completed', chatter_maintenance.run_maintenance(self.db, ['checkpoint'])[0]['result'])
+        self.db.execute("PRAGMA journal_mode=DELETE")
+
+        # Out of time
+        self.assertEqual(['skipped'] * 4, [r['result'] for r in chatter_maintenance.run_maintenance(self.db, budget=0)])
+        self.assertRaises(chatter_maintenance.MaintenanceError, chatter_maintenance.run_maintenance, self.db, ['defrag'])
+
+    def test_quiet_hours(self):
+        self.assertTrue(chatter_maintenance.is_quiet_hour((2, 5), datetime.datetime(2024, 1, 1, 3)))
+        self.assertFalse(chatter_maintenance.is_quiet_hour((2, 5), datetime.datetime(2024, 1, 1, 5)))
+        self.assertTrue(chatter_maintenance.is_quiet_hour((23, 4), datetime.datetime(2024, 1, 1, 1)))
+        self.assertFalse(chatter_maintenance.is_quiet_hour((23, 4), datetime.datetime(2024, 1, 1, 12)))
+        self.assertTrue(chatter_maintenance.is_quiet_hour(None))
+
+    def test_scheduler(self):
+        path = os.path.join(self.tmp_dir.name, 'maintenance_test.db')
+        state_path = os.path.join(self.tmp_dir.name, 'maintenance.state')
+        runs = []
+
+        def connect():
+            return sqlite3.connect(path)
+
+        scheduler = chatter_maintenance.MaintenanceScheduler(connect, state_path, hours=None, on_run=runs.append)
+        self.assertTrue(scheduler.is_due())
+
+        results = scheduler.run(['analyze'])
+        self.assertEqual([results], runs)
+        self.assertEqual('completed', results[0]['result'])
+        self.assertIsNotNone(scheduler.last_run)
+        self.assertFalse(scheduler.is_due())
+
+        # Another worker is running it
+        with open(state_path) as state:
+            fcntl.flock(state.fileno(), fcntl.LOCK_EX)
+            other = chatter_maintenance.MaintenanceScheduler(connect, state_path, hours=None)
+            self.assertIsNone(other.run())
+
+        # Triggered runs happen whatever the time
+        scheduler = chatter_maintenance.MaintenanceScheduler(connect, state_path, interval=None, hours=None,
+                                                             on_run=runs.append)
+        self.assertFalse(scheduler.is_due())
+        scheduler.start()
+        scheduler.trigger(['optimize'])
+        for i in range(100):
+            if len(runs) == 2:
+                break
+            time.sleep(0.05)
+        scheduler.stop()
+        self.assertEqual('optimize', runs[1][0]['task'])
+
+
+class TestCompressedPageCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = chatter_cache.CompressedPageCache(max_entries=2)
+        cache.put(1, 10, 'gzip', b'a')
+        cache.put(1, 20, 'gzip', b'b')
+        cache.get(1, 10, 'gzip')
+        cache.put(1, 30, 'gzip', b'c')
+
+        # Page 20 was the least recently used, so it should have been evicted
+        self.assertIsNone(cache.get(1, 20, 'gzip'))
+        self.assertEqual(b'a', cache.get(1, 10, 'gzip'))
+        self.assertEqual(2, len(cache))
+
+    def test_disk_cache_and_invalidation(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = chatter_cache.CompressedPageCache(max_entries=1, directory=cache_dir)
+            cache.put(1, 10, 'gzip', b'a')
+            cache.put(2, 10, 'gzip', b'b')
+
+            # Evicted from memory, but still available from disk
+            self.assertEqual(b'a', cache.get(1, 10, 'gzip'))
+
+            cache.invalidate_chatroom(1)
+            self.assertIsNone(cache.get(1, 10, 'gzip'))
+            self.assertEqual(b'b', cache.get(2, 10, 'gzip'))
+
+    def test_invalidated_when_sender_renamed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_db = create_test_database(os.path.join(tmp_dir, 'rename_test.db'))
+            cache = chatter_cache.CompressedPageCache()
+            chatter_classes.message_change_listeners.append(cache.invalidate_chatroom)
+
+            try:
+                chatroomids = [row[0] for row in test_db.execute("SELECT DISTINCT chatroomid FROM Message WHERE "
+                                                                 "senderid=3 ORDER BY chatroomid")]
+                self.assertEqual(chatroomids, chatter_classes.Message.get_chatroomids_for_sender(3, test_db))
+                for chatroomid in chatroomids:
+                    cache.put(chatroomid, 10, 'gzip', b'TestUser3')
+
+                # Cached pages show the old username, so they are dropped
+                chatter_classes.User(3, test_db).update(username='RenamedUser3')
+                for chatroomid in chatroomids:
+                    self.assertIsNone(cache.get(chatroomid, 10, 'gzip'))
+
+                page = json.loads(chatter_classes.Chatroom(chatroomids[0], test_db).json_history_page(limit=100))
+                self.assertIn('RenamedUser3', [json.loads(m)['sender_username'] for m in page['messages']])
+
+            finally:
+                chatter_classes.message_change_listeners.remove(cache.invalidate_chatroom)
+                test_db.close()
+
+    def test_disk_size_limit(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = chatter_cache.CompressedPageCache(max_entries=1, directory=cache_dir, max_disk_bytes=16)
+
+            for i, cursor in enumerate((10, 20, 30, 40)):
+                cache.put(1, cursor, 'gzip', b'abcd')
+                os.utime(os.path.join(cache_dir, '1', f"{cursor}.gzip"), (1000 * (i + 1), 1000 * (i + 1)))
+
+            # Over the limit, so the least recently used page is removed from disk
+            cache.put(1, 50, 'gzip', b'abcd')
+            self.assertEqual(['20.gzip', '30.gzip', '40.gzip', '50.gzip'], sorted(os.listdir(os.path.join(cache_dir, '1'))))
+            self.assertIsNone(cache.get(1, 10, 'gzip'))
+
+
+class TestFragmentCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = chatter_cache.FragmentCache(max_entries=2, block_size=10)
+        cache.put(1, 10, 19, 'v1', '<a>')
+        cache.put(1, 20, 29, 'v1', '<b>')
+        cache.get(1, 10, 19, 'v1')
+        cache.put(1, 30, 39, 'v1', '<c>')
+
+        self.assertIsNone(cache.get(1, 20, 29, 'v1'))
+        self.assertEqual('<a>', cache.get(1, 10, 19, 'v1'))
+        # A new version of the block is a different entry
+        self.assertIsNone(cache.get(1, 10, 19, 'v2'))
+
+    def test_invalidation(self):
+        cache = chatter_cache.FragmentCache(block_size=10)
+        cache.put(1, 10, 19, 'v1', '<a>')
+        cache.put(1, 12, 15, 'v1', '<a part>')
+        cache.put(1, 20, 29, 'v1', '<b>')
+        cache.put(2, 10, 19, 'v1', '<c>')
+
+        # Only the changed message's block, in its own chatroom
+        cache.invalidate_message(1, 14)
+        self.assertIsNone(cache.get(1, 10, 19, 'v1'))
+        self.assertIsNone(cache.get(1, 12, 15, 'v1'))
+        self.assertEqual('<b>', cache.get(1, 20, 29, 'v1'))
+        self.assertEqual('<c>', cache.get(2, 10, 19, 'v1'))
+
+        cache.invalidate_message(1)
+        self.assertEqual(1, len(cache))
+
+    def test_blocks_follow_chatroom_messages(self):
+        # A chatroom getting every 50th id, as when it is one of many busy chatrooms, still gets blocks of about
+        # block_size of its own messages
+        cache = chatter_cache.FragmentCache(block_size=32)
+        messageids = range(7, 500000, 50)
+        starts = sum(cache.starts_block(m) for m in messageids)
+        self.assertAlmostEqual(32, len(messageids) / starts, delta=4)
+
+    def test_rendered_timeline(self):
+        import app
+
+        with app.app.test_request_context():
+            entries = list(reversed(chatter_classes.Chatroom(3, db).get_timeline(limit=None)))
+
+            first = app.render_timeline(3, entries)
+            hits = app.fragment_cache.stats['hits']
+            self.assertEqual(first, app.render_timeline(3, entries))
+            self.assertGreater(app.fragment_cache.stats['hits'], hits)
+
+            # A changed message is rendered again
+            changed = entries[:-1] + [entries[-1]._replace(content="Changed by test_rendered_timeline()")]
+            self.assertIn("Changed by test_rendered_timeline()", app.render_timeline(3, changed))
+
+
 if __name__ == '__main__':
 
     unittest.main()
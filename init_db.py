@@ -1,4 +1,4 @@
-import sqlite3, random
+import sqlite3, random, chatter_archive, chatter_rollups, chatter_migrations
 
 DB_PATH = 'chatter_db.db'
 
@@ -8,11 +8,33 @@ db.row_factory = sqlite3.Row
 
 def init_db(dbcnx:sqlite3.Connection):
 
+    # Only takes effect on a new, empty database file; lets chatter_retention.py give deleted messages' space back
+    dbcnx.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    reset_schema_version(dbcnx)
     create_user_table(dbcnx)
     create_chatroom_table(dbcnx)
     create_chatroommember_table(dbcnx)
     create_message_table(dbcnx)
     create_attachment_table(dbcnx)
+    create_message_archive_table(dbcnx)
+    create_message_rollup_table(dbcnx)
+
+    # The tables above are the current schema, so this only adds what later migrations add and sets user_version
+    chatter_migrations.migrate(dbcnx)
+
+
+def reset_schema_version(dbcnx:sqlite3.Connection):
+
+    try:
+        c = dbcnx.cursor()
+        c.execute("DROP TABLE IF EXISTS SchemaMigrationState")
+        c.execute("PRAGMA user_version=0")
+        dbcnx.commit()
+
+    except sqlite3.Error as e:
+        dbcnx.rollback()
+        print("ERROR: Unable to reset schema version. Details:", e)
+        raise e
 
 
 def create_user_table(dbcnx:sqlite3.Connection):
@@ -155,6 +177,42 @@ def create_attachment_table(dbcnx:sqlite3.Connection):
         raise e
 
 
+def create_message_archive_table(dbcnx:sqlite3.Connection):
+
+    try:
+        c = dbcnx.cursor()
+
+        c.execute("DROP TABLE IF EXISTS MessageArchive")
+
+        chatter_archive.create_archive_table(dbcnx)
+
+        dbcnx.commit()
+        print("Success: MessageArchive table initialised.")
+
+    except sqlite3.Error as e:
+        dbcnx.rollback()
+        print("ERROR: Unable to create MessageArchive table. Details:", e)
+        raise e
+
+
+def create_message_rollup_table(dbcnx:sqlite3.Connection):
+
+    try:
+        c = dbcnx.cursor()
+
+        c.execute("DROP TABLE IF EXISTS MessageRollup")
+
+        chatter_rollups.create_rollup_table(dbcnx)
+
+        dbcnx.commit()
+        print("Success: MessageRollup table initialised.")
+
+    except sqlite3.Error as e:
+        dbcnx.rollback()
+        print("ERROR: Unable to create MessageRollup table. Details:", e)
+        raise e
+
+
 if __name__ == '__main__':
     try:
         conf_number = random.randint(100000,999999)
@@ -0,0 +1,252 @@
+import sqlite3, threading, time, random, json, os, re, shutil, tempfile, argparse, statistics, gzip, logging
+import urllib.request, urllib.parse, urllib.error, http.cookiejar
+import synthetic_data, chatter_cache
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data')
+
+# Request paths are grouped into routes by replacing ids with placeholders
+ROUTE_PATTERNS = [
+    (re.compile(r'^/view/chatroom/\d+$'), '/view/chatroom/<chatroomid>'),
+    (re.compile(r'^/json/chatroom/\d+/messages$'), '/json/chatroom/<chatroomid>/messages'),
+    (re.compile(r'^/json/chatroom/\d+$'), '/json/chatroom/<chatroomid>'),
+]
+
+
+def get_route(path):
+
+    path = urllib.parse.urlsplit(path).path
+    for pattern, route in ROUTE_PATTERNS:
+        if pattern.match(path):
+            return route
+
+    return path
+
+
+class RouteStats:
+    # Latencies and errors for each route, shared by all of the simulated users
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__latencies = {}
+        self.__errors = {}
+
+    def record(self, route, latency, error):
+        with self.__lock:
+            self.__latencies.setdefault(route, []).append(latency)
+            if error:
+                self.__errors[route] = self.__errors.get(route, 0) + 1
+
+    def summarise(self, elapsed):
+
+        summary = {}
+
+        with self.__lock:
+            for route, latencies in sorted(self.__latencies.items()):
+                latencies = sorted(latencies)
+                summary[route] = {
+                    'requests': len(latencies),
+                    'throughput_rps': len(latencies) / elapsed,
+                    'error_rate': self.__errors.get(route, 0) / len(latencies),
+                    'p50_ms': percentile(latencies, 50) * 1000,
+                    'p95_ms': percentile(latencies, 95) * 1000,
+                    'p99_ms': percentile(latencies, 99) * 1000,
+                    'mean_ms': statistics.fmean(latencies) * 1000
+                }
+
+        return summary
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+class SimulatedUser:
+    """
+    One user working through the app the way a person would: log in, open the chatroom list, then repeatedly open one
+    of their chatrooms and page back through its history.
+    """
+
+    def __init__(self, base_url, userid, chatroomids, stats:RouteStats, rng:random.Random, think_time=0.0):
+
+        self.__base_url = base_url
+        self.__userid = userid
+        self.__chatroomids = chatroomids
+        self.__stats = stats
+        self.__rng = rng
+        self.__think_time = think_time
+
+        # Each user has its own cookie jar so it keeps its own session
+        self.__opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, path, data=None, check=None):
+
+        started = time.perf_counter()
+        body = None
+        error = False
+
+        try:
+            req = urllib.request.Request(self.__base_url + path, headers={'Accept-Encoding': 'gzip'},
+                                         data=urllib.parse.urlencode(data).encode() if data else None)
+            with self.__opener.open(req, timeout=30) as response:
+                body = response.read()
+                url = response.geturl()
+
+            # Pages redirect to the login page when the session has been lost, which is a failure, not a fast page
+            redirected_to_login = urllib.parse.urlsplit(url).path == '/login' and get_route(path) != '/login'
+            error = redirected_to_login or (check is not None and not check(body))
+
+        except (urllib.error.URLError, OSError):
+            error = True
+
+        self.__stats.record(get_route(path), time.perf_counter() - started, error)
+
+        if self.__think_time:
+            time.sleep(self.__rng.uniform(0, 2 * self.__think_time))
+
+        return None if error else body
+
+    def run(self, stop_at):
+
+        logged_in = self.request('/login', {'username': synthetic_data.get_username(self.__userid),
+                                            'password': synthetic_data.get_password(self.__userid)},
+                                 check=lambda body: b'Login successful' in body)
+        if logged_in is None:
+            return
+
+        while time.time() < stop_at:
+            self.request('/view/chatroom/list')
+
+            chatroomid = self.__rng.choice(self.__chatroomids)
+            self.request(f'/view/chatroom/{chatroomid}')
+
+            page = self.__decompress(self.request(f'/json/chatroom/{chatroomid}/messages'))
+
+            # Sometimes scroll back through older history, which exercises the compressed page cache
+            while page and time.time() < stop_at and self.__rng.random() < 0.5:
+                cursor = json.loads(page).get('next_cursor')
+                if cursor is None:
+                    break
+                page = self.__decompress(self.request(f'/json/chatroom/{chatroomid}/messages?before={cursor}'))
+
+    @staticmethod
+    def __decompress(body):
+        # The client accepts gzip, so larger responses (and every cached page) arrive compressed
+        if body and body[:2] == b'\x1f\x8b':
+            return gzip.decompress(body)
+
+        return body
+
+
+def pick_users(database_path, count, seed):
+    # Chooses users that belong to at least one chatroom, returning {userid: [chatroomid, ...]}
+
+    db = sqlite3.connect(database_path)
+    rows = db.execute("SELECT userid, group_concat(chatroomid) FROM ChatroomMember GROUP BY userid").fetchall()
+    db.close()
+
+    rng = random.Random(seed)
+    chosen = rng.sample(rows, min(count, len(rows)))
+
+    return {userid: [int(r) for r in chatroomids.split(',')] for userid, chatroomids in chosen}
+
+
+def start_local_server(database_path, cache_dir):
+    # Imported here so the load generator can also be pointed at a server started some other way
+    import app as chatter_app
+    from werkzeug.serving import make_server
+
+    chatter_app.app.config['DATABASE'] = database_path
+
+    # The new cache replaces the app's as a change listener too, so it is invalidated like the one it replaces
+    listeners = chatter_app.cc.message_change_listeners
+    listeners.remove(chatter_app.page_cache.invalidate_chatroom)
+    chatter_app.page_cache = chatter_cache.CompressedPageCache(chatter_app.app.config['PAGE_CACHE_ENTRIES'], cache_dir,
+                                                               chatter_app.app.config['PAGE_CACHE_DISK_BYTES'])
+    listeners.append(chatter_app.page_cache.invalidate_chatroom)
+
+    # Logging every request would cost more than some of the requests themselves
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = make_server('127.0.0.1', 0, chatter_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="LoadTestServer", daemon=True).start()
+
+    return server
+
+
+def run(base_url, database_path, concurrency=10, duration=30.0, think_time=0.0, seed=12345):
+    """
+    Runs concurrent simulated users against the app for a fixed time.
+    :param base_url: URL of the running app, e.g. http://127.0.0.1:8000
+    :param database_path: The synthetic database the app is serving, used to choose users and their chatrooms
+    :param concurrency: Number of simultaneous simulated users
+    :param duration: Seconds to run for
+    :param think_time: Average pause in seconds between each user's requests
+    :return: Dictionary of per-route statistics
+    """
+
+    users = pick_users(database_path, concurrency, seed)
+    stats = RouteStats()
+    stop_at = time.time() + duration
+    started = time.time()
+
+    threads = [threading.Thread(target=SimulatedUser(base_url, userid, chatroomids, stats,
+                                                     random.Random(seed + userid), think_time).run, args=(stop_at,))
+               for userid, chatroomids in users.items()]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return stats.summarise(time.time() - started)
+
+
+def print_summary(summary):
+
+    print(f"{'route':<40} {'requests':>9} {'req/s':>9} {'errors':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, s in summary.items():
+        print(f"{route:<40} {s['requests']:>9} {s['throughput_rps']:>9.1f} {s['error_rate']:>8.1%} "
+              f"{s['p50_ms']:>9.2f} {s['p95_ms']:>9.2f} {s['p99_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Drive the Chatter web app with concurrent simulated users.")
+    parser.add_argument('--url', help="URL of an already running app serving --database (default: start one locally)")
+    parser.add_argument('--database', help="Synthetic database to use (default: generate one at --scale)")
+    parser.add_argument('--scale', choices=synthetic_data.SCALES.keys(), default='small')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10],
+                        help="Numbers of simultaneous users; each is run in turn (default 10)")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds per concurrency level (default 30)")
+    parser.add_argument('--think-time', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    database = args.database or synthetic_data.get_dataset(DATA_DIR, args.scale, args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_server = None
+        url = args.url
+
+        if not url:
+            # Serve a copy so the cached dataset is never changed by the app
+            served_database = os.path.join(tmp_dir, 'load_test.db')
+            shutil.copyfile(database, served_database)
+            local_server = start_local_server(served_database, os.path.join(tmp_dir, 'page_cache'))
+            url = f"http://127.0.0.1:{local_server.server_port}"
+
+        for concurrency in args.concurrency:
+            print(f"\nRunning {concurrency} simulated users for {args.duration} seconds against {url}")
+            results[concurrency] = run(url, database, concurrency, args.duration, args.think_time, args.seed)
+            print_summary(results[concurrency])
+
+        if local_server:
+            local_server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'url': args.url or 'local', 'database': database, 'duration_s': args.duration,
+                       'results': results}, f, indent=4)
+        print(f"Success: Results written to {args.output}")
@@ -0,0 +1,173 @@
+import sqlite3, random, time, argparse, os, bisect, itertools
+import init_db, chatter_rollups
+
+# Named dataset sizes shared by benchmark.py and load_test.py
+SCALES = {
+    'tiny': {'users': 50, 'chatrooms': 5, 'messages': 1000},
+    'small': {'users': 500, 'chatrooms': 50, 'messages': 20000},
+    'medium': {'users': 2000, 'chatrooms': 200, 'messages': 200000},
+    'large': {'users': 5000, 'chatrooms': 500, 'messages': 2000000}
+}
+
+ATTACHMENT_FILES = ['donald.png', 'gary.png', 'jen.png', 'will.png', 'test_attachment.txt']
+
+WORDS = ("the a to and of you it is that in for on this we be have not with are was can just so do what but if at "
+         "about like get will all my me up know out think one time when how there they see some now good your "
+         "lesson homework test python code database message chat room tomorrow today deadline project question "
+         "answer thanks please sorry yes no maybe great cool lol ok sure meeting later class teacher exam").split()
+
+# Relative busyness of each hour of the day, so messages cluster in the afternoon and evening like real chat traffic
+HOURLY_ACTIVITY = [1, 1, 1, 1, 1, 1, 2, 4, 6, 7, 7, 8, 9, 8, 8, 9, 10, 11, 12, 12, 11, 8, 5, 2]
+
+BATCH_SIZE = 10000
+
+
+def get_password(userid):
+    # Synthetic users' passwords can be derived from their id, so benchmarks and load tests can log in as anyone
+    return f"password{userid}"
+
+
+def get_username(userid):
+    return f"SynthUser{userid}"
+
+
+def zipf_cum_weights(n, s=1.1):
+    # Cumulative weights where the k-th item is chosen in proportion to 1/k^s, giving a heavy tail
+    return list(itertools.accumulate(1 / (k ** s) for k in range(1, n + 1)))
+
+
+def generate(path, users=2000, chatrooms=200, messages=200000, attachment_rate=0.02, days=365, seed=12345):
+    """
+    Creates a database of synthetic but realistically shaped data. Chatroom activity and chatroom size both follow
+    heavy-tailed distributions (a few busy rooms, many quiet ones), some members of each room send far more messages
+    than others, and message times follow a daily cycle. The same seed always produces the same database.
+    :param path: Database file to create. Any existing data in it is erased.
+    :param users: Number of users
+    :param chatrooms: Number of chatrooms
+    :param messages: Number of messages
+    :param attachment_rate: Fraction of messages that have an attachment
+    :param days: Messages are spread over this many days up to now
+    :param seed: Random seed
+    :return: Database connection to the new database
+    """
+
+    rng = random.Random(seed)
+
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    db.row_factory = sqlite3.Row
+
+    init_db.init_db(db)
+
+    # This database is being built from scratch, so durability can wait until it is finished
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute("PRAGMA journal_mode=MEMORY")
+
+    start = time.time()
+    c = db.cursor()
+
+    c.executemany("INSERT INTO User (userid, username, password, last_login_ts, admin, active) VALUES (?, ?, ?, ?, ?, 1)",
+                  [(u, get_username(u), get_password(u), 0, 1 if u == 1 else 0) for u in range(1, users + 1)])
+
+    c.executemany("INSERT INTO Chatroom (chatroomid, name, description, joincode) VALUES (?, ?, ?, ?)",
+                  [(r, f"SynthRoom{r}", f"Synthetic chatroom {r}", f"J{r:05d}") for r in range(1, chatrooms + 1)])
+
+    # Chatroom sizes are Pareto distributed; the first one or two members of each room own it
+    room_members = {}
+    for r in range(1, chatrooms + 1):
+        size = min(users, 2 + int(rng.paretovariate(1.2) * 5))
+        room_members[r] = rng.sample(range(1, users + 1), size)
+
+    c.executemany("INSERT INTO ChatroomMember (chatroomid, userid, owner) VALUES (?, ?, ?)",
+                  [(r, u, 1 if i < 1 + (r % 2) else 0) for r, members in room_members.items()
+                   for i, u in enumerate(members)])
+
+    db.commit()
+
+    # Rooms are picked by a Zipf distribution over a shuffled order, so room 1 isn't always the busiest
+    room_order = list(range(1, chatrooms + 1))
+    rng.shuffle(room_order)
+    room_weights = zipf_cum_weights(chatrooms)
+    sender_weights = {r: zipf_cum_weights(len(members)) for r, members in room_members.items()}
+    hour_weights = list(itertools.accumulate(HOURLY_ACTIVITY))
+
+    # Messages are inserted in time order, so messageids increase with timestamps as they would in real use
+    now = int(time.time())
+    first_day = now - days * 86400
+    timestamps = sorted(first_day + rng.randrange(days) * 86400 +
+                        (bisect.bisect(hour_weights, rng.random() * hour_weights[-1]) * 3600) + rng.randrange(3600)
+                        for i in range(messages))
+
+    messageid = 0
+    for batch_start in range(0, messages, BATCH_SIZE):
+        batch = timestamps[batch_start:batch_start + BATCH_SIZE]
+        rooms = rng.choices(room_order, cum_weights=room_weights, k=len(batch))
+
+        message_rows = []
+        attachment_rows = []
+
+        for ts, r in zip(batch, rooms):
+            messageid += 1
+            members = room_members[r]
+            sender = members[bisect.bisect(sender_weights[r], rng.random() * sender_weights[r][-1])]
+            word_count = max(1, int(rng.lognormvariate(2.2, 0.8)))
+            content = " ".join(rng.choices(WORDS, k=word_count)).capitalize() + "."
+
+            message_rows.append((messageid, content, r, sender, min(ts, now)))
+
+            if rng.random() < attachment_rate:
+                attachment_rows.append((messageid, rng.choice(ATTACHMENT_FILES)))
+
+        c.executemany("INSERT INTO Message (messageid, content, chatroomid, senderid, timestamp) VALUES (?, ?, ?, ?, ?)",
+                      message_rows)
+        c.executemany("INSERT INTO Attachment (messageid, filepath) VALUES (?, ?)", attachment_rows)
+        db.commit()
+
+    # The messages were bulk loaded rather than added through Message.add(), so count them all at once
+    chatter_rollups.rebuild_rollups(db)
+
+    db.execute("PRAGMA synchronous=FULL")
+    db.execute("PRAGMA journal_mode=DELETE")
+
+    print(f"Success: Generated {users} users, {chatrooms} chatrooms and {messages} messages in "
+          f"{time.time() - start:.1f} seconds.")
+
+    return db
+
+
+def get_dataset(directory, scale, seed=12345):
+    """
+    Returns the path to a generated database for one of the SCALES, generating it only if it doesn't already exist.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"synthetic_{scale}_{seed}.db")
+
+    if not os.path.exists(path):
+        # Generate under a temporary name so an interrupted run never leaves a partial dataset behind
+        tmp_path = path + '.tmp'
+        generate(tmp_path, seed=seed, **SCALES[scale]).close()
+        os.replace(tmp_path, path)
+
+    return path
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic Chatter database.")
+    parser.add_argument('database', help="Path of the database to create (any existing data is erased)")
+    parser.add_argument('--scale', choices=SCALES.keys(), default='medium',
+                        help="Preset dataset size (default medium); overridden by the options below")
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--chatrooms', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--attachment-rate', type=float, default=0.02)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=12345)
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    for key in sizes:
+        if getattr(args, key) is not None:
+            sizes[key] = getattr(args, key)
+
+    generate(args.database, attachment_rate=args.attachment_rate, days=args.days, seed=args.seed, **sizes).close()